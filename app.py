@@ -1,6 +1,15 @@
 import pathlib
-from flask import Flask, request, jsonify
-import os, json, shutil, datetime, csv, mimetypes, re
+from flask import Flask, request, jsonify, Response, stream_with_context
+import os, json, shutil, datetime, csv, mimetypes, re, fnmatch, heapq, itertools, threading, io, base64, queue, mmap, struct, math, hashlib, contextlib, time, bisect, ctypes, ctypes.util, gzip, zlib, atexit
+from array import array
+from stat import S_ISDIR
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows; locks fall back to in-process only
+    fcntl = None
 
 app = Flask(__name__)
 
@@ -9,20 +18,769 @@ import os, json, shutil, datetime, csv, mimetypes, re
 
 app = Flask(__name__)
 
-BASE_DIR = "/data/AI-Agency"
+BASE_DIR = os.getenv("DRIVE_DIR", "/data/AI-Agency")
 TRASH_DIR = os.path.join(BASE_DIR, ".trash")
 SHEETS_DIR = os.path.join(BASE_DIR, "sheets")
 DOCS_DIR = os.path.join(BASE_DIR, "docs")
 
 BASE = pathlib.Path(__file__).resolve().parent
 DATA_DIR   = pathlib.Path(os.getenv("DATA_DIR", BASE / "data"))
-LOGS_DIR   = BASE / "logs"
-DOCS_DIR   = BASE / "docs"
-SHEETS_DIR = BASE / "sheets"
+LOGS_DIR   = pathlib.Path(os.getenv("LOGS_DIR", BASE / "logs"))
+DOCS_DIR   = pathlib.Path(os.getenv("DOCS_DIR", BASE / "docs"))
+SHEETS_DIR = pathlib.Path(os.getenv("SHEETS_DIR", BASE / "sheets"))
 
 for d in (DATA_DIR, LOGS_DIR, DOCS_DIR, SHEETS_DIR):
     os.makedirs(d, exist_ok=True)
 
+# --- Streaming responses -----------------------------------------------------
+#
+# Large reads can be streamed instead of being built in memory and passed to
+# jsonify. "Accept: application/x-ndjson" yields one JSON value per line;
+# "stream=true" yields the usual JSON document in chunks. Output is flushed
+# every STREAM_CHUNK_BYTES so memory stays flat whatever the source size.
+
+STREAM_CHUNK_BYTES = int(os.getenv("STREAM_CHUNK_BYTES", 64 * 1024))
+
+def _dumps(value):
+    return json.dumps(value, separators=(",", ":"))
+
+def _stream_mode(data=None):
+    if "application/x-ndjson" in request.headers.get("Accept", ""):
+        return "ndjson"
+    flag = request.args.get("stream")
+    if flag is None and isinstance(data, dict):
+        flag = data.get("stream")
+    if str(flag).lower() in ("1", "true", "yes"):
+        return "json"
+    return None
+
+def _buffered(pieces):
+    buf, size = [], 0
+    for piece in pieces:
+        buf.append(piece)
+        size += len(piece)
+        if size >= STREAM_CHUNK_BYTES:
+            yield "".join(buf)
+            buf, size = [], 0
+    if buf:
+        yield "".join(buf)
+
+def _json_array_pieces(prefix, items, suffix):
+    yield prefix
+    for i, item in enumerate(items):
+        yield ("," if i else "") + _dumps(item)
+    yield suffix
+
+def _stream_response(mode, items, head=None, key="values"):
+    # head: leading fields of the JSON document (first NDJSON line), items: the array
+    if mode == "ndjson":
+        pieces = itertools.chain(
+            [_dumps(head) + "\n"] if head else [],
+            (_dumps(item) + "\n" for item in items),
+        )
+        return Response(_buffered(pieces), mimetype="application/x-ndjson")
+    prefix = "{" + "".join(f"{_dumps(k)}:{_dumps(v)}," for k, v in (head or {}).items())
+    pieces = _json_array_pieces(f"{prefix}{_dumps(key)}:[", items, "]}")
+    return Response(_buffered(pieces), mimetype="application/json")
+
+def _stream_text_file(mode, path):
+    def chunks():
+        with open(path, "r", encoding="utf-8") as f:
+            while True:
+                chunk = f.read(STREAM_CHUNK_BYTES)
+                if not chunk:
+                    return
+                yield chunk
+    if mode == "ndjson":
+        lines = (_dumps({"content": chunk}) + "\n" for chunk in chunks())
+        return Response(lines, mimetype="application/x-ndjson")
+    # One JSON string assembled from escaped chunks
+    body = itertools.chain(['{"content":"'], (_dumps(chunk)[1:-1] for chunk in chunks()), ['"}'])
+    return Response(body, mimetype="application/json")
+
+
+# --- Drive metadata index ----------------------------------------------------
+#
+# Name, type, size and mtime of every entry of a directory, kept in memory
+# so listings and metadata lookups cost no per-entry stat. A directory is
+# scanned once (on first use, or by the warm-up walk when a worker starts)
+# and then kept current by the drive handlers and, on Linux, by an inotify
+# watch that also sees changes made by other workers and processes.
+# Directories without a watch are rescanned when their own mtime changes,
+# and while that mtime is too recent to tell two changes apart.
+
+DRIVE_INDEX_WATCH = os.getenv("DRIVE_INDEX_WATCH", "1").lower() not in ("0", "false", "no")
+DRIVE_INDEX_WARM_DIRS = int(os.getenv("DRIVE_INDEX_WARM_DIRS", 1000))  # directories scanned at startup
+DRIVE_INDEX_RACY_NS = 2_000_000_000
+
+_IN_MODIFY, _IN_ATTRIB, _IN_CLOSE_WRITE = 0x2, 0x4, 0x8
+_IN_MOVED_FROM, _IN_MOVED_TO, _IN_CREATE, _IN_DELETE = 0x40, 0x80, 0x100, 0x200
+_IN_DELETE_SELF, _IN_MOVE_SELF, _IN_Q_OVERFLOW, _IN_IGNORED = 0x400, 0x800, 0x4000, 0x8000
+_IN_ONLYDIR = 0x1000000
+_INOTIFY_MASK = (_IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO
+                 | _IN_CREATE | _IN_DELETE | _IN_DELETE_SELF | _IN_MOVE_SELF | _IN_ONLYDIR)
+
+_DRIVE_SORT_KEYS = {
+    "name": lambda e: e[0],
+    "type": lambda e: (e[1] != "folder", e[0]),
+    "size": lambda e: (e[2], e[0]),
+    "modified": lambda e: (e[3], e[0]),
+}
+
+_DRIVE_INTERNAL_NAMES = {".trash", ".uploads", ".blobs"}
+
+def _entry_stat(path, links=None):
+    # (type, size, mtime_ns) like os.path.isdir/os.stat; dangling links are
+    # files. A file with other hard links is added to `links` by name, as
+    # its (st_dev, st_ino).
+    try:
+        st = os.stat(path)
+    except (FileNotFoundError, NotADirectoryError):
+        try:
+            st = os.lstat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+    if S_ISDIR(st.st_mode):
+        return ("folder", st.st_size, st.st_mtime_ns)
+    if links is not None and st.st_nlink > 1:
+        links[os.path.basename(path)] = (st.st_dev, st.st_ino)
+    return ("file", st.st_size, st.st_mtime_ns)
+
+class _Inotify:
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.paths = {}  # watch descriptor -> directory
+
+    def add(self, path):
+        # None when the directory is gone or the watch limit is reached
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), _INOTIFY_MASK)
+        if wd < 0:
+            return None
+        self.paths[wd] = path
+        return wd
+
+    def remove(self, wd):
+        if self.paths.pop(wd, None) is not None:
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self):
+        # Blocks until events arrive; yields (wd, mask, name)
+        data = os.read(self.fd, 256 * 1024)
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = struct.unpack_from("iIII", data, offset)
+            name = data[offset + 16:offset + 16 + length].rstrip(b"\0")
+            offset += 16 + length
+            yield wd, mask, os.fsdecode(name)
+
+class _Listing:
+    __slots__ = ("entries", "links", "mtime_ns", "racy", "wd", "views")
+
+    def __init__(self, entries, links, mtime_ns, wd):
+        self.entries = entries  # name -> (type, size, mtime_ns)
+        self.links = links  # name -> (st_dev, st_ino) of files with other hard links
+        self.mtime_ns = mtime_ns
+        self.racy = time.time_ns() - mtime_ns < DRIVE_INDEX_RACY_NS
+        self.wd = wd
+        self.views = {}  # (sort, reverse) -> sorted entry tuples
+
+class DriveIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.dirs = {}      # normalized directory path -> _Listing
+        self.changes = {}   # directory path -> change counter, detects edits during a scan
+        self.totals = {}    # directory path -> _drive_totals tuple of its watched subtree
+        self.generation = 0  # bumped whenever totals are invalidated
+        self.inotify = None
+        self.pid = None
+
+    def start(self):
+        # Once per process: threads and the inotify descriptor do not survive fork
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.dirs.clear()
+            self.totals.clear()
+            self.inotify = None
+            if DRIVE_INDEX_WATCH:
+                try:
+                    self.inotify = _Inotify()
+                except (OSError, AttributeError):
+                    app.logger.warning("inotify unavailable; drive listings revalidate by directory mtime")
+        if self.inotify is not None:
+            threading.Thread(target=self._watch, name="drive-index-watch", daemon=True).start()
+        threading.Thread(target=self._warm, name="drive-index-warm", daemon=True).start()
+
+    def _listing(self, path):
+        # The current listing of `path`, or None if it is not a directory
+        if self.pid != os.getpid():
+            self.start()
+        path = os.path.normpath(path)
+        with self.lock:
+            listing = self.dirs.get(path)
+        if listing is None or listing.wd is None:
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
+            except (FileNotFoundError, NotADirectoryError):
+                self.forget(path)
+                return None
+            if listing is None or listing.racy or listing.mtime_ns != mtime_ns:
+                listing = self._scan(path)
+        return listing
+
+    def entries(self, path, sort="name", reverse=False):
+        # Sorted (name, type, size, mtime_ns) tuples, or None if `path` is not a directory
+        listing = self._listing(path)
+        if listing is None:
+            return None
+        with self.lock:
+            view = listing.views.get((sort, reverse))
+            if view is None:
+                view = sorted(((name,) + meta for name, meta in listing.entries.items()),
+                              key=_DRIVE_SORT_KEYS[sort], reverse=reverse)
+                listing.views[(sort, reverse)] = view
+        return view
+
+    def links(self, path):
+        # {name: (st_dev, st_ino)} of the files in `path` with other hard links
+        listing = self._listing(path)
+        if listing is None:
+            return {}
+        with self.lock:
+            return dict(listing.links)
+
+    def lookup(self, path):
+        # (type, size, mtime_ns) of one path, served from its parent's listing
+        path = os.path.normpath(path)
+        parent, name = os.path.split(path)
+        if not name or not _under(path, BASE_DIR) or path == os.path.normpath(BASE_DIR):
+            return _entry_stat(path)
+        if self.entries(parent) is None:
+            return None
+        with self.lock:
+            listing = self.dirs.get(parent)
+            return listing.entries.get(name) if listing is not None else _entry_stat(path)
+
+    def watched(self, path):
+        # True if the cached listing of `path` is kept current by inotify
+        with self.lock:
+            listing = self.dirs.get(os.path.normpath(path))
+            return listing is not None and listing.wd is not None
+
+    def cached_totals(self, path):
+        with self.lock:
+            return self.totals.get(path)
+
+    def remember_totals(self, path, totals, generation):
+        # Store subtree totals computed since `generation` was read, unless
+        # something changed in the meantime
+        with self.lock:
+            if self.generation == generation:
+                self.totals[path] = totals
+
+    def _invalidate_totals(self, path):
+        # Caller holds the lock: totals of `path` and every ancestor are stale
+        self.generation += 1
+        while True:
+            self.totals.pop(path, None)
+            parent = os.path.dirname(path)
+            if parent == path:
+                return
+            path = parent
+
+    def touch(self, path):
+        # Refresh `path` and its ancestors below BASE_DIR after a handler changed it
+        path = os.path.normpath(path)
+        root = os.path.normpath(BASE_DIR)
+        while _under(path, root) and path != root:
+            self._refresh(path)
+            path = os.path.dirname(path)
+
+    def forget(self, path):
+        # Drop cached listings at and below `path`
+        prefix = path.rstrip(os.sep) + os.sep
+        with self.lock:
+            self.changes[path] = self.changes.get(path, 0) + 1
+            self._invalidate_totals(path)
+            for key in [k for k in self.totals if k.startswith(prefix)]:
+                del self.totals[key]
+            for key in [k for k in self.dirs if k == path or k.startswith(prefix)]:
+                listing = self.dirs.pop(key)
+                self.changes[key] = self.changes.get(key, 0) + 1
+                if listing.wd is not None and self.inotify is not None:
+                    self.inotify.remove(listing.wd)
+
+    def _scan(self, path):
+        # The watch goes on before the scan so no change falls between the two
+        for _ in range(3):
+            with self.lock:
+                before = self.changes.get(path, 0)
+                wd = self.inotify.add(path) if self.inotify is not None else None
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
+                entries, links = {}, {}
+                with os.scandir(path) as it:
+                    for entry in it:
+                        meta = _entry_stat(entry.path, links)
+                        if meta is not None:
+                            entries[entry.name] = meta
+            except (FileNotFoundError, NotADirectoryError):
+                self.forget(path)
+                return None
+            with self.lock:
+                if self.changes.get(path, 0) == before:
+                    listing = _Listing(entries, links, mtime_ns, wd)
+                    self.dirs[path] = listing
+                    self._invalidate_totals(path)
+                    return listing
+        # Still changing under us: serve this scan without caching it
+        return _Listing(entries, links, mtime_ns, None)
+
+    def _refresh(self, path):
+        parent, name = os.path.split(path)
+        links = {}
+        meta = _entry_stat(path, links)
+        if meta is None or meta[0] != "folder":
+            self.forget(path)
+        with self.lock:
+            self.changes[parent] = self.changes.get(parent, 0) + 1
+            self._invalidate_totals(parent)
+            listing = self.dirs.get(parent)
+            if listing is None:
+                return
+            if meta is None:
+                listing.entries.pop(name, None)
+            else:
+                listing.entries[name] = meta
+            listing.links.pop(name, None)
+            listing.links.update(links)
+            listing.views = {}
+
+    def _warm(self):
+        pending = [os.path.normpath(BASE_DIR)]
+        scanned = 0
+        while pending and scanned < DRIVE_INDEX_WARM_DIRS:
+            path = pending.pop()
+            listing = self._scan(path)
+            scanned += 1
+            if listing is not None:
+                children = (os.path.join(path, name) for name, meta in listing.entries.items()
+                            if meta[0] == "folder" and not name.startswith("."))
+                # Symlinked folders may point back up the tree
+                pending.extend(child for child in children if not os.path.islink(child))
+
+    def _watch(self):
+        inotify = self.inotify
+        while True:
+            try:
+                events = list(inotify.read())
+            except OSError:
+                app.logger.exception("inotify read failed; drive index stops watching")
+                return
+            touched = set()
+            for wd, mask, name in events:
+                if mask & _IN_Q_OVERFLOW:
+                    # Events were lost: rescan everything on next use
+                    self.forget(os.sep)
+                    continue
+                directory = inotify.paths.get(wd)
+                if directory is None:
+                    continue
+                if mask & (_IN_DELETE_SELF | _IN_MOVE_SELF | _IN_IGNORED):
+                    self.forget(directory)
+                    continue
+                if name:
+                    touched.add(os.path.join(directory, name))
+                # A change inside a directory also changes its own mtime
+                touched.add(directory)
+            for path in touched:
+                try:
+                    self._refresh(path)
+                except Exception:
+                    app.logger.exception("Drive index refresh failed for %s", path)
+
+def _under(path, root):
+    return path == root or path.startswith(root.rstrip(os.sep) + os.sep)
+
+drive_index = DriveIndex()
+
+def _paging_args():
+    # (offset, limit, paged) from ?offset=&limit=&page_token=
+    paged = any(request.args.get(k) for k in ("offset", "limit", "page_token"))
+    offset = int(request.args.get("offset", 0))
+    if request.args.get("page_token"):
+        offset = _decode_page_token(request.args["page_token"])
+    limit = request.args.get("limit")
+    limit = int(limit) if limit else None
+    if offset < 0 or (limit is not None and limit < 1):
+        raise ValueError("offset must be >= 0 and limit >= 1")
+    return offset, limit, paged
+
+def _drive_listing(path):
+    # Listing response for a directory; None if it does not exist
+    sort = request.args.get("sort", "name")
+    order = request.args.get("order", "asc")
+    if sort not in _DRIVE_SORT_KEYS or order not in ("asc", "desc"):
+        raise ValueError(f"sort must be one of {', '.join(_DRIVE_SORT_KEYS)} and order asc or desc")
+    offset, limit, paged = _paging_args()
+
+    entries = drive_index.entries(path, sort, order == "desc")
+    if entries is None:
+        return None
+    if os.path.normpath(path) == os.path.normpath(BASE_DIR):
+        # The trash, upload and blob stores are internal, not drive content
+        entries = [e for e in entries if e[0] not in _DRIVE_INTERNAL_NAMES]
+    end = len(entries) if limit is None else min(len(entries), offset + limit)
+    items = [_drive_item(entry) for entry in entries[offset:end]]
+    if not paged:
+        return jsonify(items)
+    return jsonify({
+        "items": items,
+        "total": len(entries),
+        "next_page_token": _encode_page_token(end) if end < len(entries) else None,
+    })
+
+def _drive_item(entry):
+    name, kind, size, mtime_ns = entry
+    modified = datetime.datetime.fromtimestamp(mtime_ns / 1e9).isoformat()
+    return {"name": name, "type": kind, "size": size, "modified": modified}
+
+
+# --- Tree walks and disk usage -----------------------------------------------
+#
+# /drive/tree and /drive/du walk a directory level by level. Each level's
+# directories are listed in parallel on the drive pool through the drive
+# index, so a listing that is already cached costs no scandir at all.
+# Symlinked directories are listed but never descended into. /drive/du
+# also caches (size, files, folders) per directory. It does this only for
+# subtrees that inotify fully watches, because only then does every write
+# below a directory reach it. Any change to a listing drops the cached
+# totals of its directory and all ancestors, so a repeat du only walks
+# the parts of the tree that changed.
+#
+# Deduplicated files are hard links to one blob. So "size" counts each
+# (st_dev, st_ino) once, as du(1) does, and "logical_size" counts every
+# path. Totals carry the multiply-linked inodes of their subtree so a
+# parent can drop content its children share.
+
+def _drive_walk(root, max_depth=None, totals=None):
+    # {directory: entries} for `root` and folders below it, scanning down to
+    # `max_depth` levels. Folders whose subtree totals are cached are put
+    # into `totals` instead of being scanned, when `totals` is given.
+    root = os.path.normpath(root)
+    base = os.path.normpath(BASE_DIR)
+    listings = {}
+    frontier, depth = [root], 0
+    while frontier and (max_depth is None or depth < max_depth):
+        if totals is not None:
+            pending = []
+            for path in frontier:
+                cached = drive_index.cached_totals(path)
+                if cached is not None and path != root:
+                    totals[path] = cached
+                else:
+                    pending.append(path)
+            frontier = pending
+        if len(frontier) > 1:
+            scanned = _drive_pool().map(drive_index.entries, frontier)
+        else:
+            scanned = map(drive_index.entries, frontier)
+        next_level = []
+        for path, entries in zip(frontier, scanned):
+            if entries is None:
+                continue
+            listings[path] = entries
+            for name, kind, _, _ in entries:
+                if kind != "folder" or (path == base and name in _DRIVE_INTERNAL_NAMES):
+                    continue
+                child = os.path.join(path, name)
+                if not os.path.islink(child):
+                    next_level.append(child)
+        frontier, depth = next_level, depth + 1
+    return listings
+
+def _drive_totals(root):
+    # {directory: (size, files, folders, disk_size, shared)} for `root` and
+    # the folders walked below it, or None if `root` is not a directory.
+    # `shared` maps each multiply-linked inode below to its size.
+    root = os.path.normpath(root)
+    base = os.path.normpath(BASE_DIR)
+    cached = drive_index.cached_totals(root)
+    if cached is not None:
+        return {root: cached}
+    generation = drive_index.generation
+    totals = {}
+    listings = _drive_walk(root, totals=totals)
+    if root not in listings:
+        return None
+    complete = {}  # directory -> whether its whole subtree is watched
+    for path in sorted(listings, key=lambda p: p.count(os.sep), reverse=True):
+        size = files = folders = disk = 0
+        shared = {}
+        links = drive_index.links(path)
+        watched = drive_index.watched(path)
+        for name, kind, entry_size, _ in listings[path]:
+            if kind != "folder":
+                size += entry_size
+                files += 1
+                inode = links.get(name)
+                if inode not in shared:
+                    disk += entry_size
+                    if inode is not None:
+                        shared[inode] = entry_size
+                continue
+            if path == base and name in _DRIVE_INTERNAL_NAMES:
+                continue
+            child = os.path.join(path, name)
+            folders += 1
+            if child in totals:
+                child_size, child_files, child_folders, child_disk, child_shared = totals[child]
+                size += child_size
+                files += child_files
+                folders += child_folders
+                disk += child_disk
+                for inode, inode_size in child_shared.items():
+                    if inode in shared:
+                        disk -= inode_size
+                    else:
+                        shared[inode] = inode_size
+                watched = watched and complete.get(child, True)
+        totals[path] = (size, files, folders, disk, shared)
+        complete[path] = watched
+        if watched:
+            drive_index.remember_totals(path, totals[path], generation)
+    return totals
+
+def _drive_usage(path, depth, totals=None):
+    # du response for `path`, with per-child usage `depth` levels down
+    if totals is None or path not in totals:
+        totals = _drive_totals(path)
+        if totals is None:
+            return None
+    size, files, folders, disk, _ = totals[path]
+    usage = {"path": os.path.relpath(path, BASE_DIR), "size": disk, "logical_size": size,
+             "files": files, "folders": folders}
+    if depth > 0:
+        children = []
+        for name, kind, entry_size, _ in drive_index.entries(path) or []:
+            child = os.path.join(path, name)
+            if path == os.path.normpath(BASE_DIR) and name in _DRIVE_INTERNAL_NAMES:
+                continue
+            if kind == "folder" and not os.path.islink(child):
+                child_usage = _drive_usage(child, depth - 1, totals)
+                if child_usage is not None:
+                    children.append(child_usage)
+            else:
+                children.append({"path": os.path.relpath(child, BASE_DIR), "size": entry_size,
+                                 "logical_size": entry_size, "files": 1, "folders": 0})
+        usage["children"] = sorted(children, key=lambda c: c["size"], reverse=True)
+    return usage
+
+@app.route("/drive/tree", methods=["GET"])
+def drive_tree():
+    root = os.path.normpath(os.path.join(BASE_DIR, request.args.get("subpath", "")))
+    pattern = request.args.get("pattern")
+    kind_filter = request.args.get("type")
+    try:
+        max_depth = request.args.get("max_depth")
+        max_depth = int(max_depth) if max_depth else None
+        if max_depth is not None and max_depth < 1:
+            raise ValueError("max_depth must be >= 1")
+        if kind_filter not in (None, "file", "folder"):
+            raise ValueError("type must be file or folder")
+        offset, limit, paged = _paging_args()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    listings = _drive_walk(root, max_depth)
+    if root not in listings:
+        return jsonify({"error": "Path not found"}), 404
+    base = os.path.normpath(BASE_DIR)
+    matches = []
+    for directory, entries in listings.items():
+        prefix = os.path.relpath(directory, root)
+        for entry in entries:
+            name, kind = entry[0], entry[1]
+            if directory == base and name in _DRIVE_INTERNAL_NAMES:
+                continue
+            rel = name if prefix == "." else os.path.join(prefix, name)
+            if kind_filter and kind != kind_filter:
+                continue
+            if pattern and not fnmatch.fnmatchcase(rel, pattern):
+                continue
+            matches.append((rel, entry))
+    matches.sort(key=lambda m: m[0].split(os.sep))
+
+    end = len(matches) if limit is None else min(len(matches), offset + limit)
+    items = []
+    for rel, entry in matches[offset:end]:
+        item = _drive_item(entry)
+        item.update({"path": rel, "depth": rel.count(os.sep) + 1})
+        items.append(item)
+    if not paged:
+        return jsonify(items)
+    return jsonify({
+        "items": items,
+        "total": len(matches),
+        "next_page_token": _encode_page_token(end) if end < len(matches) else None,
+    })
+
+@app.route("/drive/du", methods=["GET"])
+def drive_du():
+    path = os.path.normpath(os.path.join(BASE_DIR, request.args.get("path", "")))
+    try:
+        depth = int(request.args.get("depth", 0))
+    except ValueError:
+        return jsonify({"error": "depth must be an integer"}), 400
+    if not os.path.isdir(path):
+        meta = _entry_stat(path)
+        if meta is None:
+            return jsonify({"error": "Path not found"}), 404
+        return jsonify({"path": os.path.relpath(path, BASE_DIR), "size": meta[1], "logical_size": meta[1],
+                        "files": 1, "folders": 0})
+    return jsonify(_drive_usage(path, depth))
+
+# --- Partial file reads ------------------------------------------------------
+#
+# read-file and docs/read can return a window of a file instead of all of
+# it: a byte window (offset/length, or an HTTP Range header answered with
+# 206) or a line window (start_line/num_lines). Windows are sliced from a
+# read-only mmap, so a read costs the bytes returned. Byte windows are
+# widened or narrowed to UTF-8 character boundaries, and the bytes actually
+# returned are reported back.
+#
+# Line windows use a sparse line index: the number of newlines before each
+# LINE_INDEX_BLOCK-byte block. A line is found by bisecting the blocks and
+# scanning inside one. The index is built lazily, only as far as the lines
+# asked for, and is kept per file until the file's signature changes.
+
+LINE_INDEX_BLOCK = 64 * 1024
+LINE_INDEX_FILES = 64
+
+_RANGE_HEADER = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+class _LineIndex:
+    def __init__(self, signature):
+        self.signature = signature
+        self.counts = array("q", [0])  # newlines before block i
+
+    def line_start(self, mm, line):
+        # Byte offset where 0-based `line` starts (the file size if past the end)
+        if line <= 0:
+            return 0
+        size = len(mm)
+        while self.counts[-1] < line and (len(self.counts) - 1) * LINE_INDEX_BLOCK < size:
+            start = (len(self.counts) - 1) * LINE_INDEX_BLOCK
+            self.counts.append(self.counts[-1] + mm[start:start + LINE_INDEX_BLOCK].count(b"\n"))
+        block = bisect.bisect_left(self.counts, line) - 1
+        if block + 1 >= len(self.counts):
+            return size
+        pos = block * LINE_INDEX_BLOCK - 1
+        for _ in range(line - self.counts[block]):
+            pos = mm.find(b"\n", pos + 1)
+        return pos + 1
+
+_line_indexes = OrderedDict()
+_line_indexes_lock = threading.Lock()
+
+def _line_index(path):
+    signature = _file_signature(path)
+    with _line_indexes_lock:
+        index = _line_indexes.get(path)
+        if index is None or index.signature != signature:
+            index = _line_indexes[path] = _LineIndex(signature)
+        _line_indexes.move_to_end(path)
+        while len(_line_indexes) > LINE_INDEX_FILES:
+            _line_indexes.popitem(last=False)
+    return index
+
+def _char_boundary(mm, pos):
+    # Move `pos` back to the start of the UTF-8 character it falls in
+    while 0 < pos < len(mm) and mm[pos] & 0xC0 == 0x80:
+        pos -= 1
+    return pos
+
+def _partial_request():
+    # ("bytes", start, stop), ("suffix", n), ("lines", start, count) or None
+    # for a full read. `stop` is exclusive and may be None.
+    args = request.args
+    if args.get("start_line") is not None or args.get("num_lines") is not None:
+        start = int(args.get("start_line", 0))
+        count = args.get("num_lines")
+        count = int(count) if count else None
+        if start < 0 or (count is not None and count < 1):
+            raise ValueError("start_line must be >= 0 and num_lines >= 1")
+        return ("lines", start, count)
+    if args.get("offset") is not None or args.get("length") is not None:
+        start = int(args.get("offset", 0))
+        length = args.get("length")
+        length = int(length) if length else None
+        if start < 0 or (length is not None and length < 1):
+            raise ValueError("offset must be >= 0 and length >= 1")
+        return ("bytes", start, None if length is None else start + length)
+    match = _RANGE_HEADER.match(request.headers.get("Range", "").strip())
+    if match and (match.group(1) or match.group(2)):
+        first, last = match.groups()
+        if not first:
+            return ("suffix", int(last))
+        if not last or int(last) >= int(first):
+            return ("range", int(first), int(last) + 1 if last else None)
+    # Malformed or multi-range headers are ignored, as RFC 9110 allows
+    return None
+
+def _partial_read(path, window):
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if window[0] == "range" and window[1] >= size or window[0] == "suffix" and (window[1] == 0 or size == 0):
+            response = jsonify({"error": "Requested range not satisfiable"})
+            response.status_code = 416
+            response.headers["Content-Range"] = f"bytes */{size}"
+            return response
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        try:
+            body = {}
+            if window[0] == "lines":
+                index = _line_index(path)
+                start = index.line_start(mm, window[1])
+                stop = size if window[2] is None else index.line_start(mm, window[1] + window[2])
+                lines = mm[start:stop].count(b"\n") + (1 if stop > start and mm[stop - 1:stop] != b"\n" else 0)
+                body.update({"start_line": window[1], "num_lines": lines})
+            else:
+                start, stop = (max(0, size - window[1]), size) if window[0] == "suffix" else window[1:]
+                start = _char_boundary(mm, min(start, size))
+                stop = size if stop is None else _char_boundary(mm, max(start, min(stop, size)))
+            content = mm[start:stop].decode("utf-8", errors="replace")
+        finally:
+            if size:
+                mm.close()
+    content = content.replace("\r\n", "\n").replace("\r", "\n")
+    body.update({"content": content, "offset": start, "length": stop - start, "size": size})
+    response = jsonify(body)
+    if window[0] in ("range", "suffix"):
+        response.status_code = 206
+        response.headers["Content-Range"] = f"bytes {start}-{max(start, stop) - 1}/{size}"
+    response.headers["Accept-Ranges"] = "bytes"
+    return response
+
+def _read_text_file(path):
+    # Full, streamed or partial read for read-file and docs/read
+    try:
+        window = _partial_request()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if window is not None:
+        return _partial_read(path, window)
+    mode = _stream_mode()
+    if mode:
+        return _stream_text_file(mode, path)
+    with open(path, "r", encoding="utf-8") as f:
+        response = jsonify({"content": f.read()})
+    response.headers["Accept-Ranges"] = "bytes"
+    return response
 
 @app.route("/openapi.json")
 def openapi():
@@ -30,23 +788,25 @@ def openapi():
 
 @app.route("/drive/list", methods=["GET"])
 def drive_list():
-    items = []
-    for item in os.listdir(BASE_DIR):
-        path = os.path.join(BASE_DIR, item)
-        items.append({"name": item, "type": "folder" if os.path.isdir(path) else "file"})
-    return jsonify(items)
+    try:
+        response = _drive_listing(BASE_DIR)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if response is None:
+        return jsonify({"error": "Path not found"}), 404
+    return response
 
 @app.route("/drive/list-path", methods=["GET"])
 def drive_list_path():
     subpath = request.args.get("subpath")
     path = os.path.join(BASE_DIR, subpath)
-    if not os.path.exists(path):
+    try:
+        response = _drive_listing(path)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if response is None:
         return jsonify({"error": "Path not found"}), 404
-    items = []
-    for item in os.listdir(path):
-        full_path = os.path.join(path, item)
-        items.append({"name": item, "type": "folder" if os.path.isdir(full_path) else "file"})
-    return jsonify(items)
+    return response
 
 @app.route("/drive/read-file", methods=["GET"])
 def drive_read_file():
@@ -54,104 +814,2608 @@ def drive_read_file():
     path = os.path.join(BASE_DIR, filename)
     if not os.path.exists(path):
         return jsonify({"error": "File not found"}), 404
-    with open(path, "r", encoding="utf-8") as f:
-        return jsonify({"content": f.read()})
+    return _read_text_file(path)
 
 @app.route("/drive/write-file", methods=["POST"])
 def drive_write_file():
-    data = request.json
-    filename = os.path.join(BASE_DIR, data["filename"])
-    content = data["content"]
-    os.makedirs(os.path.dirname(filename), exist_ok=True)
-    with open(filename, "w", encoding="utf-8") as f:
-        f.write(content)
+    # JSON {"filename", "content"[, "encoding": "base64"]}, or a raw body
+    # with ?filename=; either way the file is replaced atomically
+    digest = None
+    if request.is_json:
+        data = request.json
+        filename = os.path.join(BASE_DIR, data["filename"])
+        content = data["content"]
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        if data.get("encoding") == "base64":
+            try:
+                content = base64.b64decode(content, validate=True)
+            except ValueError:
+                return jsonify({"error": "content is not valid base64"}), 400
+            digest = hashlib.sha256(content).hexdigest()
+            with _atomic_write(filename, "wb") as f:
+                f.write(content)
+        else:
+            with _atomic_write(filename, "w", encoding="utf-8") as f:
+                f.write(content)
+    else:
+        if not request.args.get("filename"):
+            return jsonify({"error": "filename parameter required"}), 400
+        filename = os.path.join(BASE_DIR, request.args["filename"])
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        digest = hashlib.sha256()
+        with _atomic_write(filename, "wb") as f:
+            _copy_body(f, digest)
+        digest = digest.hexdigest()
+    _intern(filename, digest)
+    drive_index.touch(filename)
+    search_index.refresh(filename)
     return jsonify({"success": True})
 
+def _drive_create_folder(folder_path):
+    # Returns the directories it had to create, outermost first
+    created = []
+    head = os.path.normpath(folder_path)
+    while not os.path.isdir(head) and head != os.path.dirname(head):
+        created.append(head)
+        head = os.path.dirname(head)
+    os.makedirs(folder_path, exist_ok=True)
+    drive_index.touch(folder_path)
+    return created[::-1]
+
 @app.route("/drive/create-folder", methods=["POST"])
 def drive_create_folder():
     data = request.json
-    folder_path = os.path.join(BASE_DIR, data["folder_path"])
-    os.makedirs(folder_path, exist_ok=True)
+    _drive_create_folder(os.path.join(BASE_DIR, data["folder_path"]))
     return jsonify({"success": True})
 
+def _drive_move(src, dst):
+    # Returns where `src` ended up (inside `dst` if that is a directory)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    moved = shutil.move(src, dst)
+    drive_index.touch(src)
+    drive_index.touch(moved)
+    search_index.refresh(src)
+    search_index.refresh(moved)
+    return moved
+
 @app.route("/drive/move-file", methods=["POST"])
 def drive_move_file():
     data = request.json
-    src = os.path.join(BASE_DIR, data["src"])
-    dst = os.path.join(BASE_DIR, data["dst"])
-    os.makedirs(os.path.dirname(dst), exist_ok=True)
-    shutil.move(src, dst)
+    _drive_move(os.path.join(BASE_DIR, data["src"]), os.path.join(BASE_DIR, data["dst"]))
     return jsonify({"success": True})
 
+def _deletable(path):
+    path = os.path.normpath(path)
+    return path != os.path.normpath(BASE_DIR) and not _under(path, os.path.normpath(TRASH_DIR))
+
+def _drive_delete(path):
+    # Returns the trash entry's metadata
+    meta = _move_to_trash(os.path.normpath(path))
+    drive_index.touch(path)
+    search_index.refresh(path)
+    return meta
+
 @app.route("/drive/delete-file", methods=["DELETE"])
 def drive_delete_file():
     path = os.path.join(BASE_DIR, request.args.get("path"))
     if not os.path.exists(path):
         return jsonify({"error": "Path not found"}), 404
-    os.makedirs(TRASH_DIR, exist_ok=True)
-    trash_path = os.path.join(TRASH_DIR, os.path.basename(path))
-    shutil.move(path, trash_path)
-    return jsonify({"success": True})
+    path = os.path.normpath(path)
+    if not _deletable(path):
+        return jsonify({"error": "Cannot delete this path; use /drive/trash to manage trashed items"}), 400
+    meta = _drive_delete(path)
+    return jsonify({"success": True, "trash_id": meta["id"]})
 
 @app.route("/drive/get_metadata", methods=["GET"])
 def drive_get_metadata():
     path = os.path.join(BASE_DIR, request.args.get("path"))
-    if not os.path.exists(path):
+    meta = drive_index.lookup(path)
+    if meta is None:
         return jsonify({"error": "Path not found"}), 404
-    stat = os.stat(path)
+    kind, size, mtime_ns = meta
     return jsonify({
         "path": path,
-        "size": stat.st_size,
-        "modified": datetime.datetime.fromtimestamp(stat.st_mtime).isoformat(),
-        "type": "folder" if os.path.isdir(path) else "file"
+        "size": size,
+        "modified": datetime.datetime.fromtimestamp(mtime_ns / 1e9).isoformat(),
+        "type": kind
+    })
+
+# --- Trash -------------------------------------------------------------------
+#
+# A deleted path is renamed (not copied) into an entry of its own,
+# TRASH_DIR/<id>/<name>, next to a .meta.json recording where it came from.
+# Ids start with the deletion time in hex, so sorting ids sorts entries by
+# age and listing a page of the trash reads only that page's metadata.
+# Restoring is a rename back. A sweeper purges entries older than
+# TRASH_MAX_AGE_SECONDS, then the oldest ones while the trash holds more
+# than TRASH_MAX_BYTES. Each round removes at most TRASH_SWEEP_BATCH
+# entries and only one worker sweeps at a time, so a large backlog is
+# worked off in short steps. Purged content shared with live files stays
+# in the blob store; the blob sweep frees the rest.
+
+TRASH_MAX_AGE_SECONDS = int(os.getenv("TRASH_MAX_AGE_SECONDS", 30 * 24 * 3600))
+TRASH_MAX_BYTES = int(os.getenv("TRASH_MAX_BYTES", 10 * 1024 ** 3))
+TRASH_SWEEP_SECONDS = int(os.getenv("TRASH_SWEEP_SECONDS", 300))
+TRASH_SWEEP_BATCH = int(os.getenv("TRASH_SWEEP_BATCH", 100))
+
+_TRASH_ID = re.compile(r"^[0-9a-f]{24}$")
+
+def _tree_size(path):
+    if os.path.islink(path) or not os.path.isdir(path):
+        return os.lstat(path).st_size
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+def _trash_ids(newest_first=False):
+    try:
+        names = os.listdir(TRASH_DIR)
+    except FileNotFoundError:
+        return []
+    return sorted((n for n in names if _TRASH_ID.match(n)), reverse=newest_first)
+
+def _trash_meta(entry_id):
+    # Metadata of a trash entry; None if it is unknown or half-written
+    if not _TRASH_ID.match(entry_id or ""):
+        return None
+    try:
+        with open(os.path.join(TRASH_DIR, entry_id, ".meta.json"), encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, NotADirectoryError, ValueError):
+        return None
+
+def _trash_entry(path, original, deleted_ns):
+    # Move `path` into a new trash entry; `original` is its drive-relative path
+    entry_id = f"{deleted_ns:016x}{os.urandom(4).hex()}"
+    entry_dir = os.path.join(TRASH_DIR, entry_id)
+    os.makedirs(entry_dir)
+    meta = {
+        "id": entry_id,
+        "path": original,
+        "name": os.path.basename(path),
+        "type": "folder" if os.path.isdir(path) and not os.path.islink(path) else "file",
+        "size": _tree_size(path),
+        "deleted_at": datetime.datetime.fromtimestamp(deleted_ns / 1e9).isoformat(),
+    }
+    # Metadata first: an entry without its item is dropped by the sweeper,
+    # while an item without metadata could never be listed or restored
+    with _atomic_write(os.path.join(entry_dir, ".meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    shutil.move(path, os.path.join(entry_dir, meta["name"]))
+    return meta
+
+def _move_to_trash(path):
+    meta = _trash_entry(path, os.path.relpath(path, BASE_DIR), time.time_ns())
+    _start_trash_sweeper()
+    return meta
+
+def _purge_trash(entry_id):
+    # Remove an entry; returns its metadata, or None if it was already gone
+    meta = _trash_meta(entry_id) or {"id": entry_id, "size": 0}
+    entry_dir = os.path.join(TRASH_DIR, entry_id)
+    # Rename first so a concurrent restore or purge sees the entry as gone
+    doomed = os.path.join(TRASH_DIR, f".purge.{entry_id}.{os.getpid()}.{threading.get_ident()}")
+    try:
+        os.rename(entry_dir, doomed)
+    except FileNotFoundError:
+        return None
+    shutil.rmtree(doomed, ignore_errors=True)
+    return meta
+
+def _adopt_legacy_trash():
+    # Items trashed before entries existed become entries of their own
+    try:
+        names = os.listdir(TRASH_DIR)
+    except FileNotFoundError:
+        return
+    for name in names:
+        if name.startswith(".") or _TRASH_ID.match(name):
+            continue
+        path = os.path.join(TRASH_DIR, name)
+        try:
+            _trash_entry(path, name, os.lstat(path).st_mtime_ns)
+        except (FileNotFoundError, FileExistsError):
+            pass
+
+def _sweep_trash():
+    # One bounded round; returns the number of entries purged
+    os.makedirs(TRASH_DIR, exist_ok=True)
+    with open(os.path.join(TRASH_DIR, ".sweep.lock"), "a") as lock:
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return 0  # another worker is sweeping
+        _adopt_legacy_trash()
+        ids = _trash_ids()
+        now_ns = time.time_ns()
+        sizes = {}
+        for entry_id in ids:
+            meta = _trash_meta(entry_id)
+            if meta is not None and os.path.lexists(os.path.join(TRASH_DIR, entry_id, meta["name"])):
+                sizes[entry_id] = meta["size"]
+            elif now_ns - int(entry_id[:16], 16) > 60 * 1_000_000_000:
+                sizes[entry_id] = None  # broken, not just being written
+        ids = [entry_id for entry_id in ids if entry_id in sizes]
+        total = sum(size for size in sizes.values() if size)
+        cutoff_ns = now_ns - TRASH_MAX_AGE_SECONDS * 1_000_000_000
+        purged = 0
+        for entry_id in ids:  # oldest first
+            if purged >= TRASH_SWEEP_BATCH:
+                break
+            expired = int(entry_id[:16], 16) < cutoff_ns
+            if sizes[entry_id] is not None and not expired and total <= TRASH_MAX_BYTES:
+                continue
+            if _purge_trash(entry_id) is not None:
+                purged += 1
+                total -= sizes[entry_id] or 0
+        return purged
+
+_trash_guard = threading.Lock()
+_trash_thread = None
+
+def _trash_sweeper():
+    while True:
+        try:
+            purged = _sweep_trash()
+        except Exception:
+            app.logger.exception("Trash sweep failed")
+            purged = 0
+        # A full batch means there is more to purge: go on after a short pause
+        time.sleep(1 if purged >= TRASH_SWEEP_BATCH else TRASH_SWEEP_SECONDS)
+
+def _start_trash_sweeper():
+    global _trash_thread
+    with _trash_guard:
+        if _trash_thread is None:
+            _trash_thread = threading.Thread(target=_trash_sweeper, name="trash-sweeper", daemon=True)
+            _trash_thread.start()
+
+@app.route("/drive/trash", methods=["GET"])
+def drive_trash_list():
+    # Newest first, paged like /drive/list
+    try:
+        offset, limit, paged = _paging_args()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    ids = _trash_ids(newest_first=True)
+    end = len(ids) if limit is None else min(len(ids), offset + limit)
+    items = [meta for meta in map(_trash_meta, ids[offset:end]) if meta is not None]
+    if not paged:
+        return jsonify(items)
+    return jsonify({
+        "items": items,
+        "total": len(ids),
+        "next_page_token": _encode_page_token(end) if end < len(ids) else None,
     })
 
+def _restore_trash(meta, dst):
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    os.rename(os.path.join(TRASH_DIR, meta["id"], meta["name"]), dst)
+    _purge_trash(meta["id"])
+    drive_index.touch(dst)
+    search_index.refresh(dst)
+
+@app.route("/drive/trash/restore", methods=["POST"])
+def drive_trash_restore():
+    data = request.json
+    meta = _trash_meta(data.get("id"))
+    if meta is None:
+        return jsonify({"error": "Trash entry not found"}), 404
+    dst = os.path.normpath(os.path.join(BASE_DIR, data.get("dst") or meta["path"]))
+    if not _deletable(dst) or not _under(dst, os.path.normpath(BASE_DIR)):
+        return jsonify({"error": "dst must be a path inside the drive, outside the trash"}), 400
+    if os.path.lexists(dst):
+        return jsonify({"error": "Destination exists"}), 409
+    try:
+        _restore_trash(meta, dst)
+    except FileNotFoundError:
+        return jsonify({"error": "Trash entry not found"}), 404
+    return jsonify({"success": True, "path": os.path.relpath(dst, BASE_DIR)})
+
+@app.route("/drive/trash/<entry_id>", methods=["DELETE"])
+def drive_trash_purge(entry_id):
+    meta = _purge_trash(entry_id) if _TRASH_ID.match(entry_id) else None
+    if meta is None:
+        return jsonify({"error": "Trash entry not found"}), 404
+    return jsonify({"success": True, "freed_bytes": meta["size"]})
+
+@app.route("/drive/trash/empty", methods=["POST"])
+def drive_trash_empty():
+    purged = freed = 0
+    for entry_id in _trash_ids():
+        meta = _purge_trash(entry_id)
+        if meta is not None:
+            purged += 1
+            freed += meta["size"]
+    return jsonify({"purged": purged, "freed_bytes": freed})
+
+# --- Content-addressed blobs -------------------------------------------------
+#
+# Files written through the drive, and new sheets, are deduplicated by
+# content. Each distinct content is stored once as <root>/.blobs/aa/<sha256>,
+# and every path holding it is a hard link to that blob. Copies are new
+# links and trash is a rename, so neither copies data. A shared file must
+# never be written in place: writers replace files atomically, and
+# in-place appenders call _unshare() first. Linked paths share one inode,
+# so they also share size and mtime. Nothing touches a shared inode, so its
+# (mtime, size, inode) signature only changes when a path is replaced, and
+# linking a new path to a blob leaves the other holders' versions alone.
+# Dot-files are sidecars (locks, delta logs) written in place; copies get
+# their own inode.
+# A blob whose only remaining link is the store itself is garbage. A
+# sweep removes such blobs every BLOB_GC_SECONDS, or on POST /drive/gc.
+
+BLOB_MIN_BYTES = int(os.getenv("BLOB_MIN_BYTES", 4096))  # smaller files are not worth a link
+BLOB_GC_SECONDS = int(os.getenv("BLOB_GC_SECONDS", 3600))
+
+def _blobs_dir(path):
+    path = os.path.normpath(path)
+    for root in (BASE_DIR, str(SHEETS_DIR)):
+        if _under(path, os.path.normpath(root)):
+            return os.path.join(root, ".blobs")
+    return None
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _link_into_place(src, dst):
+    # Atomically make `dst` another link to `src`
+    head, tail = os.path.split(dst)
+    tmp = os.path.join(head, f".{tail}.{os.getpid()}.{threading.get_ident()}.link")
+    os.link(src, tmp)
+    os.replace(tmp, dst)
+
+def _intern(path, digest=None):
+    # Swap `path` for a link to the blob holding its content, storing the
+    # content as a new blob if there is none yet
+    blobs = _blobs_dir(path)
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return
+    if blobs is None or st.st_size < BLOB_MIN_BYTES or st.st_nlink > 1:
+        return
+    digest = digest or _file_digest(path)
+    blob = os.path.join(blobs, digest[:2], digest)
+    os.makedirs(os.path.dirname(blob), exist_ok=True)
+    _start_blob_gc()
+    try:
+        os.link(path, blob)
+        return
+    except FileExistsError:
+        pass
+    except OSError:
+        return  # e.g. the filesystem has no hard links; keep the plain file
+    try:
+        _link_into_place(blob, path)
+    except OSError:
+        pass  # the blob was swept in between; the plain file stays
+
+def _unshare(path):
+    # Give `path` its own inode before it is written in place
+    try:
+        if os.stat(path).st_nlink < 2:
+            return
+    except FileNotFoundError:
+        return
+    with open(path, "rb") as src, _atomic_write(path, "wb") as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+
+def _link_copy(src, dst):
+    # O(1) copy of a file, or of a tree one link per file
+    if not os.path.isdir(src):
+        if os.path.basename(src).startswith("."):
+            shutil.copy2(src, dst)
+            return
+        try:
+            _link_into_place(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+        return
+    os.makedirs(dst, exist_ok=True)
+    with os.scandir(src) as it:
+        for entry in it:
+            _link_copy(entry.path, os.path.join(dst, entry.name))
+
+def _sweep_blobs():
+    removed = freed = 0
+    for root in (BASE_DIR, str(SHEETS_DIR)):
+        blobs = os.path.join(root, ".blobs")
+        if not os.path.isdir(blobs):
+            continue
+        for shard in os.scandir(blobs):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                try:
+                    st = entry.stat()
+                    if st.st_nlink == 1:
+                        os.remove(entry.path)
+                        removed += 1
+                        freed += st.st_size
+                except FileNotFoundError:
+                    pass
+    return removed, freed
+
+_blob_gc_guard = threading.Lock()
+_blob_gc_thread = None
+
+def _blob_gc_worker():
+    while True:
+        time.sleep(BLOB_GC_SECONDS)
+        try:
+            _sweep_blobs()
+        except Exception:
+            app.logger.exception("Blob sweep failed")
+
+def _start_blob_gc():
+    global _blob_gc_thread
+    with _blob_gc_guard:
+        if _blob_gc_thread is None:
+            _blob_gc_thread = threading.Thread(target=_blob_gc_worker, name="blob-gc", daemon=True)
+            _blob_gc_thread.start()
+
+def _drive_copy(src, dst):
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    _link_copy(src, dst)
+    # The source's files gained links, which no directory event reports
+    if os.path.isdir(src):
+        drive_index.forget(src)
+    else:
+        drive_index.touch(src)
+    drive_index.touch(dst)
+    search_index.refresh(dst)
+
+@app.route("/drive/copy", methods=["POST"])
+def drive_copy():
+    data = request.json
+    src = os.path.join(BASE_DIR, data["src"])
+    dst = os.path.join(BASE_DIR, data["dst"])
+    if not os.path.exists(src):
+        return jsonify({"error": "Path not found"}), 404
+    if os.path.isdir(src) and os.path.exists(dst):
+        return jsonify({"error": "Destination exists"}), 409
+    _drive_copy(src, dst)
+    return jsonify({"success": True})
+
+@app.route("/drive/gc", methods=["POST"])
+def drive_gc():
+    removed, freed = _sweep_blobs()
+    return jsonify({"removed_blobs": removed, "freed_bytes": freed})
+
+# --- Batch drive operations --------------------------------------------------
+#
+# POST /drive/batch runs many create_folder / move / copy / delete
+# operations in one request. The whole list is validated before anything
+# runs, against the drive as the earlier operations will have left it, and
+# any invalid operation rejects the batch. Operations are then grouped into
+# waves: an operation joins the wave after the last earlier operation whose
+# paths overlap its own (same path, or one inside the other). Each wave
+# runs on a pool of DRIVE_BATCH_WORKERS threads, so independent operations
+# proceed in parallel while dependent ones keep their order. With
+# "atomic": true, a failure stops the batch and every completed operation is
+# undone in reverse. Deletes go to the trash, so they can be undone too.
+
+DRIVE_BATCH_WORKERS = int(os.getenv("DRIVE_BATCH_WORKERS", 8))
+DRIVE_BATCH_MAX_OPS = int(os.getenv("DRIVE_BATCH_MAX_OPS", 10000))
+
+_DRIVE_BATCH_FIELDS = {
+    "create_folder": ("folder_path",),
+    "move": ("src", "dst"),
+    "copy": ("src", "dst"),
+    "delete": ("path",),
+}
+
+_drive_batch_pool = None
+_drive_batch_pool_guard = threading.Lock()
+
+def _drive_pool():
+    global _drive_batch_pool
+    with _drive_batch_pool_guard:
+        if _drive_batch_pool is None:
+            _drive_batch_pool = ThreadPoolExecutor(max_workers=DRIVE_BATCH_WORKERS, thread_name_prefix="drive-batch")
+        return _drive_batch_pool
+
+def _drive_ancestors(path):
+    # `path` and its parents, up to but not including the drive root
+    root = os.path.normpath(BASE_DIR)
+    while path != root and _under(path, root):
+        yield path
+        path = os.path.dirname(path)
+
+class _BatchPlan:
+    # What the drive will look like after the operations validated so far,
+    # as the paths they create or remove. The contents of a path created by
+    # the batch are not tracked: exists() returns None below one.
+    def __init__(self):
+        self.seq = 0
+        self.state = {}
+
+    def exists(self, path):
+        latest = None
+        for p in _drive_ancestors(path):
+            if p in self.state and (latest is None or self.state[p][0] > self.state[latest][0]):
+                latest = p
+        if latest is None:
+            return os.path.lexists(path)
+        if latest != path and self.state[latest][1]:
+            return None
+        return self.state[latest][1]
+
+    def isdir(self, path):
+        return os.path.isdir(path) if path not in self.state else self.state[path][2]
+
+    def mark(self, path, exists, isdir=False):
+        self.seq += 1
+        self.state[path] = (self.seq, exists, isdir)
+
+def _validate_drive_op(op, plan, atomic):
+    # Normalized (kind, paths) for one operation; raises ValueError
+    if not isinstance(op, dict) or op.get("op") not in _DRIVE_BATCH_FIELDS:
+        raise ValueError(f"op must be one of {', '.join(_DRIVE_BATCH_FIELDS)}")
+    kind = op["op"]
+    paths = []
+    for field in _DRIVE_BATCH_FIELDS[kind]:
+        if not isinstance(op.get(field), str) or not op[field]:
+            raise ValueError(f"{field} is required")
+        path = os.path.normpath(os.path.join(BASE_DIR, op[field]))
+        if not _deletable(path) or not _under(path, os.path.normpath(BASE_DIR)):
+            raise ValueError(f"{field} must be a path inside the drive, outside the trash")
+        paths.append(path)
+
+    if kind == "create_folder":
+        plan.mark(paths[0], True, True)
+    elif kind == "delete":
+        if plan.exists(paths[0]) is False:
+            raise ValueError("Path not found")
+        plan.mark(paths[0], False)
+    else:
+        src, dst = paths
+        if plan.exists(src) is False:
+            raise ValueError("Path not found")
+        if _under(dst, src):
+            raise ValueError("Cannot move or copy a folder into itself")
+        if plan.exists(dst) and (atomic or (kind == "copy" and plan.isdir(src))):
+            # Overwritten content could not be put back on rollback
+            raise ValueError("Destination exists")
+        isdir = plan.isdir(src)
+        if kind == "move":
+            plan.mark(src, False)
+        plan.mark(dst, True, isdir)
+    return kind, paths
+
+def _drive_waves(paths_per_op):
+    # Wave number of each operation (see above); O(operations x path depth)
+    exact, below, waves = {}, {}, []
+    for paths in paths_per_op:
+        wave = 0
+        for path in paths:
+            for p in _drive_ancestors(path):
+                wave = max(wave, exact.get(p, -1) + 1)
+            wave = max(wave, below.get(path, -1) + 1)
+        for path in paths:
+            exact[path] = max(exact.get(path, -1), wave)
+            for p in _drive_ancestors(path):
+                below[p] = max(below.get(p, -1), wave)
+        waves.append(wave)
+    return waves
+
+def _run_drive_op(kind, paths):
+    # Apply one operation; returns (result, undo)
+    if kind == "create_folder":
+        created = _drive_create_folder(paths[0])
+        def undo():
+            for path in reversed(created):
+                with contextlib.suppress(OSError):
+                    os.rmdir(path)
+                drive_index.touch(path)
+        return {}, undo
+    if kind == "delete":
+        meta = _drive_delete(paths[0])
+        return {"trash_id": meta["id"]}, lambda: _restore_trash(meta, paths[0])
+    src, dst = paths
+    if kind == "move":
+        moved = _drive_move(src, dst)
+        return {}, lambda: _drive_move(moved, src)
+    _drive_copy(src, dst)
+    def undo():
+        if os.path.isdir(dst) and not os.path.islink(dst):
+            shutil.rmtree(dst)
+        else:
+            os.remove(dst)
+        drive_index.touch(dst)
+        search_index.refresh(dst)
+    return {}, undo
+
+@app.route("/drive/batch", methods=["POST"])
+def drive_batch():
+    data = request.json
+    ops = data.get("operations")
+    atomic = bool(data.get("atomic", False))
+    if not isinstance(ops, list):
+        return jsonify({"error": "operations must be a list"}), 400
+    if len(ops) > DRIVE_BATCH_MAX_OPS:
+        return jsonify({"error": f"At most {DRIVE_BATCH_MAX_OPS} operations per batch"}), 400
+
+    plan, planned, errors = _BatchPlan(), [], []
+    for i, op in enumerate(ops):
+        try:
+            planned.append(_validate_drive_op(op, plan, atomic))
+        except ValueError as e:
+            errors.append({"index": i, "error": str(e)})
+    if errors:
+        return jsonify({"error": "Invalid operations; nothing was applied", "errors": errors}), 400
+
+    waves = _drive_waves([paths for _, paths in planned])
+    results = [None] * len(planned)
+    undos = []
+    failed = False
+    pool = _drive_pool()
+    for wave in range(max(waves, default=-1) + 1):
+        batch = [i for i, w in enumerate(waves) if w == wave]
+        futures = [(i, pool.submit(_run_drive_op, *planned[i])) for i in batch]
+        for i, future in futures:
+            try:
+                result, undo = future.result()
+                results[i] = {"index": i, "op": planned[i][0], "success": True, **result}
+                undos.append(undo)
+            except Exception as e:
+                results[i] = {"index": i, "op": planned[i][0], "success": False, "error": str(e)}
+                failed = True
+        if failed and atomic:
+            break
+
+    if failed and atomic:
+        rollback_errors = []
+        for undo in reversed(undos):
+            try:
+                undo()
+            except Exception as e:
+                app.logger.exception("Drive batch rollback step failed")
+                rollback_errors.append(str(e))
+        return jsonify({
+            "error": "An operation failed; completed operations were rolled back",
+            "rolled_back": not rollback_errors,
+            "rollback_errors": rollback_errors,
+            "results": [r for r in results if r is not None],
+        }), 409
+    return jsonify({"success": not failed, "results": results})
+
+# --- Resumable uploads -------------------------------------------------------
+#
+# Large or binary files are uploaded in chunks. POST /drive/uploads opens an
+# upload. PUT /drive/uploads/<id>?offset=N appends a raw request body at
+# byte N. GET reports how many bytes have arrived. POST .../commit moves the
+# file into place with an atomic rename. Bodies are streamed to a part file
+# under UPLOADS_DIR, so memory stays flat whatever the file size. The state
+# lives on disk, so any worker can take any chunk. After a dropped
+# connection the client asks for the status and resumes from the reported
+# offset: bytes that reached the disk before the drop are kept. Uploads
+# untouched for UPLOAD_TTL_SECONDS are swept. Each upload's part file lock
+# outlives its data; the sweep removes it once part and meta are gone.
+
+UPLOADS_DIR = os.path.join(BASE_DIR, ".uploads")
+UPLOAD_TTL_SECONDS = int(os.getenv("UPLOAD_TTL_SECONDS", 24 * 3600))
+
+_UPLOAD_ID = re.compile(r"^[0-9a-f]{32}$")
+_UPLOAD_FILE = re.compile(r"^\.?([0-9a-f]{32})\.")  # <id>.part, <id>.json, .<id>.part.lock
+
+def _upload_paths(upload_id):
+    return os.path.join(UPLOADS_DIR, f"{upload_id}.part"), os.path.join(UPLOADS_DIR, f"{upload_id}.json")
+
+def _load_upload(upload_id):
+    if not _UPLOAD_ID.match(upload_id):
+        return None
+    _, meta_path = _upload_paths(upload_id)
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def _upload_received(part_path):
+    # Bytes received so far, or None once the upload was committed or aborted
+    try:
+        return os.path.getsize(part_path)
+    except FileNotFoundError:
+        return None
+
+def _upload_status(upload_id, meta, received):
+    return {"upload_id": upload_id, "filename": meta["filename"], "size": meta.get("size"), "offset": received}
+
+def _copy_body(f, digest=None):
+    # Stream the raw request body into `f`; returns the number of bytes written
+    written = 0
+    while True:
+        chunk = request.stream.read(STREAM_CHUNK_BYTES)
+        if not chunk:
+            return written
+        f.write(chunk)
+        if digest is not None:
+            digest.update(chunk)
+        written += len(chunk)
+
+def _upload_touched(upload_id):
+    # Newest mtime of the upload's data and meta, or None once both are gone
+    times = []
+    for path in _upload_paths(upload_id):
+        with contextlib.suppress(FileNotFoundError):
+            times.append(os.stat(path).st_mtime)
+    return max(times, default=None)
+
+def _expire_uploads():
+    # Uploads expire whole: only when neither the data nor the meta has
+    # changed for UPLOAD_TTL_SECONDS, and both go at once
+    cutoff = time.time() - UPLOAD_TTL_SECONDS
+    try:
+        names = os.listdir(UPLOADS_DIR)
+    except FileNotFoundError:
+        return
+    upload_ids = {m.group(1) for m in map(_UPLOAD_FILE.match, names) if m}
+    for upload_id in upload_ids:
+        touched = _upload_touched(upload_id)
+        if touched is not None and touched >= cutoff:
+            continue
+        part_path, meta_path = _upload_paths(upload_id)
+        with _file_lock(part_path):
+            touched = _upload_touched(upload_id)
+            if touched is not None and touched >= cutoff:
+                continue  # a chunk landed while we waited for the lock
+            if touched is not None:
+                for path in (part_path, meta_path):
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(path)
+            else:
+                # Only the lock file is left. Ids are never reused, so no
+                # writer can need it again.
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(_sidecar_path(part_path, "lock"))
+
+@app.route("/drive/uploads", methods=["POST"])
+def drive_upload_init():
+    data = request.json
+    size = data.get("size")
+    if not data.get("filename") or (size is not None and (not isinstance(size, int) or size < 0)):
+        return jsonify({"error": "filename required and size must be a non-negative integer"}), 400
+    _expire_uploads()
+    os.makedirs(UPLOADS_DIR, exist_ok=True)
+    upload_id = os.urandom(16).hex()
+    part_path, meta_path = _upload_paths(upload_id)
+    meta = {"filename": data["filename"], "size": size, "sha256": data.get("sha256")}
+    open(part_path, "wb").close()
+    with _atomic_write(meta_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    return jsonify({**_upload_status(upload_id, meta, 0), "chunk_bytes": STREAM_CHUNK_BYTES * 64})
+
+@app.route("/drive/uploads/<upload_id>", methods=["GET"])
+def drive_upload_status(upload_id):
+    meta = _load_upload(upload_id)
+    if meta is None:
+        return jsonify({"error": "Upload not found"}), 404
+    received = _upload_received(_upload_paths(upload_id)[0])
+    if received is None:
+        return jsonify({"error": "Upload not found"}), 404
+    return jsonify(_upload_status(upload_id, meta, received))
+
+@app.route("/drive/uploads/<upload_id>", methods=["PUT"])
+def drive_upload_chunk(upload_id):
+    meta = _load_upload(upload_id)
+    if meta is None:
+        return jsonify({"error": "Upload not found"}), 404
+    offset = request.args.get("offset")
+    part_path, _ = _upload_paths(upload_id)
+    with _file_lock(part_path):
+        received = _upload_received(part_path)
+        if received is None:
+            return jsonify({"error": "Upload not found"}), 404
+        if offset is not None and offset != str(received):
+            return jsonify({"error": "offset does not match the bytes received", **_upload_status(upload_id, meta, received)}), 409
+        with open(part_path, "ab") as f:
+            _copy_body(f)
+            if meta.get("size") is not None and f.tell() > meta["size"]:
+                f.truncate(received)
+                return jsonify({"error": "Chunk runs past the declared size", **_upload_status(upload_id, meta, received)}), 413
+            received = f.tell()
+    return jsonify(_upload_status(upload_id, meta, received))
+
+@app.route("/drive/uploads/<upload_id>/commit", methods=["POST"])
+def drive_upload_commit(upload_id):
+    meta = _load_upload(upload_id)
+    if meta is None:
+        return jsonify({"error": "Upload not found"}), 404
+    part_path, meta_path = _upload_paths(upload_id)
+    target = os.path.join(BASE_DIR, meta["filename"])
+    with _file_lock(part_path):
+        received = _upload_received(part_path)
+        if received is None:
+            return jsonify({"error": "Upload not found"}), 404
+        if meta.get("size") is not None and received != meta["size"]:
+            return jsonify({"error": "Upload incomplete", **_upload_status(upload_id, meta, received)}), 409
+        digest = None
+        with open(part_path, "rb") as f:
+            if meta.get("sha256"):
+                digest = hashlib.sha256()
+                for chunk in iter(lambda: f.read(STREAM_CHUNK_BYTES * 16), b""):
+                    digest.update(chunk)
+                digest = digest.hexdigest()
+                if digest != meta["sha256"].lower():
+                    return jsonify({"error": "sha256 mismatch", **_upload_status(upload_id, meta, received)}), 409
+            os.fsync(f.fileno())
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(part_path, target)
+        os.remove(meta_path)
+    _intern(target, digest)
+    drive_index.touch(target)
+    search_index.refresh(target)
+    return jsonify({"success": True, "filename": meta["filename"], "size": received})
+
+@app.route("/drive/uploads/<upload_id>", methods=["DELETE"])
+def drive_upload_abort(upload_id):
+    if _load_upload(upload_id) is None:
+        return jsonify({"error": "Upload not found"}), 404
+    part_path, meta_path = _upload_paths(upload_id)
+    with _file_lock(part_path):
+        if _upload_received(part_path) is None:
+            return jsonify({"error": "Upload not found"}), 404
+        for path in (part_path, meta_path):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+    return jsonify({"success": True})
+
+# --- Sheet locking and versions ----------------------------------------------
+#
+# Every sheet has a reader/writer lock on a sidecar ".<name>.csv.lock" file
+# taken with flock, so it holds across threads and worker processes alike.
+# Writers take it exclusively and replace files by atomic rename. Readers hold
+# it shared only while they snapshot the base file (an open handle and its
+# current size) and the delta log, then read without blocking writers.
+# Locks are reentrant per thread; a shared request under an exclusive hold
+# is a no-op. _file_lock works for any path: upload parts, JSON sidecars and
+# the metrics directory use it too. Lock files are never removed while the
+# path they guard can still be written, since a locker that opened a fresh
+# lock file would not exclude one holding the old inode.
+#
+# A sheet's version is a digest of its file signatures. Reads return it as
+# an ETag and writes accept it back via If-Match or "expected_version".
+
+_held_locks = threading.local()
+_fallback_locks = {}
+_fallback_locks_guard = threading.Lock()
+
+@contextlib.contextmanager
+def _file_lock(path, shared=False):
+    held = _held_locks.__dict__.setdefault("paths", {})
+    mode = held.get(path)
+    if mode == "ex" or (mode == "sh" and shared):
+        yield
+        return
+    if mode == "sh":
+        raise RuntimeError(f"Cannot upgrade a shared lock on {path}")
+
+    if fcntl is None:
+        with _fallback_locks_guard:
+            lock = _fallback_locks.setdefault(path, threading.RLock())
+        with lock:
+            held[path] = "ex"
+            try:
+                yield
+            finally:
+                del held[path]
+        return
+
+    fd = os.open(_sidecar_path(path, "lock"), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        held[path] = "sh" if shared else "ex"
+        try:
+            yield
+        finally:
+            del held[path]
+    finally:
+        os.close(fd)
+
+def _atomic_write(target, mode="w", **kwargs):
+    # File object for a temp file that replaces `target` when closed cleanly
+    return _AtomicFile(target, mode, kwargs)
+
+class _AtomicFile:
+    def __init__(self, target, mode, kwargs):
+        head, tail = os.path.split(target)
+        self.target = target
+        self.tmp_path = os.path.join(head, f".{tail}.{os.getpid()}.{threading.get_ident()}.tmp")
+        self.file = open(self.tmp_path, mode, **kwargs)
+
+    def __enter__(self):
+        return self.file
+
+    def __exit__(self, exc_type, exc, tb):
+        self.file.close()
+        if exc_type is None:
+            os.replace(self.tmp_path, self.target)
+        else:
+            os.remove(self.tmp_path)
+
+def _sheet_version(path):
+    signature = _sheet_signature(path)
+    if signature is None:
+        return None
+    return hashlib.sha1(repr(signature).encode()).hexdigest()[:16]
+
+def _version_conflict(path, data=None):
+    # Precondition check for writers; call with the sheet's write lock held
+    current = _sheet_version(path)
+    expected = (data or {}).get("expected_version")
+    if expected is not None and expected != current:
+        return jsonify({"error": "Version mismatch", "version": current}), 412
+    if request.if_match and (current is None or not _if_match_version(current)):
+        return jsonify({"error": "Version mismatch", "version": current}), 412
+    return None
+
+def _if_match_version(current):
+    # Rendered reads tag "<sheet version>.<style version>"; writes only
+    # depend on the sheet part
+    if_match = request.if_match
+    return if_match.star_tag or any(tag.split(".", 1)[0] == current for tag in if_match)
+
+# --- Parsed sheet cache ------------------------------------------------------
+#
+# Parsed rows keyed by CSV path. An entry is valid while the file's
+# (mtime, size, inode) is unchanged; the least recently used entries are
+# evicted once the estimated in-memory size exceeds SHEET_CACHE_BYTES.
+# Cached rows are shared between requests and must not be mutated.
+
+SHEET_CACHE_BYTES = int(os.getenv("SHEET_CACHE_BYTES", 64 * 1024 * 1024))
+
+def _file_signature(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+def _sheet_signature(path):
+    # A sheet is its CSV plus any pending delta log
+    base = _file_signature(_base_path(path))
+    if base is None:
+        return None
+    return base + (_file_signature(_sidecar_path(path, "delta")),)
+
+def _rows_nbytes(rows):
+    # Rough CPython footprint of a list of lists of str
+    total = 56 + 8 * len(rows)
+    for row in rows:
+        total += 56 + 8 * len(row)
+        for cell in row:
+            total += 49 + len(cell)
+    return total
+
+class SheetCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        signature = _sheet_signature(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry[0] == signature:
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                self._drop(path)
+            self.misses += 1
+        return None
+
+    def put(self, path, rows, signature=None):
+        signature = signature or _sheet_signature(path)
+        nbytes = _rows_nbytes(rows)
+        with self.lock:
+            if path in self.entries:
+                self._drop(path)
+            if signature is None or nbytes > self.max_bytes:
+                return
+            self.entries[path] = (signature, rows, nbytes)
+            self.used_bytes += nbytes
+            while self.used_bytes > self.max_bytes:
+                oldest = next(iter(self.entries))
+                self._drop(oldest)
+                self.evictions += 1
+
+    def update(self, path, old_signature, change):
+        # Keep an entry current after a write made while it was valid;
+        # `change` maps the cached rows to new rows without mutating them
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None or entry[0] != old_signature:
+                return
+            cached = entry[1]
+        self.put(path, change(cached))
+
+    def invalidate(self, path):
+        with self.lock:
+            if path in self.entries:
+                self._drop(path)
+
+    def _drop(self, path):
+        _, _, nbytes = self.entries.pop(path)
+        self.used_bytes -= nbytes
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "used_bytes": self.used_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+sheet_cache = SheetCache(SHEET_CACHE_BYTES)
+
+class _SnapshotReader(io.RawIOBase):
+    # Reads a file only up to the size it had when opened, so rows appended
+    # in place afterwards (possibly half-written) are never seen
+    def __init__(self, raw, limit):
+        self.raw = raw
+        self.remaining = limit
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.remaining <= 0:
+            return 0
+        n = self.raw.readinto(memoryview(b)[:self.remaining])
+        self.remaining -= n
+        return n
+
+    def close(self):
+        self.raw.close()
+        super().close()
+
+def _csv_snapshot(path):
+    raw = open(path, "rb")
+    limit = os.fstat(raw.fileno()).st_size
+    f = io.TextIOWrapper(io.BufferedReader(_SnapshotReader(raw, limit)), encoding="utf-8", newline="")
+    reader = csv.reader(f)
+    try:
+        yield from reader
+    finally:
+        _count_rows(reader.line_num)
+        f.close()
+
+def _base_rows(path):
+    sheet = _open_columnar(path)
+    if sheet is not None:
+        return sheet.iter_rows()
+    return _csv_snapshot(path)
+
+def _stream_sheet(path):
+    # Rows of the base file with the pending delta log applied, as of the
+    # moment the first row is requested
+    with _file_lock(path, shared=True):
+        patches = _load_delta(path)
+        base = _base_rows(path)
+        first = next(base, None)
+    count = 0
+    for row in itertools.chain([] if first is None else [first], base):
+        cols = patches.get(count)
+        yield _patch_row(row, cols) if cols else row
+        count += 1
+    if patches:
+        for r in range(count, max(patches) + 1):
+            cols = patches.get(r)
+            yield _patch_row([], cols) if cols else []
+
+def _cached_rows(path):
+    # Parsed rows from the cache, loading them if the file fits the budget.
+    # Returns None for files too large to ever be cached.
+    rows = sheet_cache.get(path)
+    if rows is not None:
+        return rows
+    signature = _sheet_signature(path)
+    if signature is None or signature[1] * 3 > sheet_cache.max_bytes:
+        return None
+    rows = list(_stream_sheet(path))
+    sheet_cache.put(path, rows, signature)
+    return rows
+
+def _sheet_rows(path):
+    # Iterator over the rows of a sheet; uncacheable files are streamed
+    rows = _cached_rows(path)
+    if rows is not None:
+        return iter(rows)
+    return _stream_sheet(path)
+
+def _load_sheet(path):
+    rows = sheet_cache.get(path)
+    if rows is None:
+        signature = _sheet_signature(path)
+        rows = list(_stream_sheet(path))
+        sheet_cache.put(path, rows, signature)
+    return rows
+
+def _csv_rows(values):
+    # Rows exactly as csv.reader will hand them back after a write
+    return [["" if v is None else str(v) for v in row] for row in values]
+
+def _write_sheet(path, rows, intern=False):
+    # Full rewrite; the new content supersedes any pending delta log
+    rows = _csv_rows(rows)
+    with _file_lock(path):
+        _write_base(path, rows)
+        _drop_delta(path)
+        if intern:
+            _intern(_base_path(path))
+        sheet_cache.put(path, rows)
+
+# --- Columnar sheet storage --------------------------------------------------
+#
+# With SHEETS_STORAGE=columnar a sheet's base file is "<name>.col" instead of
+# "<name>.csv"; CSV is only used by /sheets/import and /sheets/export. Layout:
+#
+#   magic | u64 header length | JSON header | 8-byte aligned sections
+#
+# The first row (usually headers) is kept as text in the JSON header. Every
+# column below it is stored as int64 or float64 (plus a presence mask) when
+# all its cells round-trip exactly, and as UTF-8 with u64 offsets otherwise.
+# Numeric columns carry min/max per COLUMNAR_GROUP_ROWS rows and overall so
+# queries can skip row groups. Files are memory-mapped and never modified in
+# place: writes build a new file and rename it over the old one, and appends
+# and cell edits go through the delta log until compaction.
+
+SHEETS_STORAGE = os.getenv("SHEETS_STORAGE", "csv")
+COLUMNAR_GROUP_ROWS = int(os.getenv("COLUMNAR_GROUP_ROWS", 8192))
+_COLUMNAR_MAGIC = b"SHEETCOL1\n"
+
+def _columnar_path(path):
+    return os.path.splitext(path)[0] + ".col"
+
+def _base_path(path):
+    # The file holding a sheet's rows: the columnar file when there is one
+    col_path = _columnar_path(path)
+    return col_path if os.path.exists(col_path) else path
+
+def _sheet_exists(path):
+    return os.path.exists(path) or os.path.exists(_columnar_path(path))
+
+def _typed_column(values, cast, exact):
+    typed = []
+    for value in values:
+        if value == "":
+            typed.append(None)
+            continue
+        try:
+            x = cast(value)
+        except (ValueError, OverflowError):
+            return None
+        if not exact(x, value):
+            return None
+        typed.append(x)
+    return typed
+
+def _value_range(values):
+    present = [v for v in values if v is not None]
+    return [min(present), max(present)] if present else None
+
+def _write_columnar(path, rows):
+    first = list(rows[0]) if rows else []
+    body = rows[1:]
+    count = len(body)
+    ncols = max((len(row) for row in rows), default=0)
+    group = COLUMNAR_GROUP_ROWS
+    sections = [array("I", (len(row) for row in rows)).tobytes()]
+    columns = []
+
+    for c in range(ncols):
+        values = [row[c] if c < len(row) else "" for row in body]
+        typed = _typed_column(values, int, lambda x, v: str(x) == v and -2 ** 63 <= x < 2 ** 63)
+        kind, code = "int", "q"
+        if typed is None:
+            typed = _typed_column(values, float, lambda x, v: math.isfinite(x) and repr(x) == v)
+            kind, code = "float", "d"
+        column = {"type": kind if typed is not None else "str"}
+        if typed is not None:
+            sections.append(array(code, (0 if x is None else x for x in typed)).tobytes())
+            sections.append(bytes(0 if x is None else 1 for x in typed))
+            column["groups"] = [_value_range(typed[g:g + group]) for g in range(0, count, group)]
+            ranges = [r for r in column["groups"] if r]
+            if ranges:
+                column["min"] = min(r[0] for r in ranges)
+                column["max"] = max(r[1] for r in ranges)
+        else:
+            encoded = [v.encode("utf-8") for v in values]
+            offsets = array("Q", [0])
+            for chunk in encoded:
+                offsets.append(offsets[-1] + len(chunk))
+            sections.append(offsets.tobytes())
+            sections.append(b"".join(encoded))
+            present = [v for v in values if v != ""]
+            if present and max(len(v) for v in (min(present), max(present))) <= 256:
+                column["min"], column["max"] = min(present), max(present)
+        columns.append(column)
+
+    layout, pos = [], 0
+    for section in sections:
+        layout.append([pos, len(section)])
+        pos += len(section) + (-len(section) % 8)
+    header = json.dumps({
+        "rows": len(rows), "first_row": first, "group_rows": group,
+        "columns": columns, "sections": layout,
+    }, ensure_ascii=False).encode("utf-8")
+
+    with _atomic_write(_columnar_path(path), "wb") as f:
+        f.write(_COLUMNAR_MAGIC + struct.pack("<Q", len(header)) + header)
+        f.write(b"\0" * (-f.tell() % 8))
+        for section in sections:
+            f.write(section)
+            f.write(b"\0" * (-len(section) % 8))
+
+class ColumnarSheet:
+    def __init__(self, col_path):
+        with open(col_path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.map)
+        if bytes(view[:len(_COLUMNAR_MAGIC)]) != _COLUMNAR_MAGIC:
+            raise ValueError(f"Not a columnar sheet: {col_path}")
+        pos = len(_COLUMNAR_MAGIC)
+        (header_len,) = struct.unpack_from("<Q", self.map, pos)
+        pos += 8
+        meta = json.loads(bytes(view[pos:pos + header_len]))
+        pos += header_len
+        data_start = pos + (-pos % 8)
+        sections = [view[data_start + off:data_start + off + size] for off, size in meta["sections"]]
+
+        self.rows = meta["rows"]
+        self.first_row = meta["first_row"]
+        self.group_rows = meta["group_rows"]
+        self.meta = meta["columns"]
+        self.widths = sections[0].cast("I")
+        self.columns = []
+        for i, column in enumerate(self.meta):
+            data, extra = sections[1 + 2 * i], sections[2 + 2 * i]
+            if column["type"] == "str":
+                self.columns.append(("str", data.cast("Q"), extra))
+            else:
+                self.columns.append((column["type"], data.cast("q" if column["type"] == "int" else "d"), extra))
+
+    def _values(self, c, a, b, typed):
+        kind, data, extra = self.columns[c]
+        if kind == "str":
+            offsets = data[a:b + 1].tolist()
+            base = offsets[0]
+            chunk = bytes(extra[base:offsets[-1]])
+            if chunk.isascii():
+                text = chunk.decode("ascii")
+                return [text[o1 - base:o2 - base] for o1, o2 in zip(offsets, offsets[1:])]
+            return [chunk[o1 - base:o2 - base].decode("utf-8") for o1, o2 in zip(offsets, offsets[1:])]
+        values = data[a:b].tolist()
+        if typed:
+            return [v if m else "" for v, m in zip(values, extra[a:b])]
+        return [str(v) if m else "" for v, m in zip(values, extra[a:b])]
+
+    def _decode(self, start, end, typed):
+        # Rows [start, end) with start >= 1 (row 0 lives in the header)
+        widths = self.widths[start:end].tolist()
+        if not self.columns:
+            return [[] for _ in widths]
+        cols = [self._values(c, start - 1, end - 1, typed) for c in range(len(self.columns))]
+        rows = [list(t) for t in zip(*cols)]
+        ncols = len(cols)
+        for row, width in zip(rows, widths):
+            if width < ncols:
+                del row[width:]
+        return rows
+
+    def group_range(self, c, group):
+        # (min, max) of a numeric column within a row group, "text" for text
+        # columns, None when the group has no values in the column
+        if c >= len(self.meta):
+            return None
+        column = self.meta[c]
+        if column["type"] == "str":
+            return "text"
+        return column["groups"][group]
+
+    def iter_rows(self, start=0, stop=None, typed=False, group_filter=None):
+        # group_filter(group) -> False skips a row group without decoding it
+        stop = self.rows if stop is None else min(stop, self.rows)
+        if start == 0 and stop > 0:
+            yield list(self.first_row)
+            start = 1
+        while start < stop:
+            group = (start - 1) // self.group_rows
+            end = min(stop, (group + 1) * self.group_rows + 1)
+            if group_filter is None or group_filter(group):
+                _count_rows(end - start)
+                yield from self._decode(start, end, typed)
+            start = end
+
+_columnar_readers = OrderedDict()
+_columnar_readers_lock = threading.Lock()
+
+def _open_columnar(path):
+    # Memory-mapped reader for a sheet's columnar file, None for CSV sheets
+    col_path = _columnar_path(path)
+    signature = _file_signature(col_path)
+    if signature is None:
+        return None
+    with _columnar_readers_lock:
+        entry = _columnar_readers.get(col_path)
+        if entry is not None and entry[0] == signature:
+            _columnar_readers.move_to_end(col_path)
+            return entry[1]
+    sheet = ColumnarSheet(col_path)
+    with _columnar_readers_lock:
+        _columnar_readers[col_path] = (signature, sheet)
+        while len(_columnar_readers) > 32:
+            _columnar_readers.popitem(last=False)
+    return sheet
+
+def _write_base(path, rows):
+    # Write the sheet's base file in the configured storage format
+    if SHEETS_STORAGE == "columnar":
+        _write_columnar(path, rows)
+        stale = path
+    else:
+        with _atomic_write(path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerows(rows)
+        stale = _columnar_path(path)
+    if os.path.exists(stale):
+        os.remove(stale)
+
+def _delete_sheet(path):
+    with _file_lock(path):
+        for p in (path, _columnar_path(path), _sidecar_path(path, "idx"), _sidecar_path(path, "delta")):
+            if os.path.exists(p):
+                os.remove(p)
+    sheet_cache.invalidate(path)
+
+# --- Row windows and A1 ranges -----------------------------------------------
+#
+# Sheets too large for the cache get a sidecar index (".<name>.csv.idx") with
+# the byte offset of every SHEET_INDEX_STRIDE-th record, so a deep page seeks
+# close to its first row instead of parsing from the top of the file. The
+# index carries the signature of the CSV it was built from and is rebuilt
+# when the CSV changes.
+
+SHEET_INDEX_STRIDE = int(os.getenv("SHEET_INDEX_STRIDE", 1000))
+_ROW_INDEX_VERSION = 2  # bumped when the record-boundary rules change
+
+def _sidecar_path(path, suffix):
+    head, tail = os.path.split(path)
+    return os.path.join(head, f".{tail}.{suffix}")
+
+def _still_quoted(line, quoted):
+    # Whether a quoted field is open at the end of `line`, scanning as
+    # csv.reader does: a quote opens a field only as its first character,
+    # and inside an unquoted field it is just data
+    pos, end = 0, len(line)
+    while pos < end:
+        if quoted:
+            close = line.find(b'"', pos)
+            if close < 0:
+                return True
+            if line[close + 1:close + 2] == b'"':
+                pos = close + 2  # doubled quote
+                continue
+            quoted = False
+            pos = close + 1
+        elif line[pos:pos + 1] == b'"':
+            quoted = True
+            pos += 1
+            continue
+        comma = line.find(b",", pos)
+        if comma < 0:
+            return False
+        pos = comma + 1
+    return quoted
+
+def _build_row_index(path, stride):
+    offsets = array("Q")
+    rows = 0
+    pos = 0
+    quoted = False
+    with open(path, "rb") as f:
+        for line in f:
+            # A line starts a new record unless it continues a quoted field
+            if not quoted:
+                if rows % stride == 0:
+                    offsets.append(pos)
+                rows += 1
+            if b'"' in line:
+                quoted = _still_quoted(line, quoted)
+            pos += len(line)
+    return offsets, rows
+
+def _row_index(path):
+    signature = list(_file_signature(path))
+    stride = SHEET_INDEX_STRIDE
+    index_path = _sidecar_path(path, "idx")
+    try:
+        with open(index_path, "rb") as f:
+            header = json.loads(f.readline())
+            if (header["signature"] == signature and header["stride"] == stride
+                    and header.get("version") == _ROW_INDEX_VERSION):
+                offsets = array("Q")
+                offsets.frombytes(f.read())
+                return offsets, header["rows"], stride
+    except (OSError, ValueError, KeyError):
+        pass
+
+    offsets, rows = _build_row_index(path, stride)
+    with _atomic_write(index_path, "wb") as f:
+        header = {"signature": signature, "stride": stride, "rows": rows, "version": _ROW_INDEX_VERSION}
+        f.write(json.dumps(header).encode("utf-8") + b"\n")
+        f.write(offsets.tobytes())
+    return offsets, rows, stride
+
+def _read_row_window(path, start, stop):
+    # Rows [start, stop) of a sheet and the sheet's total row count
+    with _file_lock(path, shared=True):
+        return _locked_row_window(path, start, stop)
+
+def _locked_row_window(path, start, stop):
+    rows = _cached_rows(path)
+    if rows is not None:
+        return rows[start:stop], len(rows)
+    sheet = _open_columnar(path)
+    if sheet is not None:
+        total = sheet.rows
+        window = list(sheet.iter_rows(start, stop))
+    else:
+        offsets, total, stride = _row_index(path)
+        window = []
+        if start < total:
+            block = start // stride
+            skip = start - block * stride
+            with open(path, "rb") as raw:
+                raw.seek(offsets[block])
+                reader = csv.reader(io.TextIOWrapper(raw, encoding="utf-8", newline=""))
+                end = None if stop is None else stop - block * stride
+                window = list(itertools.islice(reader, skip, end))
+                _count_rows(reader.line_num)
+
+    patches = _load_delta(path)
+    if patches:
+        total = max(total, max(patches) + 1)
+        end = total if stop is None else min(stop, total)
+        window.extend([] for _ in range(len(window), end - start))
+        for r in range(start, end):
+            if r in patches:
+                window[r - start] = _patch_row(window[r - start], patches[r])
+    return window, total
+
+# --- Delta log for batch updates ---------------------------------------------
+#
+# With SHEETS_BATCH_MODE=delta, /sheets/batch-update appends the edited cells
+# as one JSON line to ".<name>.csv.delta" instead of rewriting the CSV, so a
+# write costs the size of the edit. Readers apply the log on the fly. Once
+# the log grows past SHEET_DELTA_COMPACT_BYTES a background thread folds it
+# into the CSV; full rewrites and appends fold or drop it first.
+
+SHEETS_BATCH_MODE = os.getenv("SHEETS_BATCH_MODE", "rewrite")
+SHEET_DELTA_COMPACT_BYTES = int(os.getenv("SHEET_DELTA_COMPACT_BYTES", 1024 * 1024))
+
+_compaction_guard = threading.Lock()
+
+def _load_delta(path):
+    # {row: {col: value}} from the sheet's delta log, later edits winning
+    patches = {}
+    try:
+        with open(_sidecar_path(path, "delta"), "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    cells = json.loads(line)
+                except ValueError:
+                    continue  # torn trailing line from an interrupted write
+                for r, c, value in cells:
+                    cols = patches.setdefault(r, {})
+                    if c >= 0:  # c == -1 only marks the row as present
+                        cols[c] = value
+    except FileNotFoundError:
+        pass
+    return patches
+
+def _patch_row(row, cols):
+    row = list(row)
+    width = max(cols) + 1 if cols else 0
+    if len(row) < width:
+        row.extend([""] * (width - len(row)))
+    for c, value in cols.items():
+        row[c] = value
+    return row
+
+def _apply_patches(rows, patches):
+    # New row list with the patches applied; untouched rows are shared
+    rows = list(rows)
+    if patches and max(patches) >= len(rows):
+        rows.extend([] for _ in range(len(rows), max(patches) + 1))
+    for r, cols in patches.items():
+        rows[r] = _patch_row(rows[r], cols)
+    return rows
+
+def _append_log_line(log_path, line, sync=False):
+    # Append one record to a line log; returns the bytes written. A torn
+    # last line from an interrupted write is closed off first, so the new
+    # record is not glued onto it and lost with it.
+    with open(log_path, "a+b") as f:
+        size = f.seek(0, os.SEEK_END)
+        if size:
+            f.seek(size - 1)
+            if f.read(1) != b"\n":
+                line = b"\n" + line
+        f.write(line)
+        if sync:
+            _sync(f)
+    return len(line)
+
+def _append_delta(path, cells, sync=False):
+    delta_path = _sidecar_path(path, "delta")
+    line = json.dumps(cells, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+    _append_log_line(delta_path, line, sync)
+    if os.path.getsize(delta_path) >= SHEET_DELTA_COMPACT_BYTES:
+        _schedule_compaction(path)
+
+def _drop_delta(path):
+    try:
+        os.remove(_sidecar_path(path, "delta"))
+    except FileNotFoundError:
+        pass
+
+def _compact_sheet(path):
+    with _file_lock(path):
+        if not os.path.exists(_sidecar_path(path, "delta")):
+            return
+        signature = _sheet_signature(path)
+        rows = list(_stream_sheet(path))
+        if _open_columnar(path) is None:
+            with _atomic_write(path, "w", newline="", encoding="utf-8") as f:
+                csv.writer(f).writerows(rows)
+        else:
+            _write_columnar(path, rows)
+        _drop_delta(path)
+        sheet_cache.put(path, rows)
+        filter_views.rebased(path, signature)
+
+_compaction_queue = queue.Queue()
+_compaction_pending = set()
+_compaction_thread = None
+
+def _compaction_worker():
+    while True:
+        path, compact = _compaction_queue.get()
+        with _compaction_guard:
+            _compaction_pending.discard(path)
+        try:
+            compact(path)
+        except Exception:
+            app.logger.exception("Delta compaction failed for %s", path)
+
+def _schedule_compaction(path, compact=None):
+    global _compaction_thread
+    with _compaction_guard:
+        if path in _compaction_pending:
+            return
+        _compaction_pending.add(path)
+        if _compaction_thread is None:
+            _compaction_thread = threading.Thread(target=_compaction_worker, name="sheet-compaction", daemon=True)
+            _compaction_thread.start()
+    _compaction_queue.put((path, compact or _compact_sheet))
+
+# --- Append group commit -----------------------------------------------------
+#
+# Concurrent /sheets/append calls for the same sheet are committed together.
+# A caller that finds no commit in progress becomes the leader. It waits
+# APPEND_GROUP_WINDOW_MS (0 = no wait) for more callers to queue up, then
+# takes the sheet lock once and writes the rows of every queued request in
+# one write. When it is done it answers each caller and hands leadership to
+# the first one that queued in the meantime. Under load, batches grow by
+# themselves and the lock, open and fsync are paid per batch instead of per
+# request. Each request's rows stay contiguous: no interleaved or partial
+# lines.
+#
+# Durability comes from SHEETS_APPEND_DURABILITY or a request's "durability".
+# A batch uses the strongest level any of its requests asked for:
+#   none         rows are handed to the OS (the default)
+#   batch        one fsync per commit, before anyone is answered
+#   every-write  each request's rows are written and fsynced on their own
+#
+# Requests with a version precondition skip the queue and commit alone,
+# because their check must see the version left by the previous write.
+
+APPEND_GROUP_WINDOW_MS = float(os.getenv("APPEND_GROUP_WINDOW_MS", 0))
+SHEETS_APPEND_DURABILITY = os.getenv("SHEETS_APPEND_DURABILITY", "none")
+_DURABILITY_LEVELS = ("none", "batch", "every-write")
+
+class _PendingAppend:
+    def __init__(self, values, durability):
+        self.values = values
+        self.durability = durability
+        self.woken = threading.Event()
+        self.leader = False
+        self.result = None
+        self.error = None
+
+class AppendCoalescer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queues = {}  # path -> appends waiting for the next commit; present while one runs
+        self.commits = 0
+        self.requests = 0
+
+    def submit(self, path, values, durability):
+        # Result dict for this request once its batch is committed
+        item = _PendingAppend(values, durability)
+        with self.lock:
+            waiting = self.queues.get(path)
+            if waiting is None:
+                self.queues[path] = []
+                item.leader = True
+            else:
+                waiting.append(item)
+        if not item.leader:
+            item.woken.wait()
+        if item.leader:
+            self._lead(path, item)
+        if item.error is not None:
+            raise item.error
+        return item.result
+
+    def _lead(self, path, item):
+        if APPEND_GROUP_WINDOW_MS > 0:
+            time.sleep(APPEND_GROUP_WINDOW_MS / 1000)
+        with self.lock:
+            batch = [item] + self.queues[path]
+            self.queues[path] = []
+        try:
+            _commit_appends(path, batch)
+        except Exception as e:
+            for pending in batch:
+                pending.error = e
+        with self.lock:
+            self.commits += 1
+            self.requests += len(batch)
+            waiting = self.queues[path]
+            successor = waiting.pop(0) if waiting else None
+            if successor is None:
+                del self.queues[path]
+            else:
+                successor.leader = True
+        for pending in batch[1:]:
+            pending.woken.set()
+        if successor is not None:
+            successor.woken.set()
+
+    def stats(self):
+        with self.lock:
+            return {"commits": self.commits, "requests": self.requests}
+
+append_coalescer = AppendCoalescer()
+
+def _csv_record_bytes(rows):
+    # Each row as the bytes csv.writer would append for it
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    records = []
+    for row in rows:
+        writer.writerow(row)
+        records.append(buf.getvalue().encode("utf-8"))
+        buf.seek(0)
+        buf.truncate()
+    return records
+
+def _csv_row_count(path):
+    rows = sheet_cache.get(path)
+    if rows is not None:
+        return len(rows)
+    return _row_index(path)[1]
+
+def _extend_row_index(path, before, lengths, gap=0):
+    # Carry a valid row index for the CSV with signature `before` over an
+    # append of records with these byte lengths, written `gap` bytes after
+    # its old end, instead of rescanning it
+    index_path = _sidecar_path(path, "idx")
+    try:
+        with open(index_path, "rb") as f:
+            header = json.loads(f.readline())
+            offsets = array("Q")
+            offsets.frombytes(f.read())
+    except (OSError, ValueError):
+        return
+    stride = header.get("stride")
+    if (header.get("signature") != list(before) or stride != SHEET_INDEX_STRIDE
+            or header.get("version") != _ROW_INDEX_VERSION):
+        return
+    rows, pos = header["rows"], before[1] + gap
+    for length in lengths:
+        if rows % stride == 0:
+            offsets.append(pos)
+        rows += 1
+        pos += length
+    header.update(signature=list(_file_signature(path)), rows=rows)
+    with _atomic_write(index_path, "wb") as f:
+        f.write(json.dumps(header).encode("utf-8") + b"\n")
+        f.write(offsets.tobytes())
+
+def _sync(f):
+    f.flush()
+    os.fsync(f.fileno())
+
+def _commit_appends(path, batch, check=None):
+    # Append every pending request's rows under one lock; fills in each
+    # result, or returns the response of a failed `check`
+    durability = max((item.durability for item in batch), key=_DURABILITY_LEVELS.index)
+    with _file_lock(path):
+        if check is not None:
+            conflict = check()
+            if conflict:
+                return conflict
+        if not _sheet_exists(path):
+            raise FileNotFoundError("Spreadsheet not found")
+        sheet = _open_columnar(path)
+        if sheet is not None:
+            # Columnar files are immutable: new rows go to the delta log
+            signature = _sheet_signature(path)
+            patches = _load_delta(path)
+            first = max(sheet.rows, max(patches) + 1 if patches else 0)
+            lines = []
+            for item in batch:
+                cells = []
+                for r, row in enumerate(item.values):
+                    cells.append([first + r, -1, ""])
+                    cells.extend([first + r, c, v] for c, v in enumerate(row))
+                item.first = first
+                first += len(item.values)
+                if cells:
+                    lines.append(cells)
+            if durability == "every-write":
+                for cells in lines:
+                    _append_delta(path, cells, sync=True)
+            elif lines:
+                _append_delta(path, [cell for cells in lines for cell in cells], sync=durability == "batch")
+        else:
+            # Rows added by the delta log must exist in the CSV before appending
+            _compact_sheet(path)
+            _unshare(path)
+            signature = _sheet_signature(path)
+            first = _csv_row_count(path)
+            records = []
+            for item in batch:
+                item.records = _csv_record_bytes(item.values)
+                item.first = first
+                first += len(item.values)
+                records.extend(item.records)
+            with open(path, "ab+") as f:
+                # A last line without its newline would swallow the first new row
+                terminator = b""
+                if f.tell() and os.pread(f.fileno(), 1, f.tell() - 1) != b"\n":
+                    terminator = b"\r\n"
+                    f.write(terminator)
+                if durability == "every-write":
+                    for item in batch:
+                        f.write(b"".join(item.records))
+                        _sync(f)
+                else:
+                    f.write(b"".join(records))
+                    if durability == "batch":
+                        _sync(f)
+            _extend_row_index(path, signature[:3], [len(record) for record in records], len(terminator))
+        version = _sheet_version(path)
+        values = [row for item in batch for row in item.values]
+        sheet_cache.update(path, signature, lambda rows: rows + values)
+        filter_views.appended(path, signature, values)
+    for item in batch:
+        item.result = {"success": True, "appended_rows": len(item.values), "version": version,
+                       "first_row": item.first + 1, "last_row": item.first + len(item.values)}
+    return None
+
+_A1_CELL = re.compile(r"^([A-Za-z]*)(\d*)$")
+
+def _column_number(letters):
+    number = 0
+    for ch in letters.upper():
+        number = number * 26 + ord(ch) - ord("A") + 1
+    return number - 1
+
+def _column_letters(index):
+    letters = ""
+    index += 1
+    while index:
+        index, rem = divmod(index - 1, 26)
+        letters = chr(ord("A") + rem) + letters
+    return letters
+
+def _parse_a1(ref):
+    # "Tab!A1:F200", "A:C", "2:10", "B5" -> (tab, row0, row1, col0, col1)
+    # with exclusive ends; None means unbounded
+    tab = None
+    if "!" in ref:
+        tab, ref = ref.rsplit("!", 1)
+        if len(tab) > 1 and tab[0] == tab[-1] == "'":
+            tab = tab[1:-1].replace("''", "'")
+    elif not _A1_CELL.match(ref.split(":", 1)[0]):
+        return ref, 0, None, 0, None
+    start, _, end = ref.partition(":")
+    m1 = _A1_CELL.match(start)
+    m2 = _A1_CELL.match(end if end else start)
+    if not m1 or not m2 or not start:
+        raise ValueError(f"Invalid range: {ref}")
+    row0 = int(m1.group(2)) - 1 if m1.group(2) else 0
+    row1 = int(m2.group(2)) if m2.group(2) else None
+    col0 = _column_number(m1.group(1)) if m1.group(1) else 0
+    col1 = _column_number(m2.group(1)) + 1 if m2.group(1) else None
+    if row0 < 0 or (row1 is not None and row1 <= row0) or (col1 is not None and col1 <= col0):
+        raise ValueError(f"Invalid range: {ref}")
+    return tab, row0, row1, col0, col1
+
+def _encode_page_token(offset):
+    return base64.urlsafe_b64encode(json.dumps({"offset": offset}).encode()).decode()
+
+def _decode_page_token(token):
+    try:
+        return int(json.loads(base64.urlsafe_b64decode(token.encode()))["offset"])
+    except (ValueError, KeyError, TypeError):
+        raise ValueError("Invalid page_token")
+
+# --- Workbook manifest -------------------------------------------------------
+#
+# A multi-tab spreadsheet is a folder SHEETS_DIR/<sid>/ holding one file per
+# tab. Its manifest, .workbook.json in that folder, lists the tabs in order
+# with their titles, files and sheetIds. Ids come from a counter and are
+# never reused, so they survive restarts and agree between workers. Reads
+# never write it: each worker reconciles the recorded tabs with the folder
+# listing in memory, and caches the result until the manifest or the folder
+# changes. Tab files the manifest does not list, e.g. ones added by hand,
+# get the next ids in name order. They are recorded with those same ids
+# the next time a tab is added or deleted. Spreadsheets that are a single
+# <sid>.csv keep working unchanged: their one tab has sheetId 0.
+
+def _manifest_path(sid):
+    return os.path.join(SHEETS_DIR, sid, ".workbook.json")
+
+_manifests = {}  # sid -> (manifest file signature, manifest)
+_manifests_lock = threading.Lock()
+
+def _tab_files(folder):
+    names = set()
+    for filename in os.listdir(folder):
+        stem, ext = os.path.splitext(filename)
+        if ext in (".csv", ".col") and not stem.startswith("."):
+            names.add(stem)
+    return names
+
+def _read_manifest(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def _reconcile_manifest(manifest, files):
+    # `manifest` without tabs whose file is gone, plus the unlisted files
+    manifest = manifest or {"next_id": 1, "tabs": []}
+    updated = {"next_id": manifest["next_id"],
+               "tabs": [dict(tab) for tab in manifest["tabs"] if tab["file"] in files]}
+    for name in sorted(files - {tab["file"] for tab in updated["tabs"]}):
+        updated["tabs"].append({"sheetId": updated["next_id"], "title": name, "file": name, "hidden": False})
+        updated["next_id"] += 1
+    return updated
+
+def _change_manifest(sid, change=None):
+    # Record the reconciled manifest after applying `change` to it; for
+    # writers that add or delete tabs. Returns the result.
+    path = _manifest_path(sid)
+    with _file_lock(path):
+        manifest = _read_manifest(path)
+        updated = _reconcile_manifest(manifest, _tab_files(os.path.dirname(path)))
+        if change is not None:
+            change(updated)
+        if updated != manifest:
+            with _atomic_write(path, "w", encoding="utf-8") as f:
+                json.dump(updated, f, ensure_ascii=False, indent=2)
+    with _manifests_lock:
+        _manifests.pop(sid, None)
+    return updated
+
+def _load_manifest(sid):
+    # The workbook's manifest, or None if `sid` has no tab folder
+    path = _manifest_path(sid)
+    folder = os.path.dirname(path)
+    signature = (_file_signature(path), _file_signature(folder))
+    if signature[1] is None or not os.path.isdir(folder):
+        return None
+    with _manifests_lock:
+        cached = _manifests.get(sid)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+    try:
+        manifest = _reconcile_manifest(_read_manifest(path), _tab_files(folder))
+    except FileNotFoundError:
+        return None
+    with _manifests_lock:
+        _manifests[sid] = (signature, manifest)
+    return manifest
+
+def _find_tab(manifest, tab=None, sheet_id=None):
+    for entry in manifest["tabs"] if manifest else []:
+        if sheet_id is not None and entry["sheetId"] == sheet_id:
+            return entry
+        if tab is not None and tab in (entry["title"], entry["file"]):
+            return entry
+    return None
+
+def _resolve_tab(sid, tab=None, sheet_id=None, manifest=False):
+    # (path, title) of the tab named `tab` or numbered `sheet_id`, or of the
+    # spreadsheet's default tab when neither is given; None if there is no
+    # such tab. The default of a workbook without <sid>.csv is its first tab.
+    # `manifest` may be passed in when resolving many tabs at once.
+    legacy = os.path.join(SHEETS_DIR, f"{sid}.csv")
+    if manifest is False:
+        manifest = _load_manifest(sid)
+    if tab is None and sheet_id is None:
+        if manifest and manifest["tabs"] and not _sheet_exists(legacy):
+            entry = manifest["tabs"][0]
+            return os.path.join(SHEETS_DIR, sid, f"{entry['file']}.csv"), entry["title"]
+        return legacy, sid
+    entry = _find_tab(manifest, tab, sheet_id)
+    if entry is not None:
+        return os.path.join(SHEETS_DIR, sid, f"{entry['file']}.csv"), entry["title"]
+    if _sheet_exists(legacy) and (sheet_id == 0 or (sheet_id is None and tab is not None)):
+        # A single-file spreadsheet answers to any tab name, as before
+        return legacy, sid
+    return None
+
+def _parse_tab_range(sid, ref, manifest=False):
+    # _parse_a1, except that a bare tab title such as "Costs" (which would
+    # otherwise read as column letters) means that whole tab
+    if "!" not in ref:
+        if manifest is False:
+            manifest = _load_manifest(sid)
+        if _find_tab(manifest, ref) is not None:
+            return ref, 0, None, 0, None
+    return _parse_a1(ref)
+
+def _tab_args(source):
+    # (tab, sheet_id) from request args or a JSON body; raises ValueError
+    tab = source.get("tab") or None
+    sheet_id = source.get("sheet_id")
+    if sheet_id not in (None, ""):
+        try:
+            sheet_id = int(sheet_id)
+        except (TypeError, ValueError):
+            raise ValueError("sheet_id must be an integer")
+    else:
+        sheet_id = None
+    return tab, sheet_id
+
+def _sheet_path(sid, source):
+    # Resolved sheet path for a request addressing `sid` and maybe a tab;
+    # returns (path, title, error response)
+    try:
+        tab, sheet_id = _tab_args(source)
+    except ValueError as e:
+        return None, None, (jsonify({"error": str(e)}), 400)
+    resolved = _resolve_tab(sid, tab, sheet_id)
+    if resolved is None:
+        return None, None, (jsonify({"error": "Tab not found"}), 404)
+    return resolved[0], resolved[1], None
+
+def _tab_file(title):
+    return re.sub(r'[^\w\-_\.]', '_', title)
+
+def _register_tab(sid, title):
+    # Give the just-written file of tab `title` its manifest entry; returns it
+    file = _tab_file(title)
+    registered = {}
+
+    def change(manifest):
+        entry = next((t for t in manifest["tabs"] if t["file"] == file), None)
+        if entry is None:
+            # (A lookup may already have listed the file under its bare name)
+            entry = {"sheetId": manifest["next_id"], "file": file, "hidden": False}
+            manifest["tabs"].append(entry)
+            manifest["next_id"] += 1
+        entry["title"] = title
+        registered.update(entry)
+
+    _change_manifest(sid, change)
+    return registered
+
+# --- Bulk import and export --------------------------------------------------
+#
+# /sheets/import and /sheets/export move a whole tab as CSV, TSV or NDJSON
+# (one JSON array or object per line), optionally gzip-compressed. Both
+# directions stream. Imports decompress and parse the body in BULK_CHUNK_BYTES
+# reads and write rows in batches to a staging file next to the sheet. The
+# staging file replaces the sheet under its lock once the upload is complete,
+# so readers see either the old tab or the new one. Exports encode and
+# compress one chunk at a time. Memory stays flat whatever the data size.
+# The exception is columnar storage: its base file is still built from the
+# full row list once the CSV has been staged.
+#
+# Imports infer a type for each column from its first BULK_INFER_ROWS cells
+# (0 = every cell). Progress is reported two ways:
+#   - With "Accept: application/x-ndjson", the import response streams a
+#     progress record every BULK_PROGRESS_BYTES of input, followed by the
+#     summary.
+#   - With an import_id, the same records are written to a small status file,
+#     so any worker can answer GET /sheets/import-status while the upload
+#     is running. Status files older than BULK_STATUS_SECONDS are pruned.
+
+BULK_CHUNK_BYTES = int(os.getenv("BULK_CHUNK_BYTES", 1024 * 1024))
+BULK_BATCH_ROWS = int(os.getenv("BULK_BATCH_ROWS", 1024))
+BULK_INFER_ROWS = int(os.getenv("BULK_INFER_ROWS", 10000))
+BULK_PROGRESS_BYTES = int(os.getenv("BULK_PROGRESS_BYTES", 8 * 1024 * 1024))
+BULK_STATUS_SECONDS = int(os.getenv("BULK_STATUS_SECONDS", 86400))
+
+_BULK_FORMATS = {"csv": "csv", "tsv": "tsv", "ndjson": "ndjson", "jsonl": "ndjson"}
+_BULK_MIMETYPES = {"csv": "text/csv", "tsv": "text/tab-separated-values", "ndjson": "application/x-ndjson"}
+_IMPORT_ID = re.compile(r"[\w.-]{1,64}")
+_INT_CELL = re.compile(r"[-+]?\d+")
+_FLOAT_CELL = re.compile(r"[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?")
+_DATE_CELL = re.compile(r"\d{4}-\d{2}-\d{2}")
+_DATETIME_CELL = re.compile(r"\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}(:\d{2}(\.\d+)?)?(Z|[+-]\d{2}:?\d{2})?")
+
+def _bulk_format(value, content_type="", filename=""):
+    # Format name from an explicit value, the Content-Type, or a file name;
+    # raises ValueError for an unknown explicit format
+    if value:
+        if value.lower() not in _BULK_FORMATS:
+            raise ValueError(f"format must be one of {', '.join(sorted(_BULK_FORMATS))}")
+        return _BULK_FORMATS[value.lower()]
+    content_type = content_type.split(";")[0].strip().lower()
+    for name, mimetype in _BULK_MIMETYPES.items():
+        if content_type == mimetype:
+            return name
+    if content_type in ("application/jsonl", "application/x-jsonlines"):
+        return "ndjson"
+    stem = filename.lower()[:-3] if filename.lower().endswith(".gz") else filename.lower()
+    return _BULK_FORMATS.get(os.path.splitext(stem)[1].lstrip("."), "csv")
+
+def _cell_type(value):
+    if _INT_CELL.fullmatch(value):
+        return "int"
+    if _FLOAT_CELL.fullmatch(value):
+        return "float"
+    if value.lower() in ("true", "false"):
+        return "bool"
+    if _DATE_CELL.fullmatch(value):
+        return "date"
+    if _DATETIME_CELL.fullmatch(value):
+        return "datetime"
+    return "text"
+
+def _widen(current, seen):
+    if current is None or current == seen:
+        return seen
+    pair = {current, seen}
+    if pair == {"int", "float"}:
+        return "float"
+    if pair == {"date", "datetime"}:
+        return "datetime"
+    return "text"
+
+class _ColumnTypes:
+    # Narrowest type covering every non-empty cell seen in each column
+    def __init__(self):
+        self.types = []
+
+    def observe(self, rows):
+        types = self.types
+        for row in rows:
+            if len(row) > len(types):
+                types.extend([None] * (len(row) - len(types)))
+            for c, value in enumerate(row):
+                if value and types[c] != "text":
+                    types[c] = _widen(types[c], _cell_type(value))
+
+    def columns(self, header):
+        width = max(len(header), len(self.types))
+        return [{"name": header[c] if c < len(header) else "",
+                 "type": (self.types[c] if c < len(self.types) else None) or "empty"}
+                for c in range(width)]
+
+def _csv_line(row):
+    buf = io.StringIO()
+    csv.writer(buf).writerow(row)
+    return buf.getvalue()
+
+def _json_cell(value):
+    # A JSON value as the text a sheet cell holds
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float, str)):
+        return str(value)
+    return _dumps(value)
+
+def _typed_cell(value):
+    # Inverse of _json_cell for cells that round-trip exactly
+    if _INT_CELL.fullmatch(value) and str(int(value)) == value:
+        return int(value)
+    if _FLOAT_CELL.fullmatch(value):
+        number = float(value)
+        if math.isfinite(number) and repr(number) == value:
+            return number
+    if value in ("true", "false"):
+        return value == "true"
+    return value
+
+class _CountingReader(io.RawIOBase):
+    # Raw request body that counts the bytes consumed
+    def __init__(self, stream):
+        self.stream = stream
+        self.count = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.stream.read(len(b))
+        n = len(data)
+        b[:n] = data
+        self.count += n
+        return n
+
+def _import_status_path(import_id):
+    return os.path.join(SHEETS_DIR, ".imports", f"{import_id}.json")
+
+def _prune_import_status():
+    folder = os.path.join(SHEETS_DIR, ".imports")
+    cutoff = time.time() - BULK_STATUS_SECONDS
+    try:
+        entries = list(os.scandir(folder))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+class _BulkImport:
+    # One streamed import into the sheet at `path`; run() yields progress
+    # records and ends with the summary
+    def __init__(self, path, fmt, import_id=None, total_bytes=None):
+        self.path = path
+        self.format = fmt
+        self.import_id = import_id
+        self.total_bytes = total_bytes
+        self.reader = None
+        self.rows = 0
+        self.compressed = False
+        self.header = []
+        self.types = _ColumnTypes()
+        self.started = time.monotonic()
+        self.reported = 0
+
+    def progress(self, state="running"):
+        record = {"state": state, "rows": self.rows, "bytes": self.reader.count if self.reader else 0,
+                  "seconds": round(time.monotonic() - self.started, 3)}
+        if self.total_bytes:
+            record["total_bytes"] = self.total_bytes
+            record["percent"] = round(100 * min(record["bytes"] / self.total_bytes, 1), 1)
+        if self.import_id:
+            record["import_id"] = self.import_id
+            with _atomic_write(_import_status_path(self.import_id)) as f:
+                json.dump(record, f)
+        return record
+
+    def open(self, stream):
+        # Text stream over the body, gunzipped when it starts with the gzip magic
+        self.reader = _CountingReader(stream)
+        raw = io.BufferedReader(self.reader, BULK_CHUNK_BYTES)
+        if raw.peek(2)[:2] == b"\x1f\x8b":
+            self.compressed = True
+            raw = io.BufferedReader(gzip.GzipFile(fileobj=raw, mode="rb"), BULK_CHUNK_BYTES)
+        return io.TextIOWrapper(raw, encoding="utf-8-sig", newline="")
+
+    def parse(self, text):
+        if self.format != "ndjson":
+            yield from csv.reader(text, delimiter="\t" if self.format == "tsv" else ",")
+            return
+        # Objects are keyed into columns by name; keys first seen after the
+        # header was written are added to it when the import finishes
+        columns = None
+        for number, line in enumerate(text, 1):
+            if not line.strip():
+                continue
+            try:
+                value = json.loads(line)
+            except ValueError as e:
+                raise ValueError(f"line {number}: {e}")
+            if isinstance(value, dict):
+                if columns is None:
+                    columns = {key: c for c, key in enumerate(value)}
+                    self.header = list(columns)
+                    yield self.header
+                for key in value:
+                    if key not in columns:
+                        columns[key] = len(columns)
+                row = [""] * len(columns)
+                for key, cell in value.items():
+                    row[columns[key]] = _json_cell(cell)
+                yield row
+            elif isinstance(value, list):
+                yield [_json_cell(cell) for cell in value]
+            else:
+                raise ValueError(f"line {number}: expected a JSON array or object")
+        if columns is not None and len(columns) > len(self.header):
+            self.header = list(columns)
+
+    def run(self, stream, on_complete=None):
+        if self.import_id:
+            os.makedirs(os.path.dirname(_import_status_path(self.import_id)), exist_ok=True)
+            _prune_import_status()
+        head, tail = os.path.split(self.path)
+        staging = os.path.join(head, f".{tail}.{os.getpid()}.{threading.get_ident()}.import")
+        try:
+            try:
+                yield from self._stage(stream, staging)
+            except Exception:
+                if self.import_id:
+                    self.progress("failed")
+                raise
+            self._install(staging)
+            _count_rows(self.rows)
+        finally:
+            if os.path.exists(staging):
+                os.remove(staging)
+        if on_complete:
+            on_complete()
+        summary = self.progress("done")
+        summary["format"] = self.format
+        summary["compressed"] = self.compressed
+        summary["columns"] = self.types.columns(self.header)
+        yield summary
+
+    def _stage(self, stream, staging):
+        rows = self.parse(self.open(stream))
+        header_bytes = 0
+        with _atomic_write(staging, "w", newline="", encoding="utf-8", buffering=BULK_CHUNK_BYTES) as f:
+            writer = csv.writer(f)
+            first = next(rows, None)
+            if first is not None:
+                self.header = list(first)
+                header_bytes = len(_csv_line(first).encode("utf-8"))
+                writer.writerow(first)
+                self.rows = 1
+            written_header = list(self.header)
+            while True:
+                batch = list(itertools.islice(rows, BULK_BATCH_ROWS))
+                if not batch:
+                    break
+                writer.writerows(batch)
+                sample = BULK_INFER_ROWS - (self.rows - 1) if BULK_INFER_ROWS else len(batch)
+                if sample > 0:
+                    self.types.observe(batch[:sample])
+                self.rows += len(batch)
+                if self.reader.count - self.reported >= BULK_PROGRESS_BYTES:
+                    self.reported = self.reader.count
+                    yield self.progress()
+        if self.header != written_header:
+            # NDJSON objects introduced new keys: rewrite the header line only
+            with _atomic_write(staging, "wb") as out, open(staging, "rb") as src:
+                out.write(_csv_line(self.header).encode("utf-8"))
+                src.seek(header_bytes)
+                shutil.copyfileobj(src, out, BULK_CHUNK_BYTES)
+
+    def _install(self, staging):
+        if SHEETS_STORAGE == "columnar":
+            with open(staging, newline="", encoding="utf-8") as f:
+                _write_sheet(self.path, list(csv.reader(f)))
+            return
+        with _file_lock(self.path):
+            os.replace(staging, self.path)
+            if os.path.exists(_columnar_path(self.path)):
+                os.remove(_columnar_path(self.path))
+            _drop_delta(self.path)
+            sheet_cache.invalidate(self.path)
+
+def _export_chunks(rows, fmt, header=True, typed=False):
+    # Encoded text of `rows`, in pieces of about STREAM_CHUNK_BYTES
+    buf = io.StringIO()
+    if fmt == "ndjson":
+        rows = iter(rows)
+        keys = next(rows, None) if header else None
+        if keys is None and header:
+            return
+        convert = _typed_cell if typed else (lambda value: value)
+        for row in rows:
+            cells = [convert(value) for value in row]
+            if keys is not None:
+                cells = {key: cells[c] if c < len(cells) else None for c, key in enumerate(keys)}
+            buf.write(_dumps(cells))
+            buf.write("\n")
+            if buf.tell() >= STREAM_CHUNK_BYTES:
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+    else:
+        writer = csv.writer(buf, delimiter="\t" if fmt == "tsv" else ",")
+        rows = iter(rows)
+        if not header:
+            next(rows, None)
+        while True:
+            batch = list(itertools.islice(rows, BULK_BATCH_ROWS))
+            if not batch:
+                break
+            writer.writerows(batch)
+            if buf.tell() >= STREAM_CHUNK_BYTES:
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+    yield buf.getvalue()
+
+def _gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8"))
+        if data:
+            yield data
+    yield compressor.flush()
+
+@app.route("/sheets/export", methods=["GET"])
+def sheets_export():
+    sid = request.args.get("spreadsheet_id")
+    path, title, error = _sheet_path(sid, request.args)
+    if error:
+        return error
+    if not _sheet_exists(path):
+        return jsonify({"error": "Sheet not found"}), 404
+    try:
+        fmt = _bulk_format(request.args.get("format") or "csv")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    compression = (request.args.get("compression") or "none").lower()
+    if compression not in ("none", "gzip"):
+        return jsonify({"error": "compression must be none or gzip"}), 400
+    header = request.args.get("header", "true").lower() not in ("0", "false", "no")
+    typed = request.args.get("typed", "false").lower() in ("1", "true", "yes")
+
+    chunks = _export_chunks(_sheet_rows(path), fmt, header=header, typed=typed)
+    filename = f"{_tab_file(title)}.{fmt}"
+    mimetype = _BULK_MIMETYPES[fmt]
+    if compression == "gzip":
+        chunks = _gzip_chunks(chunks)
+        filename += ".gz"
+        mimetype = "application/gzip"
+    return Response(chunks, mimetype=mimetype,
+                    headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+@app.route("/sheets/import", methods=["POST"])
+def sheets_import():
+    sid = request.args.get("spreadsheet_id")
+    tab = request.args.get("tab")
+    import_id = request.args.get("import_id")
+    if not sid:
+        return jsonify({"error": "spreadsheet_id parameter is required"}), 400
+    if import_id and not _IMPORT_ID.fullmatch(import_id):
+        return jsonify({"error": "import_id may only contain letters, digits, '.', '-' and '_'"}), 400
+    try:
+        fmt = _bulk_format(request.args.get("format"), request.content_type or "",
+                           request.args.get("filename") or "")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    entry = _find_tab(_load_manifest(sid), tab) if tab else None
+    if tab:
+        os.makedirs(os.path.join(SHEETS_DIR, sid), exist_ok=True)
+        path = os.path.join(SHEETS_DIR, sid, f"{entry['file'] if entry else _tab_file(tab)}.csv")
+        if entry is None:
+            # Record the ids readers see now, before the new file joins the unlisted ones
+            _change_manifest(sid)
+    else:
+        path = os.path.join(SHEETS_DIR, f"{sid}.csv")
+
+    def registered():
+        if tab and entry is None:
+            _register_tab(sid, tab)
+
+    job = _BulkImport(path, fmt, import_id, request.content_length)
+    records = job.run(request.stream, registered)
+    failures = (ValueError, csv.Error, EOFError, gzip.BadGzipFile, zlib.error)
+
+    if _stream_mode() == "ndjson":
+        def generate():
+            try:
+                for record in records:
+                    if record["state"] == "done":
+                        record["spreadsheetId"] = sid
+                    yield _dumps(record) + "\n"
+            except failures as e:
+                yield _dumps({"state": "failed", "error": str(e)}) + "\n"
+        return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+    try:
+        summary = None
+        for summary in records:
+            pass
+    except failures as e:
+        return jsonify({"error": str(e)}), 400
+    summary["spreadsheetId"] = sid
+    return jsonify(summary)
+
+@app.route("/sheets/import-status", methods=["GET"])
+def sheets_import_status():
+    import_id = request.args.get("import_id")
+    if not import_id or not _IMPORT_ID.fullmatch(import_id):
+        return jsonify({"error": "import_id parameter is required"}), 400
+    try:
+        with open(_import_status_path(import_id), encoding="utf-8") as f:
+            return jsonify(json.load(f))
+    except FileNotFoundError:
+        return jsonify({"error": "Import not found"}), 404
+
+@app.route("/sheets/cache-stats", methods=["GET"])
+def sheets_cache_stats():
+    return jsonify(sheet_cache.stats())
+
 @app.route("/sheets/create", methods=["POST"])
 def sheets_create():
     data = request.json
     name = data["name"]
     path = os.path.join(SHEETS_DIR, f"{name}.csv")
-    with open(path, "w", newline="", encoding="utf-8") as f:
-        writer = csv.writer(f)
-        writer.writerows(data.get("data", []))
+    _write_sheet(path, data.get("data", []), intern=True)
     return jsonify({"spreadsheetId": name})
 
 @app.route("/sheets/read", methods=["GET"])
 def sheets_read():
     sid = request.args.get("spreadsheet_id")
-    path = os.path.join(SHEETS_DIR, f"{sid}.csv")
-    if not os.path.exists(path):
+    a1 = request.args.get("range")
+    paged = any(request.args.get(k) for k in ("range", "offset", "limit", "page_token"))
+    render = request.args.get("render", "").lower() in ("1", "true", "yes")
+    tab = None
+    try:
+        if a1:
+            tab, row0, row1, col0, col1 = _parse_tab_range(sid, a1)
+        else:
+            row0, row1, col0, col1 = 0, None, 0, None
+        offset = int(request.args.get("offset", 0))
+        if request.args.get("page_token"):
+            offset = _decode_page_token(request.args["page_token"])
+        limit = request.args.get("limit")
+        limit = int(limit) if limit else None
+        if offset < 0 or (limit is not None and limit < 1):
+            raise ValueError("offset must be >= 0 and limit >= 1")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    # "Tab!A1:B2", ?tab= or ?sheet_id= read that tab of a workbook
+    try:
+        tab_arg, sheet_id = _tab_args(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    resolved = _resolve_tab(sid, tab or tab_arg, sheet_id)
+    if resolved is None:
+        return jsonify({"error": "Tab not found"}), 404
+    path, style_tab = resolved
+    if not _sheet_exists(path):
         return jsonify({"error": "Sheet not found"}), 404
-    with open(path, newline="", encoding="utf-8") as f:
-        reader = csv.reader(f)
-        return jsonify({"values": list(reader)})
+    if render:
+        return _rendered_read(path, sid, style_tab, row0, row1, col0, col1, offset, limit)
+    version = _sheet_version(path)
+    if version and request.if_none_match.contains(version):
+        return Response(status=304, headers={"ETag": f'"{version}"'})
+    if not paged:
+        mode = _stream_mode()
+        if mode:
+            response = _stream_response(mode, _sheet_rows(path))
+        else:
+            response = jsonify({"values": list(_sheet_rows(path))})
+        response.set_etag(version)
+        return response
+
+    start = row0 + offset
+    stop = row1
+    if limit is not None:
+        stop = start + limit if stop is None else min(stop, start + limit)
+    window, total = _read_row_window(path, start, stop)
+    if col0 or col1 is not None:
+        window = [row[col0:col1] for row in window]
+
+    end = start + len(window)
+    more = len(window) > 0 and end < total and (row1 is None or end < row1)
+    response = {"values": window, "total_rows": total, "next_page_token": None}
+    if window:
+        last_col = col1 if col1 is not None else col0 + max(len(row) for row in window)
+        response["range"] = f"{_column_letters(col0)}{start + 1}:{_column_letters(max(last_col, col0 + 1) - 1)}{end}"
+        if tab:
+            response["range"] = f"{tab}!{response['range']}"
+    if more:
+        response["next_page_token"] = _encode_page_token(end - row0)
+    response = jsonify(response)
+    response.set_etag(version)
+    return response
+
+@app.route("/sheets/batch-read", methods=["GET"])
+def sheets_batch_read():
+    # Several A1 ranges, from any tabs, resolved against one manifest lookup
+    sid = request.args.get("spreadsheet_id")
+    ranges = request.args.getlist("ranges")
+    if not sid or not ranges:
+        return jsonify({"error": "spreadsheet_id and at least one ranges parameter are required"}), 400
+    manifest = _load_manifest(sid)
+    value_ranges = []
+    for a1 in ranges:
+        try:
+            tab, row0, row1, col0, col1 = _parse_tab_range(sid, a1, manifest)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        resolved = _resolve_tab(sid, tab, manifest=manifest)
+        if resolved is None or not _sheet_exists(resolved[0]):
+            return jsonify({"error": f"Tab not found for range {a1}"}), 404
+        path = resolved[0]
+        with _file_lock(path, shared=True):
+            window, total = _read_row_window(path, row0, row1)
+            version = _sheet_version(path)
+        if col0 or col1 is not None:
+            window = [row[col0:col1] for row in window]
+        value_ranges.append({"range": a1, "values": window, "total_rows": total, "version": version})
+    return jsonify({"spreadsheetId": sid, "valueRanges": value_ranges})
 
 @app.route("/sheets/update", methods=["POST"])
 def sheets_update():
     data = request.json
     sid = data["spreadsheet_id"]
     values = data["values"]
-    path = os.path.join(SHEETS_DIR, f"{sid}.csv")
-    with open(path, "w", newline="", encoding="utf-8") as f:
-        writer = csv.writer(f)
-        writer.writerows(values)
-    return jsonify({"success": True})
+    path, _, error = _sheet_path(sid, data)
+    if error:
+        return error
+    with _file_lock(path):
+        conflict = _version_conflict(path, data)
+        if conflict:
+            return conflict
+        _write_sheet(path, values)
+        version = _sheet_version(path)
+    return jsonify({"success": True, "version": version})
   
 @app.route("/sheets/append", methods=["POST"])
 def sheets_append():
     data = request.json
     sid = data["spreadsheet_id"]
     values = data["values"]
-    path = os.path.join(SHEETS_DIR, f"{sid}.csv")
-
-    if not os.path.exists(path):
+    durability = data.get("durability") or SHEETS_APPEND_DURABILITY
+    if durability not in _DURABILITY_LEVELS:
+        return jsonify({"error": f"durability must be one of {', '.join(_DURABILITY_LEVELS)}"}), 400
+    path, _, error = _sheet_path(sid, data)
+    if error:
+        return error
+
+    if not _sheet_exists(path):
         return jsonify({"error": "Spreadsheet not found"}), 404
 
     try:
-        with open(path, "a", newline="", encoding="utf-8") as f:
-            writer = csv.writer(f)
-            writer.writerows(values)
-        return jsonify({"success": True, "appended_rows": len(values)})
+        values = _csv_rows(values)
+        if data.get("expected_version") is not None or request.if_match:
+            item = _PendingAppend(values, durability)
+            conflict = _commit_appends(path, [item], check=lambda: _version_conflict(path, data))
+            if conflict:
+                return conflict
+            return jsonify(item.result)
+        return jsonify(append_coalescer.submit(path, values, durability))
+    except FileNotFoundError:
+        return jsonify({"error": "Spreadsheet not found"}), 404
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -160,16 +3424,15 @@ def sheets_batch_update():
     data = request.json
     sid = data["spreadsheet_id"]
     requests = data["requests"]
-    path = os.path.join(SHEETS_DIR, f"{sid}.csv")
+    path, _, error = _sheet_path(sid, data)
+    if error:
+        return error
 
-    if not os.path.exists(path):
+    if not _sheet_exists(path):
         return jsonify({"error": "Spreadsheet not found"}), 404
 
     try:
-        # Load existing data
-        with open(path, "r", newline="", encoding="utf-8") as f:
-            existing_data = list(csv.reader(f))
-
+        cells = []
         applied_requests = 0
 
         for req in requests:
@@ -181,22 +3444,32 @@ def sheets_batch_update():
                 col_index = start.get("columnIndex", 0)
 
                 for r, row in enumerate(rows):
-                    values = row.get("values", [])
-                    while len(existing_data) <= row_index + r:
-                        existing_data.append([])
-
-                    for c, cell in enumerate(values):
-                        while len(existing_data[row_index + r]) <= col_index + c:
-                            existing_data[row_index + r].append("")
+                    for c, cell in enumerate(row.get("values", [])):
                         val = cell.get("userEnteredValue", {}).get("stringValue", "")
-                        existing_data[row_index + r][col_index + c] = val
+                        cells.append([row_index + r, col_index + c, "" if val is None else str(val)])
                 applied_requests += 1
 
-        with open(path, "w", newline="", encoding="utf-8") as f:
-            writer = csv.writer(f)
-            writer.writerows(existing_data)
-
-        return jsonify({"success": True, "applied_requests": applied_requests})
+        patches = {}
+        for r, c, val in cells:
+            patches.setdefault(r, {})[c] = val
+
+        with _file_lock(path):
+            conflict = _version_conflict(path, data)
+            if conflict:
+                return conflict
+            signature = _sheet_signature(path)
+            delta_mode = data.get("mode", SHEETS_BATCH_MODE) == "delta"
+            if delta_mode:
+                if cells:
+                    _append_delta(path, cells)
+            else:
+                _write_sheet(path, _apply_patches(_load_sheet(path), patches))
+            version = _sheet_version(path)
+            if delta_mode:
+                sheet_cache.update(path, signature, lambda rows: _apply_patches(rows, patches))
+            filter_views.patched(path, signature, patches)
+
+        return jsonify({"success": True, "applied_requests": applied_requests, "version": version})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -207,24 +3480,22 @@ def sheets_list_tabs():
         return jsonify({"error": "spreadsheet_id parameter is required"}), 400
 
     # Check if it's a multi-tab spreadsheet (folder) or single CSV
-    folder_path = os.path.join(SHEETS_DIR, sid)
+    manifest = _load_manifest(sid)
     file_path = os.path.join(SHEETS_DIR, f"{sid}.csv")
     
     tabs = []
     
-    if os.path.exists(folder_path) and os.path.isdir(folder_path):
+    if manifest is not None and (manifest["tabs"] or not _sheet_exists(file_path)):
         # It's a multi-tab spreadsheet
-        for filename in os.listdir(folder_path):
-            if filename.endswith(".csv"):
-                tab_name = filename[:-4]
-                tabs.append({
-                    "title": tab_name,
-                    "sheetId": int(hash(tab_name) % 10000000),
-                    "index": len(tabs),
-                    "sheetType": "GRID", 
-                    "hidden": False
-                })
-    elif os.path.exists(file_path):
+        for entry in manifest["tabs"]:
+            tabs.append({
+                "title": entry["title"],
+                "sheetId": entry["sheetId"],
+                "index": len(tabs),
+                "sheetType": "GRID", 
+                "hidden": entry["hidden"]
+            })
+    elif _sheet_exists(file_path):
         # It's a single tab spreadsheet
         tabs.append({
             "title": sid,
@@ -250,19 +3521,20 @@ def sheets_add_tab():
     folder_path = os.path.join(SHEETS_DIR, sid)
     os.makedirs(folder_path, exist_ok=True)
 
-    safe_title = re.sub(r'[^\w\-_\.]', '_', title)
-    new_tab_path = os.path.join(folder_path, f"{safe_title}.csv")
+    new_tab_path = os.path.join(folder_path, f"{_tab_file(title)}.csv")
 
-    if os.path.exists(new_tab_path):
+    if _sheet_exists(new_tab_path) or _find_tab(_load_manifest(sid), title) is not None:
         return jsonify({"error": "Tab already exists"}), 400
 
     try:
-        with open(new_tab_path, "w", newline="", encoding="utf-8") as f:
-            pass
+        # Record the ids readers see now, before the new file joins the unlisted ones
+        _change_manifest(sid)
+        _write_sheet(new_tab_path, [])
+        entry = _register_tab(sid, title)
 
         return jsonify({
             "success": True,
-            "sheetId": int(datetime.datetime.now().timestamp()),
+            "sheetId": entry["sheetId"],
             "title": title
         })
     except Exception as e:
@@ -273,17 +3545,24 @@ def sheets_delete_tab():
     sid = request.args.get("spreadsheet_id")
     title = request.args.get("title")
 
-    if not sid or not title:
-        return jsonify({"error": "spreadsheet_id and title required"}), 400
-
-    safe_title = re.sub(r'[^\w\-_\.]', '_', title)
-    tab_path = os.path.join(SHEETS_DIR, sid, f"{safe_title}.csv")
+    if not sid or not (title or request.args.get("sheet_id")):
+        return jsonify({"error": "spreadsheet_id and title (or sheet_id) required"}), 400
 
-    if not os.path.exists(tab_path):
+    try:
+        _, sheet_id = _tab_args(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    manifest = _load_manifest(sid)
+    entry = _find_tab(manifest, title, sheet_id) if manifest is not None else None
+    file = entry["file"] if entry is not None else _tab_file(title or "")
+    tab_path = os.path.join(SHEETS_DIR, sid, f"{file}.csv")
+
+    if not _sheet_exists(tab_path):
         return jsonify({"error": "Tab not found"}), 404
 
     try:
-        os.remove(tab_path)
+        _delete_sheet(tab_path)
+        _change_manifest(sid)
         return jsonify({"success": True})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -300,9 +3579,13 @@ def sheets_format():
         os.makedirs(sheet_dir, exist_ok=True)
 
     format_file = os.path.join(sheet_dir, f"{tab}.format.json")
+    try:
+        _format_rects(formatting)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
     try:
-        with open(format_file, "w", encoding="utf-8") as f:
+        with _atomic_write(format_file, "w", encoding="utf-8") as f:
             json.dump(formatting, f, ensure_ascii=False, indent=2)
         return jsonify({"success": True})
     except Exception as e:
@@ -319,24 +3602,23 @@ def sheets_create_filter():
     if not os.path.exists(sheet_dir):
         os.makedirs(sheet_dir, exist_ok=True)
 
-    filters_file = os.path.join(sheet_dir, f"{tab}.filters.json")
-
-    # Load existing filters if any
-    filters = []
-    if os.path.exists(filters_file):
-        with open(filters_file, "r", encoding="utf-8") as f:
-            filters = json.load(f)
-
-    filters.append({
-        "filter_id": int(datetime.datetime.now().timestamp()),
-        "filter": filter_config,
-        "created_at": datetime.datetime.now().isoformat()
-    })
-
+    # Any config is stored, as before views existed; /sheets/filter-view
+    # reports one it cannot evaluate
+    filters_file = _filters_path(sid, tab)
     try:
-        with open(filters_file, "w", encoding="utf-8") as f:
-            json.dump(filters, f, ensure_ascii=False, indent=2)
-        return jsonify({"success": True})
+        with _file_lock(filters_file):
+            filters = _load_filters(sid, tab)
+            # Ids stay timestamps, but two filters made in one second must not share one
+            filter_id = max([int(datetime.datetime.now().timestamp())]
+                            + [f["filter_id"] + 1 for f in filters])
+            filters.append({
+                "filter_id": filter_id,
+                "filter": filter_config,
+                "created_at": datetime.datetime.now().isoformat()
+            })
+            with _atomic_write(filters_file, "w", encoding="utf-8") as f:
+                json.dump(filters, f, ensure_ascii=False, indent=2)
+        return jsonify({"success": True, "filter_id": filter_id})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -376,48 +3658,1525 @@ def sheets_conditional_format():
         os.makedirs(sheet_dir, exist_ok=True)
 
     cond_file = os.path.join(sheet_dir, f"{tab}.conditional.json")
-    rules = []
-    if os.path.exists(cond_file):
-        with open(cond_file, "r", encoding="utf-8") as f:
-            rules = json.load(f)
-
-    rules.append({
-        "rule": rule,
-        "created_at": datetime.datetime.now().isoformat()
-    })
+    try:
+        _compile_rule(rule)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
     try:
-        with open(cond_file, "w", encoding="utf-8") as f:
-            json.dump(rules, f, ensure_ascii=False, indent=2)
+        with _file_lock(cond_file):
+            rules = _load_json_list(cond_file) or []
+            rules.append({
+                "rule": rule,
+                "created_at": datetime.datetime.now().isoformat()
+            })
+            with _atomic_write(cond_file, "w", encoding="utf-8") as f:
+                json.dump(rules, f, ensure_ascii=False, indent=2)
         return jsonify({"success": True})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# --- Sheet query engine ------------------------------------------------------
+#
+# SQL subset evaluated row by row while the CSV is being read:
+#
+#   SELECT * | col [AS alias] | AGG(col|*) [AS alias], ...  [FROM <ignored>]
+#   [WHERE predicate] [GROUP BY col, ...]
+#   [ORDER BY col|AGG(col) [ASC|DESC], ...] [LIMIT n] [OFFSET m]
+#
+# Only rows that pass WHERE are kept. Without ORDER BY the scan stops once
+# LIMIT is satisfied; with ORDER BY + LIMIT only the top rows are held.
+
+class QueryError(ValueError):
+    pass
+
+_QUERY_TOKEN = re.compile(r"""\s*(?:
+      (?P<num>\d+\.?\d*(?:[eE][-+]?\d+)?|\.\d+)
+    | '(?P<str>(?:[^']|'')*)'
+    | "(?P<qid>(?:[^"]|"")*)"
+    | `(?P<bid>[^`]*)`
+    | (?P<op><=|>=|<>|!=|=|<|>|\(|\)|,|\*|-)
+    | (?P<word>[A-Za-z_][\w.]*)
+    )""", re.X)
+
+_QUERY_KEYWORDS = {
+    "SELECT", "FROM", "WHERE", "GROUP", "ORDER", "BY", "ASC", "DESC", "LIMIT",
+    "OFFSET", "AND", "OR", "NOT", "LIKE", "IN", "IS", "NULL", "AS", "BETWEEN",
+}
+_QUERY_AGGREGATES = {"COUNT", "SUM", "AVG", "MIN", "MAX"}
+_QUERY_COMPARE = {
+    "=": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    "<>": lambda a, b: a != b,
+    "<": lambda a, b: a < b,
+    "<=": lambda a, b: a <= b,
+    ">": lambda a, b: a > b,
+    ">=": lambda a, b: a >= b,
+}
+
+def _parse_number(value):
+    if isinstance(value, (int, float)):
+        return value
+    if not value:
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def _text(value):
+    # Cells from columnar sheets arrive typed; text contexts see them as written
+    if value.__class__ is str:
+        return value
+    return "" if value is None else str(value)
+
+def _sort_value(value):
+    # Numbers sort before text, empty cells last
+    if value is None or value == "":
+        return (2, "")
+    number = _parse_number(value)
+    if number is not None:
+        return (0, number)
+    return (1, value)
+
+def _tokenize_query(query):
+    tokens = []
+    pos = 0
+    query = query.strip()
+    while pos < len(query):
+        m = _QUERY_TOKEN.match(query, pos)
+        if not m or m.end() == pos:
+            raise QueryError(f"Unexpected input at: {query[pos:pos + 20]!r}")
+        pos = m.end()
+        if m.group("num") is not None:
+            tokens.append(("lit", _parse_number(m.group("num"))))
+        elif m.group("str") is not None:
+            tokens.append(("lit", m.group("str").replace("''", "'")))
+        elif m.group("qid") is not None:
+            tokens.append(("id", m.group("qid").replace('""', '"')))
+        elif m.group("bid") is not None:
+            tokens.append(("id", m.group("bid")))
+        elif m.group("op") is not None:
+            tokens.append(("op", m.group("op")))
+        else:
+            word = m.group("word")
+            if word.upper() in _QUERY_KEYWORDS:
+                tokens.append(("kw", word.upper()))
+            else:
+                tokens.append(("id", word))
+    return tokens
+
+class _QueryParser:
+    def __init__(self, query):
+        self.tokens = _tokenize_query(query)
+        self.pos = 0
+
+    def peek(self, offset=0):
+        i = self.pos + offset
+        return self.tokens[i] if i < len(self.tokens) else (None, None)
+
+    def take(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def accept(self, kind, value=None):
+        k, v = self.peek()
+        if k == kind and (value is None or v == value):
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, kind, value=None):
+        k, v = self.peek()
+        if not self.accept(kind, value):
+            raise QueryError(f"Expected {value or kind}, got {v!r}")
+        return v
+
+    def parse(self):
+        plan = {"select": [], "where": None, "group_by": [], "order_by": [],
+                "limit": None, "offset": 0}
+        self.expect("kw", "SELECT")
+        plan["select"].append(self.select_item())
+        while self.accept("op", ","):
+            plan["select"].append(self.select_item())
+        if self.accept("kw", "FROM"):
+            self.take()
+        if self.accept("kw", "WHERE"):
+            plan["where"] = self.or_expr()
+        if self.accept("kw", "GROUP"):
+            self.expect("kw", "BY")
+            plan["group_by"].append(self.expect("id"))
+            while self.accept("op", ","):
+                plan["group_by"].append(self.expect("id"))
+        if self.accept("kw", "ORDER"):
+            self.expect("kw", "BY")
+            while True:
+                item = self.select_item(allow_alias=False)
+                desc = False
+                if self.accept("kw", "DESC"):
+                    desc = True
+                else:
+                    self.accept("kw", "ASC")
+                plan["order_by"].append((item, desc))
+                if not self.accept("op", ","):
+                    break
+        while self.peek()[0] == "kw" and self.peek()[1] in ("LIMIT", "OFFSET"):
+            clause = self.take()[1].lower()
+            value = self.expect("lit")
+            if not isinstance(value, int) or value < 0:
+                raise QueryError(f"{clause.upper()} must be a non-negative integer")
+            plan[clause] = value
+        if self.peek()[0] is not None:
+            raise QueryError(f"Unexpected token: {self.peek()[1]!r}")
+        return plan
+
+    def select_item(self, allow_alias=True):
+        if self.accept("op", "*"):
+            item = {"kind": "star"}
+        else:
+            name = self.expect("id")
+            if name.upper() in _QUERY_AGGREGATES and self.accept("op", "("):
+                func = name.upper()
+                if self.accept("op", "*"):
+                    if func != "COUNT":
+                        raise QueryError(f"{func}(*) is not supported")
+                    arg = None
+                else:
+                    arg = self.expect("id")
+                self.expect("op", ")")
+                label = f"{func}({'*' if arg is None else arg})"
+                item = {"kind": "agg", "func": func, "arg": arg, "label": label}
+            else:
+                item = {"kind": "col", "name": name, "label": name}
+        if allow_alias and item["kind"] != "star" and self.accept("kw", "AS"):
+            item["label"] = self.expect("id")
+        return item
+
+    def or_expr(self):
+        node = self.and_expr()
+        while self.accept("kw", "OR"):
+            node = ("or", node, self.and_expr())
+        return node
+
+    def and_expr(self):
+        node = self.not_expr()
+        while self.accept("kw", "AND"):
+            node = ("and", node, self.not_expr())
+        return node
+
+    def not_expr(self):
+        if self.accept("kw", "NOT"):
+            return ("not", self.not_expr())
+        if self.accept("op", "("):
+            node = self.or_expr()
+            self.expect("op", ")")
+            return node
+        return self.predicate()
+
+    def operand(self):
+        if self.accept("op", "-"):
+            value = self.expect("lit")
+            if not isinstance(value, (int, float)):
+                raise QueryError("Expected a number after '-'")
+            return ("lit", -value)
+        if self.accept("kw", "NULL"):
+            return ("lit", None)
+        kind, value = self.take()
+        if kind == "lit":
+            return ("lit", value)
+        if kind == "id":
+            return ("col", value)
+        raise QueryError(f"Expected a column or literal, got {value!r}")
+
+    def predicate(self):
+        left = self.operand()
+        if self.accept("kw", "IS"):
+            negate = self.accept("kw", "NOT")
+            self.expect("kw", "NULL")
+            return ("null", left, negate)
+        negate = self.accept("kw", "NOT")
+        if self.accept("kw", "LIKE"):
+            pattern = self.expect("lit")
+            return ("like", left, str(pattern), negate)
+        if self.accept("kw", "IN"):
+            self.expect("op", "(")
+            values = [self.operand()]
+            while self.accept("op", ","):
+                values.append(self.operand())
+            self.expect("op", ")")
+            return ("in", left, [v for k, v in values if k == "lit"], negate)
+        if self.accept("kw", "BETWEEN"):
+            low = self.operand()
+            self.expect("kw", "AND")
+            high = self.operand()
+            return ("between", left, low, high, negate)
+        if negate:
+            raise QueryError("Expected LIKE, IN or BETWEEN after NOT")
+        kind, op = self.take()
+        if kind != "op" or op not in _QUERY_COMPARE:
+            raise QueryError(f"Expected a comparison operator, got {op!r}")
+        return ("cmp", op, left, self.operand())
+
+def _parse_query(query):
+    return _QueryParser(query).parse()
+
+def _column_index(headers, name):
+    if name in headers:
+        return headers.index(name)
+    lowered = [h.lower() for h in headers]
+    if name.lower() in lowered:
+        return lowered.index(name.lower())
+    raise QueryError(f"Unknown column: {name}")
+
+def _cell_getter(index):
+    def get(row):
+        return row[index] if index < len(row) else ""
+    return get
+
+def _compile_operand(headers, operand):
+    kind, value = operand
+    if kind == "col":
+        return _cell_getter(_column_index(headers, value)), False, None
+    return (lambda row: value), True, value
+
+def _compile_compare(op, a, b):
+    get_a, lit_a, val_a = a
+    get_b, lit_b, val_b = b
+    compare = _QUERY_COMPARE[op]
+    literal_is_number = (lit_a and isinstance(val_a, (int, float))) or \
+        (lit_b and isinstance(val_b, (int, float)))
+    if literal_is_number:
+        def pred(row):
+            x = _parse_number(get_a(row))
+            y = _parse_number(get_b(row))
+            return x is not None and y is not None and compare(x, y)
+    elif (lit_a and val_a is None) or (lit_b and val_b is None):
+        return lambda row: False
+    elif lit_a or lit_b:
+        def pred(row):
+            return compare(_text(get_a(row)), _text(get_b(row)))
+    else:
+        # Column vs column: numeric when both sides parse, text otherwise
+        def pred(row):
+            x, y = get_a(row), get_b(row)
+            nx, ny = _parse_number(x), _parse_number(y)
+            if nx is not None and ny is not None:
+                return compare(nx, ny)
+            return compare(_text(x), _text(y))
+    return pred
+
+def _compile_predicate(headers, node):
+    kind = node[0]
+    if kind in ("and", "or"):
+        left = _compile_predicate(headers, node[1])
+        right = _compile_predicate(headers, node[2])
+        if kind == "and":
+            return lambda row: left(row) and right(row)
+        return lambda row: left(row) or right(row)
+    if kind == "not":
+        inner = _compile_predicate(headers, node[1])
+        return lambda row: not inner(row)
+    if kind == "cmp":
+        _, op, a, b = node
+        return _compile_compare(op, _compile_operand(headers, a), _compile_operand(headers, b))
+    if kind == "null":
+        _, operand, negate = node
+        get = _compile_operand(headers, operand)[0]
+        return lambda row: (get(row) not in ("", None)) == negate
+    if kind == "like":
+        _, operand, pattern, negate = node
+        get = _compile_operand(headers, operand)[0]
+        regex = re.compile("".join(
+            ".*" if ch == "%" else "." if ch == "_" else re.escape(ch) for ch in pattern
+        ) + r"\Z", re.S)
+        return lambda row: bool(regex.match(_text(get(row)))) != negate
+    if kind == "in":
+        _, operand, values, negate = node
+        get = _compile_operand(headers, operand)[0]
+        texts = {v for v in values if isinstance(v, str)}
+        numbers = {v for v in values if isinstance(v, (int, float))}
+        def pred(row):
+            cell = get(row)
+            hit = _text(cell) in texts or (bool(numbers) and _parse_number(cell) in numbers)
+            return hit != negate
+        return pred
+    if kind == "between":
+        _, operand, low, high, negate = node
+        value = _compile_operand(headers, operand)
+        above = _compile_compare(">=", value, _compile_operand(headers, low))
+        below = _compile_compare("<=", value, _compile_operand(headers, high))
+        return lambda row: (above(row) and below(row)) != negate
+    raise QueryError(f"Unsupported expression: {kind}")
+
+class _Aggregate:
+    __slots__ = ("func", "get", "count", "total", "all_int", "best")
+
+    def __init__(self, func, get):
+        self.func = func
+        self.get = get
+        self.count = 0
+        self.total = 0
+        self.all_int = True
+        self.best = None
+
+    def add(self, row):
+        if self.get is None:
+            self.count += 1
+            return
+        cell = self.get(row)
+        if cell == "":
+            return
+        if self.func == "COUNT":
+            self.count += 1
+        elif self.func in ("SUM", "AVG"):
+            number = _parse_number(cell)
+            if number is not None:
+                self.count += 1
+                self.total += number
+                self.all_int = self.all_int and isinstance(number, int)
+        else:
+            key = _sort_value(cell)
+            if self.best is None or (key < self.best if self.func == "MIN" else key > self.best):
+                self.best = key
+
+    def result(self):
+        if self.func == "COUNT":
+            return self.count
+        if self.func == "SUM":
+            return self.total if self.all_int else float(self.total)
+        if self.func == "AVG":
+            return self.total / self.count if self.count else None
+        return None if self.best is None else self.best[1]
+
+class _OrderKey:
+    __slots__ = ("values", "desc")
+
+    def __init__(self, values, desc):
+        self.values = values
+        self.desc = desc
+
+    def __lt__(self, other):
+        for a, b, desc in zip(self.values, other.values, self.desc):
+            if a != b:
+                return a > b if desc else a < b
+        return False
+
+def _order_rows(rows, getters, desc, limit):
+    # Sort (or keep only the top `limit`) by the typed values of `getters`
+    def key(row):
+        return _OrderKey([_sort_value(get(row)) for get in getters], desc)
+    if limit is None:
+        return sorted(rows, key=key)
+    return heapq.nsmallest(limit, rows, key=key)
+
+def _compile_group_filter(headers, node, sheet):
+    # Conservative check, from a columnar sheet's per-group min/max, whether
+    # any row in a row group can satisfy the WHERE predicate
+    kind = node[0]
+    if kind in ("and", "or"):
+        left = _compile_group_filter(headers, node[1], sheet)
+        right = _compile_group_filter(headers, node[2], sheet)
+        if kind == "and":
+            return lambda group: left(group) and right(group)
+        return lambda group: left(group) or right(group)
+    if kind == "cmp":
+        _, op, a, b = node
+        if a[0] == "lit" and b[0] == "col":
+            op = {"<": ">", "<=": ">=", ">": "<", ">=": "<="}.get(op, op)
+            a, b = b, a
+        if a[0] == "col" and b[0] == "lit" and isinstance(b[1], (int, float)):
+            index, value = _column_index(headers, a[1]), b[1]
+            return lambda group: _range_may_match(op, sheet.group_range(index, group), value, value)
+    if kind == "between" and not node[4] and node[1][0] == "col":
+        low, high = node[2], node[3]
+        if low[0] == high[0] == "lit" and all(isinstance(v[1], (int, float)) for v in (low, high)):
+            index = _column_index(headers, node[1][1])
+            return lambda group: _range_may_match("between", sheet.group_range(index, group), low[1], high[1])
+    return lambda group: True
+
+def _range_may_match(op, value_range, low, high):
+    if value_range == "text":
+        return True
+    if value_range is None:
+        return False  # no numeric cells in this group
+    lo, hi = value_range
+    if op == "=":
+        return lo <= low <= hi
+    if op in ("!=", "<>"):
+        return not (lo == hi == low)
+    if op == "<":
+        return lo < low
+    if op == "<=":
+        return lo <= low
+    if op == ">":
+        return hi > low
+    if op == ">=":
+        return hi >= low
+    return lo <= high and hi >= low
+
+def _execute_query(plan, headers, rows, typed=False):
+    # Returns (output headers, iterator of output rows); `rows` is consumed lazily.
+    # typed rows (from columnar sheets) are converted back to text on output.
+    if plan["where"] is not None:
+        pred = _compile_predicate(headers, plan["where"])
+        rows = (row for row in rows if pred(row))
+
+    select = plan["select"]
+    offset, limit = plan["offset"], plan["limit"]
+    stop = None if limit is None else offset + limit
+    grouped = bool(plan["group_by"]) or any(item["kind"] == "agg" for item in select)
+
+    if not grouped:
+        out_headers, indexes = [], []
+        for item in select:
+            if item["kind"] == "star":
+                out_headers.extend(headers)
+                indexes.extend(range(len(headers)))
+            elif item["kind"] == "col":
+                out_headers.append(item["label"])
+                indexes.append(_column_index(headers, item["name"]))
+        if plan["order_by"]:
+            aliases = {item["label"]: item["name"] for item in select if item["kind"] == "col"}
+            getters, desc = [], []
+            for item, is_desc in plan["order_by"]:
+                if item["kind"] != "col":
+                    raise QueryError("ORDER BY aggregate requires GROUP BY")
+                name = item["name"] if item["name"] in headers else aliases.get(item["name"], item["name"])
+                getters.append(_cell_getter(_column_index(headers, name)))
+                desc.append(is_desc)
+            rows = iter(_order_rows(rows, getters, desc, stop))
+        rows = itertools.islice(rows, offset, stop)
+        if len(select) == 1 and select[0]["kind"] == "star":
+            if typed:
+                return out_headers, ([_text(v) for v in row] for row in rows)
+            return out_headers, rows
+        getters = [_cell_getter(i) for i in indexes]
+        return out_headers, ([_text(get(row)) for get in getters] for row in rows)
+
+    group_indexes = [_column_index(headers, name) for name in plan["group_by"]]
+    factories = []
+    for item in select:
+        if item["kind"] == "star":
+            raise QueryError("SELECT * cannot be combined with aggregates")
+        if item["kind"] == "col":
+            index = _column_index(headers, item["name"])
+            if index not in group_indexes:
+                raise QueryError(f"Column {item['name']} must appear in GROUP BY")
+            factories.append(("key", group_indexes.index(index)))
+        else:
+            get = None if item["arg"] is None else _cell_getter(_column_index(headers, item["arg"]))
+            factories.append(("agg", item["func"], get))
+
+    groups = {}
+    for row in rows:
+        key = tuple(_text(row[i]) if i < len(row) else "" for i in group_indexes)
+        states = groups.get(key)
+        if states is None:
+            states = groups[key] = [_Aggregate(f[1], f[2]) for f in factories if f[0] == "agg"]
+        for state in states:
+            state.add(row)
+    if not groups and not group_indexes:
+        groups[()] = [_Aggregate(f[1], f[2]) for f in factories if f[0] == "agg"]
+
+    out_headers = [item["label"] for item in select]
+    out_rows = []
+    for key, states in groups.items():
+        results = iter([state.result() for state in states])
+        out_rows.append([key[f[1]] if f[0] == "key" else next(results) for f in factories])
+
+    if plan["order_by"]:
+        getters, desc = [], []
+        lowered = [h.lower() for h in out_headers]
+        for item, is_desc in plan["order_by"]:
+            for candidate in (item["label"], item.get("name")):
+                if candidate and candidate.lower() in lowered:
+                    getters.append(_cell_getter(lowered.index(candidate.lower())))
+                    break
+            else:
+                raise QueryError(f"ORDER BY {item['label']} must be a selected column")
+            desc.append(is_desc)
+        out_rows = _order_rows(out_rows, getters, desc, stop)
+    return out_headers, itertools.islice(out_rows, offset, stop)
+
 @app.route("/sheets/query", methods=["POST"])
 def sheets_query():
     data = request.json
     sid = data["spreadsheet_id"]
     query = data["query"]
 
-    path = os.path.join(SHEETS_DIR, f"{sid}.csv")
-    if not os.path.exists(path):
+    path, _, error = _sheet_path(sid, data)
+    if error:
+        return error
+    if not _sheet_exists(path):
         return jsonify({"error": "Spreadsheet not found"}), 404
 
-    with open(path, "r", newline="", encoding="utf-8") as f:
-        reader = csv.reader(f)
-        rows = list(reader)
+    try:
+        plan = _parse_query(query)
+        with _file_lock(path, shared=True):
+            sheet = _open_columnar(path)
+            typed = sheet is not None and sheet.rows > 0 and \
+                not os.path.exists(_sidecar_path(path, "delta"))
+        if typed:
+            # Scan typed columns directly, skipping row groups ruled out by min/max
+            headers = list(sheet.first_row)
+            group_filter = None
+            if plan["where"] is not None:
+                group_filter = _compile_group_filter(headers, plan["where"], sheet)
+            rows = sheet.iter_rows(1, typed=True, group_filter=group_filter)
+        else:
+            rows = _sheet_rows(path)
+            headers = next(rows, None)
+        if headers is None:
+            return jsonify({"headers": [], "rows": []})
+        out_headers, rows = _execute_query(plan, headers, rows, typed=typed)
+        mode = _stream_mode(data)
+        if mode:
+            return _stream_response(mode, rows, head={"headers": out_headers}, key="rows")
+        return jsonify({"headers": out_headers, "rows": list(rows)})
+    except QueryError as e:
+        return jsonify({"error": str(e)}), 400
+
+# --- Filter views ------------------------------------------------------------
+#
+# Filters saved by /sheets/create-filter can be read as views:
+# /sheets/filter-view returns only the matching rows. A filter it can
+# evaluate is either {"where": "<WHERE clause of /sheets/query>"} or
+# {"conditions": [{"column", "op", "value"}, ...], "match": "all" | "any"}.
+# Both compile to the query engine's predicates. Other shapes are still
+# stored, but their view answers 400. Each worker caches the matching row numbers of a
+# view, keyed by the sheet's signature, in an LRU of FILTER_VIEW_CACHE_ENTRIES.
+# Writers keep the cached views current under the sheet lock: appends
+# test only the new rows, batch updates retest only the rows they touch,
+# and compaction keeps the views unchanged. Any other write (or a write by
+# another worker) changes the signature, and the view is rebuilt on its
+# next read. A cached view is read at the cost of the page it returns.
+
+FILTER_VIEW_CACHE_ENTRIES = int(os.getenv("FILTER_VIEW_CACHE_ENTRIES", 256))
+
+_FILTER_OPS = {"=", "!=", "<>", "<", "<=", ">", ">=", "contains", "not_contains", "is_empty", "not_empty"}
+
+def _filters_path(sid, tab):
+    return os.path.join(SHEETS_DIR, sid, f"{tab}.filters.json")
+
+def _load_filters(sid, tab):
+    try:
+        with open(_filters_path(sid, tab), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
+
+def _filter_sheet_path(sid, tab):
+    # The tab file, or the spreadsheet itself for its single implicit tab
+    resolved = _resolve_tab(sid, tab)
+    if resolved is None or not _sheet_exists(resolved[0]):
+        return None
+    return resolved[0]
+
+def _filter_node(config):
+    # Predicate tree of a saved filter; raises QueryError
+    if not isinstance(config, dict):
+        raise QueryError("filter_config must be an object")
+    if isinstance(config.get("where"), str):
+        parser = _QueryParser(config["where"])
+        node = parser.or_expr()
+        if parser.peek()[0] is not None:
+            raise QueryError(f"Unexpected token: {parser.peek()[1]!r}")
+        return node
+    conditions = config.get("conditions")
+    if not isinstance(conditions, list) or not conditions:
+        raise QueryError("filter_config needs a where clause or a list of conditions")
+    nodes = []
+    for cond in conditions:
+        if not isinstance(cond, dict) or not isinstance(cond.get("column"), str):
+            raise QueryError("each condition needs a column")
+        op = cond.get("op", "=")
+        if op not in _FILTER_OPS:
+            raise QueryError(f"op must be one of {', '.join(sorted(_FILTER_OPS))}")
+        column = ("col", cond["column"])
+        if op in ("is_empty", "not_empty"):
+            nodes.append(("null", column, op == "not_empty"))
+        elif op in ("contains", "not_contains"):
+            nodes.append(("like", column, f"%{cond.get('value', '')}%", op == "not_contains"))
+        else:
+            nodes.append(("cmp", op, column, ("lit", cond.get("value"))))
+    joiner = "or" if config.get("match") == "any" else "and"
+    node = nodes[0]
+    for other in nodes[1:]:
+        node = (joiner, node, other)
+    return node
+
+class _FilterView:
+    __slots__ = ("signature", "headers", "pred", "matches", "total")
+
+    def __init__(self, signature, headers, pred, matches, total):
+        self.signature = signature
+        self.headers = headers
+        self.pred = pred
+        self.matches = matches  # ascending row numbers (0-based, header = 0) of matching rows
+        self.total = total      # rows in the sheet, header included
+
+class FilterViewCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # (path, filter_id, config json) -> _FilterView
+        self.lock = threading.Lock()
+
+    def get(self, key, signature):
+        with self.lock:
+            view = self.entries.get(key)
+            if view is None or view.signature != signature:
+                return None
+            self.entries.move_to_end(key)
+            return view
+
+    def put(self, key, view):
+        with self.lock:
+            self.entries[key] = view
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def _views(self, path, old_signature):
+        # Views of `path` that were current before a write; caller holds the sheet lock
+        with self.lock:
+            return [(key, view) for key, view in self.entries.items()
+                    if key[0] == path and view.signature == old_signature]
+
+    def _drop(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def appended(self, path, old_signature, rows):
+        new_signature = _sheet_signature(path)
+        for key, view in self._views(path, old_signature):
+            try:
+                for i, row in enumerate(rows):
+                    if view.pred(row):
+                        view.matches.append(view.total + i)
+            except Exception:
+                self._drop(key)
+                continue
+            view.total += len(rows)
+            view.signature = new_signature
+
+    def patched(self, path, old_signature, patches):
+        views = self._views(path, old_signature)
+        if not views:
+            return
+        new_signature = _sheet_signature(path)
+        rows = _cached_rows(path) if 0 not in patches else None
+        for key, view in views:
+            if rows is None:
+                # The header changed, or the sheet is too large to hold
+                self._drop(key)
+                continue
+            try:
+                for r in sorted(patches):
+                    i = bisect.bisect_left(view.matches, r)
+                    present = i < len(view.matches) and view.matches[i] == r
+                    hit = r < len(rows) and view.pred(rows[r])
+                    if hit and not present:
+                        view.matches.insert(i, r)
+                    elif present and not hit:
+                        del view.matches[i]
+            except Exception:
+                self._drop(key)
+                continue
+            view.total = max(view.total, len(rows))
+            view.signature = new_signature
+
+    def rebased(self, path, old_signature):
+        # Same rows under a new signature, e.g. after compaction
+        new_signature = _sheet_signature(path)
+        for _, view in self._views(path, old_signature):
+            view.signature = new_signature
+
+filter_views = FilterViewCache(FILTER_VIEW_CACHE_ENTRIES)
+
+def _build_filter_view(path, node, signature):
+    rows = _sheet_rows(path)
+    headers = next(rows, None)
+    if headers is None:
+        return _FilterView(signature, [], lambda row: False, [], 0)
+    pred = _compile_predicate(headers, node)
+    matches, total = [], 1
+    for r, row in enumerate(rows, 1):
+        if pred(row):
+            matches.append(r)
+        total += 1
+    return _FilterView(signature, headers, pred, matches, total)
+
+def _view_rows(path, row_numbers):
+    # The rows at `row_numbers` (ascending), from the cache when the sheet fits
+    rows = _cached_rows(path)
+    if rows is not None:
+        return [rows[r] if r < len(rows) else [] for r in row_numbers]
+    wanted = set(row_numbers)
+    picked = {}
+    for r, row in enumerate(_stream_sheet(path)):
+        if r in wanted:
+            picked[r] = row
+            if len(picked) == len(wanted):
+                break
+    return [picked.get(r, []) for r in row_numbers]
+
+@app.route("/sheets/filter-view", methods=["GET"])
+def sheets_filter_view():
+    sid = request.args.get("spreadsheet_id")
+    tab = request.args.get("tab") or sid
+    filter_id = request.args.get("filter_id")
+    if not sid or not filter_id:
+        return jsonify({"error": "spreadsheet_id and filter_id are required"}), 400
+    try:
+        offset, limit, _ = _paging_args()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-    if not rows:
-        return jsonify({"headers": [], "rows": []})
+    path = _filter_sheet_path(sid, tab)
+    if path is None:
+        return jsonify({"error": "Sheet not found"}), 404
+    saved = next((f for f in _load_filters(sid, tab) if str(f["filter_id"]) == filter_id), None)
+    if saved is None:
+        return jsonify({"error": "Filter not found"}), 404
 
-    headers = rows[0]
-    data_rows = rows[1:]
+    key = (path, filter_id, json.dumps(saved["filter"], sort_keys=True))
+    try:
+        node = _filter_node(saved["filter"])
+        with _file_lock(path, shared=True):
+            signature = _sheet_signature(path)
+            view = filter_views.get(key, signature)
+            if view is None:
+                view = _build_filter_view(path, node, signature)
+                if view.headers:
+                    # A sheet without a header row gets one from its next append
+                    filter_views.put(key, view)
+            end = len(view.matches) if limit is None else min(len(view.matches), offset + limit)
+            row_numbers = view.matches[offset:end]
+            values = _view_rows(path, row_numbers)
+            headers = list(view.headers)
+            total = len(view.matches)
+            version = _sheet_version(path)
+    except QueryError as e:
+        return jsonify({"error": str(e)}), 400
+
+    response = jsonify({
+        "headers": headers,
+        "values": values,
+        "row_numbers": [r + 1 for r in row_numbers],  # as in A1 notation
+        "total_matches": total,
+        "next_page_token": _encode_page_token(end) if end < total else None,
+    })
+    response.set_etag(version)
+    return response
+
+# --- Conditional format rendering --------------------------------------------
+#
+# /sheets/read?render=true returns resolved cell styles with the values:
+# the tab's base formatting (/sheets/format) with the first matching
+# conditional rule (/sheets/conditional-format) layered on top. Rules are
+# evaluated per column rather than per cell. The cells of a referenced
+# column are grouped by distinct value once, so a text rule tests each
+# distinct value only once, and numeric values are kept sorted, so a
+# numeric threshold is a bisect. A rule with a "where" clause tests each
+# row once. The resulting map from cell to rule is cached per sheet
+# version and rule set, in an LRU of STYLE_MAP_CACHE_ENTRIES maps. Each
+# read then resolves styles only for the cells it returns.
+
+STYLE_MAP_CACHE_ENTRIES = int(os.getenv("STYLE_MAP_CACHE_ENTRIES", 64))
+
+_NUMBER_CONDITIONS = {
+    "NUMBER_GREATER": ">", "NUMBER_GREATER_THAN_EQ": ">=", "NUMBER_LESS": "<",
+    "NUMBER_LESS_THAN_EQ": "<=", "NUMBER_EQ": "=", "NUMBER_NOT_EQ": "!=",
+    "NUMBER_BETWEEN": "between", "NUMBER_NOT_BETWEEN": "not_between",
+}
+_TEXT_CONDITIONS = {
+    "TEXT_CONTAINS": lambda v, x: x in v,
+    "TEXT_NOT_CONTAINS": lambda v, x: x not in v,
+    "TEXT_STARTS_WITH": lambda v, x: v.startswith(x),
+    "TEXT_ENDS_WITH": lambda v, x: v.endswith(x),
+    "TEXT_EQ": lambda v, x: v == x,
+    "BLANK": lambda v, x: v == "",
+    "NOT_BLANK": lambda v, x: v != "",
+}
+
+def _grid_range(ref):
+    # (row0, row1, col0, col1) of an A1 string or a GridRange object
+    if isinstance(ref, str):
+        return _parse_a1(ref)[1:]
+    if isinstance(ref, dict):
+        return (ref.get("startRowIndex", 0), ref.get("endRowIndex"),
+                ref.get("startColumnIndex", 0), ref.get("endColumnIndex"))
+    raise ValueError("ranges must be A1 strings or GridRange objects")
+
+def _merge_style(base, top):
+    # Shallow merge, one level deep for nested objects such as textFormat
+    merged = dict(base)
+    for key, value in top.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = {**merged[key], **value}
+        else:
+            merged[key] = value
+    return merged
+
+def _format_rects(formatting):
+    # Base formatting as (row0, row1, col0, col1, style), later entries on top
+    entries = formatting if isinstance(formatting, list) else [formatting]
+    rects = []
+    for entry in entries:
+        if not isinstance(entry, dict):
+            continue
+        style = entry.get("format", entry.get("style"))
+        refs = entry.get("ranges") or ([entry["range"]] if "range" in entry else None)
+        if style is None and refs is None:
+            rects.append((0, None, 0, None, entry))  # a bare style covers the tab
+            continue
+        for ref in refs or [{}]:
+            rects.append(_grid_range(ref) + (style or {},))
+    return rects
+
+def _compile_rule(rule):
+    # (ranges, condition, style) of a conditional rule, Sheets API shape or
+    # {"range"/"ranges", "condition", "format"}; raises ValueError
+    if not isinstance(rule, dict):
+        raise ValueError("rule must be an object")
+    body = rule.get("booleanRule", rule)
+    refs = rule.get("ranges") or ([rule["range"]] if "range" in rule else [{"startRowIndex": 1}])
+    ranges = [_grid_range(ref) for ref in refs]
+    condition = body.get("condition")
+    style = body.get("format", body.get("style"))
+    if not isinstance(condition, dict) or not isinstance(style, dict):
+        raise ValueError("rule needs a condition and a format")
+    if isinstance(condition.get("where"), str):
+        try:
+            return ranges, ("where", _filter_node(condition)), style
+        except QueryError as e:
+            raise ValueError(str(e))
+    kind = condition.get("type")
+    values = [v.get("userEnteredValue") if isinstance(v, dict) else v for v in condition.get("values", [])]
+    if kind in _NUMBER_CONDITIONS:
+        op = _NUMBER_CONDITIONS[kind]
+        numbers = [_parse_number(v) for v in values[:2 if op.endswith("between") else 1]]
+        if not numbers or None in numbers or (op.endswith("between") and len(numbers) < 2):
+            raise ValueError(f"{kind} needs numeric values")
+        return ranges, ("number", op, numbers), style
+    if kind in _TEXT_CONDITIONS:
+        text = "" if not values or values[0] is None else str(values[0])
+        return ranges, ("text", _TEXT_CONDITIONS[kind], text), style
+    raise ValueError(f"Unsupported condition type: {kind}; use one of "
+                     f"{', '.join(list(_NUMBER_CONDITIONS) + list(_TEXT_CONDITIONS))} or a where clause")
+
+class _ColumnValues:
+    # One column grouped by value: distinct text -> rows, and the distinct
+    # numeric values sorted for range lookups
+    def __init__(self, rows, col):
+        self.by_text = {}
+        for r, row in enumerate(rows):
+            self.by_text.setdefault(_text(row[col]) if col < len(row) else "", []).append(r)
+        numeric = {}
+        for value, hits in self.by_text.items():
+            number = _parse_number(value)
+            if number is not None:
+                numeric.setdefault(number, []).extend(hits)
+        self.numbers = sorted(numeric)
+        self.number_rows = [numeric[n] for n in self.numbers]
+
+    def number_hits(self, op, numbers):
+        keys, x = self.numbers, numbers[0]
+        if op == ">":
+            spans = [(bisect.bisect_right(keys, x), len(keys))]
+        elif op == ">=":
+            spans = [(bisect.bisect_left(keys, x), len(keys))]
+        elif op == "<":
+            spans = [(0, bisect.bisect_left(keys, x))]
+        elif op == "<=":
+            spans = [(0, bisect.bisect_right(keys, x))]
+        elif op == "=":
+            spans = [(bisect.bisect_left(keys, x), bisect.bisect_right(keys, x))]
+        elif op == "!=":
+            spans = [(0, bisect.bisect_left(keys, x)), (bisect.bisect_right(keys, x), len(keys))]
+        else:
+            lo, hi = sorted(numbers)
+            inside = (bisect.bisect_left(keys, lo), bisect.bisect_right(keys, hi))
+            spans = [inside] if op == "between" else [(0, inside[0]), (inside[1], len(keys))]
+        return itertools.chain.from_iterable(
+            itertools.chain.from_iterable(self.number_rows[a:b]) for a, b in spans)
+
+    def text_hits(self, test, text):
+        return itertools.chain.from_iterable(hits for value, hits in self.by_text.items() if test(value, text))
+
+class _StyleMap:
+    def __init__(self, signature, files_sig, rects, cells, rule_styles):
+        self.signature = signature
+        self.files_sig = files_sig
+        self.rects = rects              # base formatting rectangles
+        self.cells = cells              # row -> {col: index of the first matching rule}
+        self.rule_styles = rule_styles  # rule index -> style
+        # Rows split into bands at every rectangle edge; each band lists the
+        # rectangles covering all of its rows
+        self.band_starts = sorted({a for a, *_ in rects} | {b for _, b, *_ in rects if b is not None})
+        self.bands = [tuple((i, x, y) for i, (a, b, x, y, _) in enumerate(rects) if a <= lo and (b is None or lo < b))
+                      for lo in self.band_starts]
+
+    def resolve(self, rows, row0, col0):
+        # (palette, {A1: palette index}) for the cells of a window of rows
+        # whose first cell is at row0/col0
+        palette, ids, cell_styles = [], {}, {}
+        bases = {}  # (band, col) -> indexes of the rectangles covering it
+        for r, row in enumerate(rows, row0):
+            hits = self.cells.get(r, {})
+            band = bisect.bisect_right(self.band_starts, r) - 1
+            for c in range(col0, col0 + len(row)):
+                base = bases.get((band, c))
+                if base is None:
+                    spans = self.bands[band] if band >= 0 else ()
+                    base = bases[band, c] = tuple(i for i, x, y in spans if x <= c and (y is None or c < y))
+                key = (base, hits.get(c))
+                if key == ((), None):
+                    continue
+                if key not in ids:
+                    style = {}
+                    for i in base:
+                        style = _merge_style(style, self.rects[i][4])
+                    if key[1] is not None:
+                        style = _merge_style(style, self.rule_styles[key[1]])
+                    ids[key] = len(palette)
+                    palette.append(style)
+                cell_styles[f"{_column_letters(c)}{r + 1}"] = ids[key]
+        return palette, cell_styles
+
+def _load_json_list(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
 
-    # Extremely basic query parser: SELECT * ONLY
-    if query.strip().upper() == "SELECT *":
-        return jsonify({"headers": headers, "rows": data_rows})
+def _build_style_map(path, sid, tab, signature, files_sig):
+    sheet_dir = os.path.join(SHEETS_DIR, sid)
+    formatting = _load_json_list(os.path.join(sheet_dir, f"{tab}.format.json"))
+    saved = _load_json_list(os.path.join(sheet_dir, f"{tab}.conditional.json")) or []
+    rects = _format_rects(formatting) if formatting is not None else []
+    rules = [_compile_rule(entry["rule"]) for entry in saved]
+
+    rows = _cached_rows(path)
+    if rows is None:
+        rows = list(_stream_sheet(path)) if rules else []
+    sheet_width = max((len(row) for row in rows), default=0)
+    columns = {}
+    cells = {}
+    rule_styles = {}
+    for k, (ranges, condition, style) in enumerate(rules):
+        rule_styles[k] = style
+        for row0, row1, col0, col1 in ranges:
+            stop_row = len(rows) if row1 is None else min(row1, len(rows))
+            width = sheet_width if col1 is None else min(col1, sheet_width)
+            if condition[0] == "where":
+                pred = _compile_predicate(rows[0] if rows else [], condition[1])
+                for r in range(max(row0, 1), stop_row):
+                    if pred(rows[r]):
+                        marks = cells.setdefault(r, {})
+                        for c in range(col0, width):
+                            marks.setdefault(c, k)
+                continue
+            for c in range(col0, width):
+                values = columns.get(c)
+                if values is None:
+                    values = columns[c] = _ColumnValues(rows, c)
+                if condition[0] == "number":
+                    hits = values.number_hits(condition[1], condition[2])
+                else:
+                    hits = values.text_hits(condition[1], condition[2])
+                for r in hits:
+                    if row0 <= r < stop_row:
+                        cells.setdefault(r, {}).setdefault(c, k)
+    return _StyleMap(signature, files_sig, rects, cells, rule_styles)
+
+def _rendered_read(path, sid, tab, row0, row1, col0, col1, offset, limit):
+    # /sheets/read?render=true: a window of values plus resolved styles
+    start = row0 + offset
+    stop = row1
+    if limit is not None:
+        stop = start + limit if stop is None else min(stop, start + limit)
+    try:
+        with _file_lock(path, shared=True):
+            # The styles depend on the format and rule files as well as the
+            # sheet, so the tag covers both
+            version = _sheet_version(path)
+            files_sig = _style_files_sig(sid, tab)
+            if version:
+                version += "." + hashlib.sha1(repr(files_sig).encode()).hexdigest()[:8]
+                if request.if_none_match.contains(version):
+                    return Response(status=304, headers={"ETag": f'"{version}"'})
+            style_map = _style_map(path, sid, tab)
+            window, total = _read_row_window(path, start, stop)
+    except (ValueError, QueryError) as e:
+        return jsonify({"error": f"Invalid formatting rule: {e}"}), 400
+    if col0 or col1 is not None:
+        window = [row[col0:col1] for row in window]
+    palette, cell_styles = style_map.resolve(window, start, col0)
+    end = start + len(window)
+    more = len(window) > 0 and end < total and (row1 is None or end < row1)
+    response = jsonify({
+        "values": window,
+        "styles": palette,
+        "cell_styles": cell_styles,
+        "total_rows": total,
+        "next_page_token": _encode_page_token(end - row0) if more else None,
+    })
+    response.set_etag(version)
+    return response
 
-    return jsonify({"error": "Only 'SELECT *' supported for now"}), 400
+def _style_files_sig(sid, tab):
+    sheet_dir = os.path.join(SHEETS_DIR, sid)
+    return tuple(_file_signature(os.path.join(sheet_dir, f"{tab}.{kind}.json"))
+                 for kind in ("format", "conditional"))
+
+_style_maps = OrderedDict()  # (path, sid, tab) -> _StyleMap
+_style_maps_lock = threading.Lock()
+
+def _style_map(path, sid, tab):
+    # Cached style map for the current sheet version and rule files; the
+    # caller holds the sheet lock (shared)
+    signature = _sheet_signature(path)
+    files_sig = _style_files_sig(sid, tab)
+    key = (path, sid, tab)
+    with _style_maps_lock:
+        cached = _style_maps.get(key)
+        if cached is not None and cached.signature == signature and cached.files_sig == files_sig:
+            _style_maps.move_to_end(key)
+            return cached
+    style_map = _build_style_map(path, sid, tab, signature, files_sig)
+    with _style_maps_lock:
+        _style_maps[key] = style_map
+        _style_maps.move_to_end(key)
+        while len(_style_maps) > STYLE_MAP_CACHE_ENTRIES:
+            _style_maps.popitem(last=False)
+    return style_map
+
+# --- Full-text search --------------------------------------------------------
+#
+# BM25-ranked inverted index over the documents in DOCS_DIR and the text
+# files under BASE_DIR. Each worker builds its index in the background at
+# startup. Docs and drive write handlers then reindex the one file they
+# changed. A periodic resync (stat only, off the request path) picks up
+# files changed by other workers or processes. Hits are checked against the
+# file before a snippet is cut, so a changed or deleted file never
+# produces a stale snippet.
+
+SEARCH_MAX_FILE_BYTES = int(os.getenv("SEARCH_MAX_FILE_BYTES", 4 * 1024 * 1024))
+SEARCH_RESYNC_SECONDS = float(os.getenv("SEARCH_RESYNC_SECONDS", 60))
+SEARCH_SNIPPET_CHARS = 160
+_BM25_K1, _BM25_B = 1.2, 0.75
+
+_SEARCH_TOKEN = re.compile(r"\w+")
+_TEXT_MIMETYPES = {"application/json", "application/xml", "application/javascript",
+                   "application/x-sh", "application/x-yaml", "application/yaml"}
+
+def _search_tokens(text):
+    return [t.lower() for t in _SEARCH_TOKEN.findall(text)]
+
+def _searchable(path):
+    # Docs are their .txt bodies; drive files must look like text. Hidden
+    # entries (the trash, sheet sidecars) are never indexed.
+    if any(part.startswith(".") for part in pathlib.PurePath(os.path.relpath(path, _search_root(path))).parts):
+        return False
+    if _under(path, str(DOCS_DIR)):
+        return os.path.dirname(path) == str(DOCS_DIR) and path.endswith(".txt")
+    mimetype, _ = mimetypes.guess_type(path)
+    return mimetype is not None and (mimetype.startswith("text/") or mimetype in _TEXT_MIMETYPES)
+
+def _search_root(path):
+    return str(DOCS_DIR) if _under(path, str(DOCS_DIR)) else BASE_DIR
+
+def _search_signature(path):
+    # Docs carry pending edits in a delta log beside the file
+    signature = _file_signature(path)
+    if signature is None or not _under(path, str(DOCS_DIR)):
+        return signature
+    return signature + (_file_signature(_sidecar_path(path, "delta")),)
+
+def _search_text(path):
+    if _under(path, str(DOCS_DIR)):
+        return _read_doc(path)
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read(SEARCH_MAX_FILE_BYTES)
+
+def _search_hit(path):
+    if _under(path, str(DOCS_DIR)):
+        return {"source": "docs", "document_id": os.path.basename(path)[:-len(".txt")]}
+    return {"source": "drive", "path": os.path.relpath(path, BASE_DIR)}
+
+class SearchIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ids = {}        # path -> doc id
+        self.docs = {}       # doc id -> (path, signature, length, terms)
+        self.postings = {}   # term -> {doc id: term frequency}
+        self.total_length = 0
+        self.next_id = 0
+        self.ready = False
+        self.pid = None
+        self.pending = queue.Queue()
+
+    def start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.ready = False
+        threading.Thread(target=self._run, name="search-index", daemon=True).start()
+
+    def refresh(self, path, defer=False):
+        # Called by write handlers: files are reindexed now, directories
+        # (moved or deleted trees) and deferred files by the background
+        # thread. Small edits to large documents defer, so they stay cheap.
+        path = os.path.normpath(str(path))
+        if defer or os.path.isdir(path):
+            self.pending.put(path)
+        else:
+            self._index_file(path)
+        self._drop_missing(path)
+
+    def search(self, query, limit=10, offset=0, source=None, match_all=False):
+        if self.pid != os.getpid():
+            self.start()
+        terms = list(dict.fromkeys(_search_tokens(query)))
+        if not terms:
+            return [], 0, self.ready
+        with self.lock:
+            n = len(self.docs)
+            avg_length = self.total_length / n if n else 0
+            scores = {}
+            matched = {}
+            for term in terms:
+                postings = self.postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+                for doc_id, tf in postings.items():
+                    length = self.docs[doc_id][2]
+                    norm = tf + _BM25_K1 * (1 - _BM25_B + _BM25_B * length / avg_length)
+                    scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (_BM25_K1 + 1) / norm
+                    matched[doc_id] = matched.get(doc_id, 0) + 1
+            candidates = [
+                (score, self.docs[doc_id][0]) for doc_id, score in scores.items()
+                if (not match_all or matched[doc_id] == len(terms))
+                and (source is None or _search_hit(self.docs[doc_id][0])["source"] == source)
+            ]
+            ready = self.ready
+        top = heapq.nlargest(offset + limit, candidates)[offset:]
+        results = []
+        for score, path in top:
+            snippet = self._snippet(path, terms)
+            if snippet is None:
+                continue
+            results.append({**_search_hit(path), "score": round(score, 4), "snippet": snippet})
+        return results, len(candidates), ready
+
+    def _snippet(self, path, terms):
+        # Text around the first match, or None for a hit that no longer
+        # holds because the file changed or went away since it was indexed
+        try:
+            text = _search_text(path)
+        except (FileNotFoundError, NotADirectoryError, UnicodeDecodeError):
+            self._drop_missing(path)
+            return None
+        with self.lock:
+            doc_id = self.ids.get(path)
+            signature = self.docs[doc_id][1] if doc_id is not None else None
+        pattern = re.compile(r"\b(?:" + "|".join(re.escape(t) for t in terms) + r")\b", re.IGNORECASE)
+        match = pattern.search(text)
+        if signature != _search_signature(path):
+            self._index_file(path)
+            if match is None:
+                return None
+        start = max(0, match.start() - SEARCH_SNIPPET_CHARS // 2) if match else 0
+        snippet = " ".join(text[start:start + SEARCH_SNIPPET_CHARS].split())
+        return ("..." if start else "") + snippet + ("..." if start + SEARCH_SNIPPET_CHARS < len(text) else "")
+
+    def _index_file(self, path):
+        signature = _search_signature(path)
+        tokens = None
+        if signature is not None and signature[1] <= SEARCH_MAX_FILE_BYTES and _searchable(path):
+            try:
+                tokens = _search_tokens(_search_text(path))
+            except (FileNotFoundError, IsADirectoryError, UnicodeDecodeError):
+                tokens = None
+        counts = {}
+        for token in tokens or ():
+            counts[token] = counts.get(token, 0) + 1
+        with self.lock:
+            self._remove(path)
+            if tokens is None:
+                return
+            doc_id = self.next_id
+            self.next_id += 1
+            self.ids[path] = doc_id
+            self.docs[doc_id] = (path, signature, len(tokens), tuple(counts))
+            self.total_length += len(tokens)
+            for term, tf in counts.items():
+                self.postings.setdefault(term, {})[doc_id] = tf
+
+    def _remove(self, path):
+        doc_id = self.ids.pop(path, None)
+        if doc_id is None:
+            return
+        _, _, length, terms = self.docs.pop(doc_id)
+        self.total_length -= length
+        for term in terms:
+            postings = self.postings[term]
+            del postings[doc_id]
+            if not postings:
+                del self.postings[term]
+
+    def _drop_missing(self, path):
+        # Forget `path` and anything indexed below it that no longer exists
+        prefix = path.rstrip(os.sep) + os.sep
+        with self.lock:
+            stale = [p for p in self.ids if (p == path or p.startswith(prefix)) and not os.path.isfile(p)]
+            for p in stale:
+                self._remove(p)
+
+    def _walk(self, root):
+        if not os.path.isdir(root):
+            return
+        pending = [root]
+        while pending:
+            try:
+                with os.scandir(pending.pop()) as it:
+                    entries = list(it)
+            except (FileNotFoundError, NotADirectoryError, PermissionError):
+                continue
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                if entry.is_dir():
+                    pending.append(entry.path)
+                    continue
+                self._sync_file(os.path.normpath(entry.path))
+
+    def _sync_file(self, path):
+        with self.lock:
+            doc_id = self.ids.get(path)
+            signature = self.docs[doc_id][1] if doc_id is not None else None
+        if signature is None or signature != _search_signature(path):
+            self._index_file(path)
+
+    def _resync(self):
+        for root in (str(DOCS_DIR), BASE_DIR):
+            self._walk(os.path.normpath(root))
+        with self.lock:
+            paths = list(self.ids)
+        for path in paths:
+            if not os.path.isfile(path):
+                self._drop_missing(path)
+
+    def _run(self):
+        while True:
+            try:
+                self._resync()
+            except Exception:
+                app.logger.exception("Search index resync failed")
+            self.ready = True
+            deadline = time.monotonic() + SEARCH_RESYNC_SECONDS
+            while (remaining := deadline - time.monotonic()) > 0:
+                try:
+                    path = self.pending.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                try:
+                    if os.path.isdir(path):
+                        self._walk(path)
+                    else:
+                        self._sync_file(path)
+                except Exception:
+                    app.logger.exception("Search indexing failed for %s", path)
+
+search_index = SearchIndex()
+
+@app.route("/search", methods=["GET"])
+def search():
+    query = request.args.get("query")
+    if not query:
+        return jsonify({"error": "query parameter required"}), 400
+    source = request.args.get("source")
+    if source not in (None, "docs", "drive"):
+        return jsonify({"error": "source must be docs or drive"}), 400
+    try:
+        limit = int(request.args.get("limit", 10))
+        offset = int(request.args.get("offset", 0))
+        if not 1 <= limit <= 100 or offset < 0:
+            raise ValueError
+    except ValueError:
+        return jsonify({"error": "limit must be 1-100 and offset >= 0"}), 400
+    match_all = request.args.get("match", "any") == "all"
+    results, total, complete = search_index.search(query, limit, offset, source, match_all)
+    return jsonify({"results": results, "total": total, "complete": complete})
+
+# --- Document edit log -------------------------------------------------------
+#
+# Small edits to a document (insert, delete, replace at character ranges)
+# are appended to a delta log beside its .txt file, one JSON line per
+# batch, instead of rewriting the file. Each worker keeps a piece table per
+# document: the text as slices of the base text and the inserted strings,
+# so an edit splices slices instead of copying the document. Tables replay
+# only the part of the log they have not yet seen, so edits made by other
+# workers arrive incrementally. The log is folded into the .txt file by the
+# compaction thread once it grows past DOC_DELTA_COMPACT_BYTES, and before
+# any read that needs the file itself (byte/line windows, streams).
+
+DOC_DELTA_COMPACT_BYTES = int(os.getenv("DOC_DELTA_COMPACT_BYTES", 1024 * 1024))
+DOC_PIECES_MAX = 4096   # a table with more pieces is collapsed back into one string
+DOC_TABLES_MAX = 64     # documents whose tables are kept per worker
+
+class _PieceTable:
+    __slots__ = ("pieces", "length", "signature", "log_offset")
+
+    def __init__(self, text, signature):
+        self.pieces = [(text, 0, len(text))] if text else []  # (buffer, start, end)
+        self.length = len(text)
+        self.signature = signature  # of the .txt file the table was loaded from
+        self.log_offset = 0         # bytes of the delta log applied so far
+
+    def _split(self, pos):
+        # Index of the piece starting at `pos`, splitting the piece around it
+        offset = 0
+        for i, (buf, start, end) in enumerate(self.pieces):
+            if offset == pos:
+                return i
+            if pos < offset + end - start:
+                cut = start + pos - offset
+                self.pieces[i:i + 1] = [(buf, start, cut), (buf, cut, end)]
+                return i + 1
+            offset += end - start
+        return len(self.pieces)
+
+    def apply(self, ops):
+        for op in ops:
+            if op[0] == "i" and op[2]:
+                self.pieces.insert(self._split(op[1]), (op[2], 0, len(op[2])))
+                self.length += len(op[2])
+            elif op[0] == "d" and op[2] > op[1]:
+                first = self._split(op[1])
+                del self.pieces[first:self._split(op[2])]
+                self.length -= op[2] - op[1]
+        if len(self.pieces) > DOC_PIECES_MAX:
+            text = self.text()
+            self.pieces = [(text, 0, len(text))]
+
+    def text(self):
+        return "".join(buf[start:end] for buf, start, end in self.pieces)
+
+_doc_tables = OrderedDict()
+_doc_tables_lock = threading.Lock()
+
+def _doc_table(path):
+    # Current piece table of a document. Call with the document lock and
+    # _doc_tables_lock held: tables are shared and updated in place.
+    signature = _file_signature(path)
+    table = _doc_tables.get(path)
+    if table is None or table.signature != signature:
+        with open(path, "r", encoding="utf-8") as f:
+            table = _PieceTable(f.read(), signature)
+    try:
+        with open(_sidecar_path(path, "delta"), "rb") as f:
+            f.seek(table.log_offset)
+            tail = f.read()
+    except FileNotFoundError:
+        tail = b""
+        if table.log_offset:
+            # Log dropped without the file changing under us: start over
+            with open(path, "r", encoding="utf-8") as f:
+                table = _PieceTable(f.read(), signature)
+    for line in tail.splitlines():
+        try:
+            ops = json.loads(line)
+        except ValueError:
+            continue  # torn line from an interrupted write
+        table.apply(ops)
+    table.log_offset += len(tail)
+    _doc_tables[path] = table
+    _doc_tables.move_to_end(path)
+    while len(_doc_tables) > DOC_TABLES_MAX:
+        _doc_tables.popitem(last=False)
+    return table
+
+def _read_doc(path):
+    # Full text of a document including pending edits
+    with _file_lock(path, shared=True):
+        if os.path.exists(_sidecar_path(path, "delta")):
+            with _doc_tables_lock:
+                return _doc_table(path).text()
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read()
+
+def _edit_doc(path, ops):
+    # Append one batch of ops to the log and apply it; call with the
+    # document's write lock held. Returns the new length.
+    delta_path = _sidecar_path(path, "delta")
+    with _doc_tables_lock:
+        table = _doc_table(path)
+        line = json.dumps(ops, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+        written = _append_log_line(delta_path, line)
+        table.apply(ops)
+        table.log_offset += written
+        length = table.length
+    if os.path.getsize(delta_path) >= DOC_DELTA_COMPACT_BYTES:
+        _schedule_compaction(path, _compact_doc)
+    return length
+
+def _write_doc(path, content):
+    # Full rewrite; supersedes any pending edits
+    with _file_lock(path):
+        with _atomic_write(path, "w", encoding="utf-8") as f:
+            f.write(content)
+        _drop_delta(path)
+
+def _compact_doc(path):
+    with _file_lock(path):
+        if not os.path.exists(_sidecar_path(path, "delta")):
+            return
+        with _doc_tables_lock:
+            text = _doc_table(path).text()
+            with _atomic_write(path, "w", encoding="utf-8") as f:
+                f.write(text)
+            _drop_delta(path)
+            table = _PieceTable(text, _file_signature(path))
+            _doc_tables[path] = table
+
+def _parse_doc_edits(edits, length):
+    # Validate a batch against the current length; returns log ops
+    ops = []
+    for edit in edits:
+        if not isinstance(edit, dict) or len(edit) != 1:
+            raise ValueError("each edit must be one of insert, delete or replace")
+        kind, spec = next(iter(edit.items()))
+        if kind == "insert":
+            index, text = spec.get("index", length), spec.get("text", "")
+            if not isinstance(index, int) or not isinstance(text, str) or not 0 <= index <= length:
+                raise ValueError(f"insert index must be within 0-{length}")
+            ops.append(["i", index, text])
+            length += len(text)
+        elif kind in ("delete", "replace"):
+            start, end = spec.get("start"), spec.get("end")
+            if not isinstance(start, int) or not isinstance(end, int) or not 0 <= start <= end <= length:
+                raise ValueError(f"{kind} range must satisfy 0 <= start <= end <= {length}")
+            ops.append(["d", start, end])
+            length -= end - start
+            if kind == "replace":
+                text = spec.get("text", "")
+                if not isinstance(text, str):
+                    raise ValueError("replace text must be a string")
+                ops.append(["i", start, text])
+                length += len(text)
+        else:
+            raise ValueError(f"Unknown edit: {kind}")
+    return ops
 
 @app.route("/docs/create", methods=["POST"])
 def docs_create():
@@ -432,8 +5191,8 @@ def docs_create():
     # Ensure docs directory exists
     os.makedirs(DOCS_DIR, exist_ok=True)
 
-    with open(path, "w", encoding="utf-8") as f:
-        f.write(content)
+    _write_doc(path, content)
+    search_index.refresh(path)
 
     return jsonify({"document_id": safe_title})
 
@@ -445,10 +5204,23 @@ def docs_read():
     if not os.path.exists(path):
         return jsonify({"error": "Document not found"}), 404
 
-    with open(path, "r", encoding="utf-8") as f:
-        content = f.read()
-
-    return jsonify({"content": content})
+    version = _sheet_version(path)
+    if os.path.exists(_sidecar_path(path, "delta")):
+        try:
+            whole = _partial_request() is None and _stream_mode() is None
+        except ValueError:
+            whole = False
+        if whole:
+            response = jsonify({"content": _read_doc(path)})
+            response.set_etag(version)
+            return response
+        # Windows and streams read the file itself: fold pending edits in first
+        _compact_doc(path)
+        version = _sheet_version(path)
+    response = _read_text_file(path)
+    if isinstance(response, Response):
+        response.set_etag(version)
+    return response
 
 @app.route("/docs/update", methods=["POST"])
 def docs_update():
@@ -461,10 +5233,44 @@ def docs_update():
     if not os.path.exists(path):
         return jsonify({"error": "Document not found"}), 404
 
-    with open(path, "w", encoding="utf-8") as f:
-        f.write(new_content)
+    with _file_lock(path):
+        conflict = _version_conflict(path, data)
+        if conflict:
+            return conflict
+        _write_doc(path, new_content)
+        version = _sheet_version(path)
+    search_index.refresh(path)
 
-    return jsonify({"success": True})
+    return jsonify({"success": True, "version": version})
+
+@app.route("/docs/batch-edit", methods=["POST"])
+def docs_batch_edit():
+    data = request.json
+    document_id = data["document_id"]
+    edits = data.get("edits", [])
+    path = os.path.join(DOCS_DIR, f"{document_id}.txt")
+
+    if not os.path.exists(path):
+        return jsonify({"error": "Document not found"}), 404
+    if not isinstance(edits, list):
+        return jsonify({"error": "edits must be a list"}), 400
+
+    with _file_lock(path):
+        conflict = _version_conflict(path, data)
+        if conflict:
+            return conflict
+        with _doc_tables_lock:
+            length = _doc_table(path).length
+        try:
+            ops = _parse_doc_edits(edits, length)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        if ops:
+            length = _edit_doc(path, ops)
+        version = _sheet_version(path)
+    search_index.refresh(path, defer=True)
+
+    return jsonify({"success": True, "applied_edits": len(edits), "length": length, "version": version})
 
 @app.route("/docs/format", methods=["POST"])
 def docs_format():
@@ -474,16 +5280,14 @@ def docs_format():
 
     meta_path = os.path.join(DOCS_DIR, f"{document_id}.format.json")
 
-    # Load existing formats
-    formats = []
-    if os.path.exists(meta_path):
-        with open(meta_path, "r", encoding="utf-8") as f:
-            formats = json.load(f)
-
-    formats.extend(requests)
-
-    with open(meta_path, "w", encoding="utf-8") as f:
-        json.dump(formats, f, ensure_ascii=False, indent=2)
+    with _file_lock(meta_path):
+        formats = []
+        if os.path.exists(meta_path):
+            with open(meta_path, "r", encoding="utf-8") as f:
+                formats = json.load(f)
+        formats.extend(requests)
+        with _atomic_write(meta_path, "w", encoding="utf-8") as f:
+            json.dump(formats, f, ensure_ascii=False, indent=2)
 
     return jsonify({"success": True})
 
@@ -498,25 +5302,24 @@ def docs_insert_image():
     if not os.path.exists(file_path):
         return jsonify({"error": "Document not found"}), 404
 
-    with open(file_path, "r", encoding="utf-8") as f:
-        content = f.read()
-
     image_tag = f"[IMAGE: {image_url}]"
-    index = min(len(content), max(0, index))
-    new_content = content[:index] + image_tag + content[index:]
-
-    with open(file_path, "w", encoding="utf-8") as f:
-        f.write(new_content)
+    with _file_lock(file_path):
+        with _doc_tables_lock:
+            length = _doc_table(file_path).length
+        index = min(length, max(0, index))
+        _edit_doc(file_path, [["i", index, image_tag]])
+    search_index.refresh(file_path, defer=True)
 
     # log inserted image (optional for agent traceability)
     images_meta = os.path.join(DOCS_DIR, f"{document_id}.images.json")
-    images = []
-    if os.path.exists(images_meta):
-        with open(images_meta, "r", encoding="utf-8") as f:
-            images = json.load(f)
-    images.append({"url": image_url, "index": index})
-    with open(images_meta, "w", encoding="utf-8") as f:
-        json.dump(images, f, ensure_ascii=False, indent=2)
+    with _file_lock(images_meta):
+        images = []
+        if os.path.exists(images_meta):
+            with open(images_meta, "r", encoding="utf-8") as f:
+                images = json.load(f)
+        images.append({"url": image_url, "index": index})
+        with _atomic_write(images_meta, "w", encoding="utf-8") as f:
+            json.dump(images, f, ensure_ascii=False, indent=2)
 
     return jsonify({"success": True})
 
@@ -552,536 +5355,420 @@ def web_scrape():
     return jsonify({"content": simulated_content.strip()})
 
 
-@app.route("/openapi.json")
-def openapi():
-    return jsonify({"status": "ok"})
-
-@app.route("/drive/list", methods=["GET"])
-def drive_list():
-    items = []
-    for item in os.listdir(BASE_DIR):
-        path = os.path.join(BASE_DIR, item)
-        items.append({"name": item, "type": "folder" if os.path.isdir(path) else "file"})
-    return jsonify(items)
-
-@app.route("/drive/list-path", methods=["GET"])
-def drive_list_path():
-    subpath = request.args.get("subpath")
-    path = os.path.join(BASE_DIR, subpath)
-    if not os.path.exists(path):
-        return jsonify({"error": "Path not found"}), 404
-    items = []
-    for item in os.listdir(path):
-        full_path = os.path.join(path, item)
-        items.append({"name": item, "type": "folder" if os.path.isdir(full_path) else "file"})
-    return jsonify(items)
-
-@app.route("/drive/read-file", methods=["GET"])
-def drive_read_file():
-    filename = request.args.get("filename")
-    path = os.path.join(BASE_DIR, filename)
-    if not os.path.exists(path):
-        return jsonify({"error": "File not found"}), 404
-    with open(path, "r", encoding="utf-8") as f:
-        return jsonify({"content": f.read()})
-
-@app.route("/drive/write-file", methods=["POST"])
-def drive_write_file():
-    data = request.json
-    filename = os.path.join(BASE_DIR, data["filename"])
-    content = data["content"]
-    os.makedirs(os.path.dirname(filename), exist_ok=True)
-    with open(filename, "w", encoding="utf-8") as f:
-        f.write(content)
-    return jsonify({"success": True})
-
-@app.route("/drive/create-folder", methods=["POST"])
-def drive_create_folder():
-    data = request.json
-    folder_path = os.path.join(BASE_DIR, data["folder_path"])
-    os.makedirs(folder_path, exist_ok=True)
-    return jsonify({"success": True})
-
-@app.route("/drive/move-file", methods=["POST"])
-def drive_move_file():
-    data = request.json
-    src = os.path.join(BASE_DIR, data["src"])
-    dst = os.path.join(BASE_DIR, data["dst"])
-    os.makedirs(os.path.dirname(dst), exist_ok=True)
-    shutil.move(src, dst)
-    return jsonify({"success": True})
-
-@app.route("/drive/delete-file", methods=["DELETE"])
-def drive_delete_file():
-    path = os.path.join(BASE_DIR, request.args.get("path"))
-    if not os.path.exists(path):
-        return jsonify({"error": "Path not found"}), 404
-    os.makedirs(TRASH_DIR, exist_ok=True)
-    trash_path = os.path.join(TRASH_DIR, os.path.basename(path))
-    shutil.move(path, trash_path)
-    return jsonify({"success": True})
-
-@app.route("/drive/get_metadata", methods=["GET"])
-def drive_get_metadata():
-    path = os.path.join(BASE_DIR, request.args.get("path"))
-    if not os.path.exists(path):
-        return jsonify({"error": "Path not found"}), 404
-    stat = os.stat(path)
-    return jsonify({
-        "path": path,
-        "size": stat.st_size,
-        "modified": datetime.datetime.fromtimestamp(stat.st_mtime).isoformat(),
-        "type": "folder" if os.path.isdir(path) else "file"
-    })
-
-@app.route("/sheets/create", methods=["POST"])
-def sheets_create():
-    data = request.json
-    name = data["name"]
-    path = os.path.join(SHEETS_DIR, f"{name}.csv")
-    with open(path, "w", newline="", encoding="utf-8") as f:
-        writer = csv.writer(f)
-        writer.writerows(data.get("data", []))
-    return jsonify({"spreadsheetId": name})
-
-@app.route("/sheets/read", methods=["GET"])
-def sheets_read():
-    sid = request.args.get("spreadsheet_id")
-    path = os.path.join(SHEETS_DIR, f"{sid}.csv")
-    if not os.path.exists(path):
-        return jsonify({"error": "Sheet not found"}), 404
-    with open(path, newline="", encoding="utf-8") as f:
-        reader = csv.reader(f)
-        return jsonify({"values": list(reader)})
-
-@app.route("/sheets/update", methods=["POST"])
-def sheets_update():
-    data = request.json
-    sid = data["spreadsheet_id"]
-    values = data["values"]
-    path = os.path.join(SHEETS_DIR, f"{sid}.csv")
-    with open(path, "w", newline="", encoding="utf-8") as f:
-        writer = csv.writer(f)
-        writer.writerows(values)
-    return jsonify({"success": True})
-  
-@app.route("/sheets/append", methods=["POST"])
-def sheets_append():
-    data = request.json
-    sid = data["spreadsheet_id"]
-    values = data["values"]
-    path = os.path.join(SHEETS_DIR, f"{sid}.csv")
-
-    if not os.path.exists(path):
-        return jsonify({"error": "Spreadsheet not found"}), 404
-
-    try:
-        with open(path, "a", newline="", encoding="utf-8") as f:
-            writer = csv.writer(f)
-            writer.writerows(values)
-        return jsonify({"success": True, "appended_rows": len(values)})
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
-
-@app.route("/sheets/batch-update", methods=["POST"])
-def sheets_batch_update():
-    data = request.json
-    sid = data["spreadsheet_id"]
-    requests = data["requests"]
-    path = os.path.join(SHEETS_DIR, f"{sid}.csv")
-
-    if not os.path.exists(path):
-        return jsonify({"error": "Spreadsheet not found"}), 404
-
-    try:
-        # Load existing data
-        with open(path, "r", newline="", encoding="utf-8") as f:
-            existing_data = list(csv.reader(f))
-
-        applied_requests = 0
-
-        for req in requests:
-            if "updateCells" in req:
-                start = req["updateCells"]["start"]
-                rows = req["updateCells"]["rows"]
-
-                row_index = start.get("rowIndex", 0)
-                col_index = start.get("columnIndex", 0)
-
-                for r, row in enumerate(rows):
-                    values = row.get("values", [])
-                    while len(existing_data) <= row_index + r:
-                        existing_data.append([])
-
-                    for c, cell in enumerate(values):
-                        while len(existing_data[row_index + r]) <= col_index + c:
-                            existing_data[row_index + r].append("")
-                        val = cell.get("userEnteredValue", {}).get("stringValue", "")
-                        existing_data[row_index + r][col_index + c] = val
-                applied_requests += 1
-
-        with open(path, "w", newline="", encoding="utf-8") as f:
-            writer = csv.writer(f)
-            writer.writerows(existing_data)
-
-        return jsonify({"success": True, "applied_requests": applied_requests})
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
-
-@app.route("/sheets/list-tabs", methods=["GET"])
-def sheets_list_tabs():
-    sid = request.args.get("spreadsheet_id")
-    if not sid:
-        return jsonify({"error": "spreadsheet_id parameter is required"}), 400
-
-    # Check if it's a multi-tab spreadsheet (folder) or single CSV
-    folder_path = os.path.join(SHEETS_DIR, sid)
-    file_path = os.path.join(SHEETS_DIR, f"{sid}.csv")
-    
-    tabs = []
-    
-    if os.path.exists(folder_path) and os.path.isdir(folder_path):
-        # It's a multi-tab spreadsheet
-        for filename in os.listdir(folder_path):
-            if filename.endswith(".csv"):
-                tab_name = filename[:-4]
-                tabs.append({
-                    "title": tab_name,
-                    "sheetId": int(hash(tab_name) % 10000000),
-                    "index": len(tabs),
-                    "sheetType": "GRID", 
-                    "hidden": False
-                })
-    elif os.path.exists(file_path):
-        # It's a single tab spreadsheet
-        tabs.append({
-            "title": sid,
-            "sheetId": 0,
-            "index": 0,
-            "sheetType": "GRID",
-            "hidden": False
-        })
-    else:
-        return jsonify({"error": "Spreadsheet not found"}), 404
-
-    return jsonify(tabs)
-
-@app.route("/sheets/add-tab", methods=["POST"])
-def sheets_add_tab():
-    data = request.json
-    sid = data.get("spreadsheet_id")
-    title = data.get("title")
-
-    if not sid or not title:
-        return jsonify({"error": "spreadsheet_id and title required"}), 400
-
-    folder_path = os.path.join(SHEETS_DIR, sid)
-    os.makedirs(folder_path, exist_ok=True)
-
-    safe_title = re.sub(r'[^\w\-_\.]', '_', title)
-    new_tab_path = os.path.join(folder_path, f"{safe_title}.csv")
-
-    if os.path.exists(new_tab_path):
-        return jsonify({"error": "Tab already exists"}), 400
-
+# --- Request metrics ---------------------------------------------------------
+#
+# Every request is timed from the moment it reaches the app to its last
+# response byte. The file I/O and sheet rows it causes are charged to it.
+# GET /metrics exposes them in the Prometheus text format:
+#
+#   toolserver_requests_total{method,route,status}       counter
+#   toolserver_request_duration_seconds{method,route}    histogram
+#   toolserver_response_bytes{method,route}              histogram
+#   toolserver_file_read_bytes{method,route}             histogram
+#   toolserver_file_written_bytes{method,route}          histogram
+#   toolserver_sheet_rows_parsed{method,route}           histogram, /sheets routes only
+#
+# Routes are labelled by their URL rule ("/drive/uploads/<upload_id>"), so
+# the number of series stays fixed. File bytes are the read()/write()
+# traffic of the threads that served the request. They are taken from
+# /proc/thread-self/io around the view and around each chunk of a streamed
+# body. Socket traffic and memory-mapped columnar reads are not included.
+# Rows parsed counts CSV lines read and columnar rows decoded.
+#
+# Recording takes no locks. Each thread adds into its own shard of
+# pre-bucketed histograms. Every METRICS_FLUSH_SECONDS a background thread
+# sums the shards into this process's file in METRICS_DIR. A scrape merges
+# that with the files of the other live processes and with retired.json.
+# Files of exited workers are folded into retired.json by the first scrape
+# that finds them, so totals survive worker restarts and the directory stays
+# one file per live worker. Other processes' numbers are up to one flush
+# interval old. Gunicorn clears METRICS_DIR when its master starts
+# (gunicorn.conf.py). Under uvicorn each worker clears it at startup unless
+# another process that wrote to it is still alive (asgi.py).
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") not in ("0", "false", "no")
+METRICS_DIR = pathlib.Path(os.getenv("METRICS_DIR", DATA_DIR / "metrics"))
+METRICS_FLUSH_SECONDS = float(os.getenv("METRICS_FLUSH_SECONDS", 1))
+
+_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+_BYTE_BUCKETS = tuple(256 * 4 ** i for i in range(11))  # 256 B .. 256 MiB
+_ROW_BUCKETS = tuple(10 ** i for i in range(8))
+_HISTOGRAMS = (
+    ("request_duration_seconds", _LATENCY_BUCKETS, "Time from request start to the last response byte."),
+    ("response_bytes", _BYTE_BUCKETS, "Response body size."),
+    ("file_read_bytes", _BYTE_BUCKETS, "Bytes read from files while serving the request."),
+    ("file_written_bytes", _BYTE_BUCKETS, "Bytes written to files while serving the request."),
+    ("sheet_rows_parsed", _ROW_BUCKETS, "Sheet rows parsed or decoded while serving the request."),
+)
+
+_metrics_local = threading.local()
+_metrics_shards = []  # (thread, shard) for every thread that has recorded
+_metrics_retired = {}  # totals of shards whose threads have exited
+_metrics_lock = threading.Lock()
+_metrics_file = (None, None)  # (pid, path), renewed after a fork
+_METRICS_FILE = re.compile(r"^(\d+)-(\w+)\.json$")
+_METRICS_RETIRED = "retired.json"
+_metrics_flusher = None
+
+def _metrics_shard():
+    shard = getattr(_metrics_local, "shard", None)
+    if shard is None:
+        shard = _metrics_local.shard = {}
+        with _metrics_lock:
+            _metrics_shards.append((threading.current_thread(), shard))
+    return shard
+
+def _observe(shard, name, bounds, method, route, value):
+    # A histogram cell holds one count per bucket (the last is +Inf), then the sum
+    key = (name, method, route)
+    cell = shard.get(key)
+    if cell is None:
+        cell = shard[key] = [0] * (len(bounds) + 2)
+    cell[bisect.bisect_left(bounds, value)] += 1
+    cell[-1] += value
+
+def _thread_io():
+    # (rchar, wchar, bytes this call read) for the calling thread, or None
+    f = getattr(_metrics_local, "io", False)
+    if f is False:
+        try:
+            f = open("/proc/thread-self/io", "rb", buffering=0)
+        except OSError:
+            f = None
+        _metrics_local.io = f
+    if f is None:
+        return None
+    data = os.pread(f.fileno(), 256, 0)
+    rchar, wchar, _ = data.split(b"\n", 2)
+    return int(rchar[7:]), int(wchar[7:]), len(data)
+
+class _RequestStats:
+    __slots__ = ("read", "written", "rows", "io")
+
+    def __init__(self):
+        self.read = self.written = self.rows = 0
+        self.io = None
+
+    def begin(self):
+        # Charge this thread's work to the request until end()
+        _metrics_local.stats = self
+        self.io = _thread_io()
+
+    def end(self):
+        _metrics_local.stats = None
+        if self.io is not None:
+            after = _thread_io()
+            self.read += after[0] - self.io[0] - self.io[2]
+            self.written += after[1] - self.io[1]
+
+def _count_rows(count):
+    stats = getattr(_metrics_local, "stats", None)
+    if stats is not None:
+        stats.rows += count
+
+def _record_request(environ, status, started, stats, size):
+    route = environ.get("toolserver.route", "unmatched")
+    method = environ.get("REQUEST_METHOD", "")
+    shard = _metrics_shard()
+    key = ("requests_total", method, route, status)
+    shard[key] = shard.get(key, 0) + 1
+    _observe(shard, "request_duration_seconds", _LATENCY_BUCKETS, method, route, time.perf_counter() - started)
+    _observe(shard, "response_bytes", _BYTE_BUCKETS, method, route, size)
+    _observe(shard, "file_read_bytes", _BYTE_BUCKETS, method, route, stats.read)
+    _observe(shard, "file_written_bytes", _BYTE_BUCKETS, method, route, stats.written)
+    if route.startswith("/sheets/"):
+        _observe(shard, "sheet_rows_parsed", _ROW_BUCKETS, method, route, stats.rows)
+
+def _label_route():
+    # Flask drops the request from the environ before the body is sent, so
+    # keep the matched rule for _record_request
+    if request.url_rule is not None:
+        request.environ["toolserver.route"] = request.url_rule.rule
+
+def _label_response(response):
+    request.environ["toolserver.buffered"] = not response.is_streamed
+    return response
+
+class _MetricsMiddleware:
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        started = time.perf_counter()
+        stats = _RequestStats()
+        status = ["500"]
+
+        def start(line, headers, exc_info=None):
+            status[0] = line.split(" ", 1)[0]
+            return start_response(line, headers, exc_info)
+
+        stats.begin()
+        try:
+            body = self.wsgi_app(environ, start)
+        except BaseException:
+            stats.end()
+            _record_request(environ, status[0], started, stats, 0)
+            raise
+        stats.end()
+        return _MeteredBody(body, environ, status, started, stats)
+
+class _MeteredBody:
+    # The response iterable; records the request once the body is exhausted
+    # or closed, charging the work done for each chunk to it. Buffered
+    # responses do no work per chunk, so they are not sampled
+    def __init__(self, body, environ, status, started, stats):
+        self.body = body
+        self.chunks = iter(body)
+        self.buffered = environ.get("toolserver.buffered", False)
+        self.environ = environ
+        self.status = status
+        self.started = started
+        self.stats = stats
+        self.size = 0
+        self.recorded = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.buffered:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                self._record()
+                raise StopIteration
+            self.size += len(chunk)
+            return chunk
+        self.stats.begin()
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            self._record()
+            raise
+        finally:
+            self.stats.end()
+        self.size += len(chunk)
+        return chunk
+
+    def close(self):
+        try:
+            if hasattr(self.body, "close"):
+                self.body.close()
+        finally:
+            self._record()
+
+    def _record(self):
+        if not self.recorded:
+            self.recorded = True
+            _record_request(self.environ, self.status[0], self.started, self.stats, self.size)
+
+def _merge_metrics(into, source):
+    for key, value in source:
+        if isinstance(value, list):
+            cell = into.get(key)
+            if cell is None:
+                into[key] = list(value)
+            else:
+                for i, v in enumerate(value):
+                    cell[i] += v
+        else:
+            into[key] = into.get(key, 0) + value
+
+def _process_metrics():
+    # This process's totals: exited threads' shards plus every live one
+    with _metrics_lock:
+        live = []
+        for thread, shard in _metrics_shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+            else:
+                _merge_metrics(_metrics_retired, shard.items())
+        _metrics_shards[:] = live
+        totals = {}
+        _merge_metrics(totals, _metrics_retired.items())
+    for _, shard in live:
+        _merge_metrics(totals, list(shard.items()))
+    return totals
+
+def _process_token(pid):
+    # Start time of `pid` in clock ticks since boot, so a reused pid does not
+    # pass for the process that wrote a file. None if the process is gone.
     try:
-        with open(new_tab_path, "w", newline="", encoding="utf-8") as f:
-            pass
-
-        return jsonify({
-            "success": True,
-            "sheetId": int(datetime.datetime.now().timestamp()),
-            "title": title
-        })
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
-
-@app.route("/sheets/delete-tab", methods=["DELETE"])
-def sheets_delete_tab():
-    sid = request.args.get("spreadsheet_id")
-    title = request.args.get("title")
-
-    if not sid or not title:
-        return jsonify({"error": "spreadsheet_id and title required"}), 400
-
-    safe_title = re.sub(r'[^\w\-_\.]', '_', title)
-    tab_path = os.path.join(SHEETS_DIR, sid, f"{safe_title}.csv")
-
-    if not os.path.exists(tab_path):
-        return jsonify({"error": "Tab not found"}), 404
-
-    try:
-        os.remove(tab_path)
-        return jsonify({"success": True})
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
-
-@app.route("/sheets/format", methods=["POST"])
-def sheets_format():
-    data = request.json
-    sid = data["spreadsheet_id"]
-    tab = data["tab"]
-    formatting = data["formatting"]
-
-    sheet_dir = os.path.join(SHEETS_DIR, sid)
-    if not os.path.exists(sheet_dir):
-        os.makedirs(sheet_dir, exist_ok=True)
-
-    format_file = os.path.join(sheet_dir, f"{tab}.format.json")
-
+        with open(f"/proc/{pid}/stat", "rb") as f:
+            return f.read().rsplit(b")", 1)[1].split()[19].decode()
+    except FileNotFoundError:
+        return None if os.path.isdir("/proc/self") else ""
+    except (OSError, IndexError):
+        return ""
+
+def _process_alive(pid, token):
+    current = _process_token(pid)
+    if current:
+        return current == token
+    if current is None:
+        return False
     try:
-        with open(format_file, "w", encoding="utf-8") as f:
-            json.dump(formatting, f, ensure_ascii=False, indent=2)
-        return jsonify({"success": True})
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
-
-@app.route("/sheets/create-filter", methods=["POST"])
-def sheets_create_filter():
-    data = request.json
-    sid = data["spreadsheet_id"]
-    tab = data["tab"]
-    filter_config = data["filter_config"]
-
-    sheet_dir = os.path.join(SHEETS_DIR, sid)
-    if not os.path.exists(sheet_dir):
-        os.makedirs(sheet_dir, exist_ok=True)
-
-    filters_file = os.path.join(sheet_dir, f"{tab}.filters.json")
-
-    # Load existing filters if any
-    filters = []
-    if os.path.exists(filters_file):
-        with open(filters_file, "r", encoding="utf-8") as f:
-            filters = json.load(f)
-
-    filters.append({
-        "filter_id": int(datetime.datetime.now().timestamp()),
-        "filter": filter_config,
-        "created_at": datetime.datetime.now().isoformat()
-    })
-
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _metrics_path():
+    global _metrics_file
+    pid, path = _metrics_file
+    if pid != os.getpid():
+        token = _process_token(os.getpid()) or f"{time.time_ns():x}"
+        path = os.path.join(METRICS_DIR, f"{os.getpid()}-{token}.json")
+        _metrics_file = (os.getpid(), path)
+    return path
+
+def _flush_metrics():
+    totals = _process_metrics()
+    if not totals:
+        return
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    with _atomic_write(_metrics_path(), "w", encoding="utf-8") as f:
+        json.dump([[list(key), value] for key, value in totals.items()], f, separators=(",", ":"))
+
+def _metrics_flush_loop():
+    while True:
+        time.sleep(METRICS_FLUSH_SECONDS)
+        try:
+            _flush_metrics()
+        except Exception:
+            app.logger.exception("Metrics flush failed")
+
+def _start_metrics_flusher():
+    global _metrics_flusher
+    if not METRICS_ENABLED or (_metrics_flusher is not None and _metrics_flusher.is_alive()):
+        return
+    _metrics_flusher = threading.Thread(target=_metrics_flush_loop, name="metrics-flush", daemon=True)
+    _metrics_flusher.start()
+    atexit.register(_flush_metrics)
+
+def _metrics_files():
+    # (path, pid, token) of every process file in METRICS_DIR but our own
+    own = _metrics_path()
     try:
-        with open(filters_file, "w", encoding="utf-8") as f:
-            json.dump(filters, f, ensure_ascii=False, indent=2)
-        return jsonify({"success": True})
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
-
-@app.route("/sheets/freeze-panes", methods=["POST"])
-def sheets_freeze_panes():
-    data = request.json
-    sid = data["spreadsheet_id"]
-    tab = data["tab"]
-    freeze_config = {
-        "rows": data.get("rows", 0),
-        "columns": data.get("columns", 0),
-        "updated_at": datetime.datetime.now().isoformat()
-    }
-
-    sheet_dir = os.path.join(SHEETS_DIR, sid)
-    if not os.path.exists(sheet_dir):
-        os.makedirs(sheet_dir, exist_ok=True)
-
-    freeze_file = os.path.join(sheet_dir, f"{tab}.freeze.json")
-
+        entries = list(os.scandir(METRICS_DIR))
+    except FileNotFoundError:
+        return []
+    files = []
+    for entry in entries:
+        m = _METRICS_FILE.match(entry.name)
+        if m and entry.path != own:
+            files.append((entry.path, int(m.group(1)), m.group(2)))
+    return files
+
+def _read_metrics_file(path):
     try:
-        with open(freeze_file, "w", encoding="utf-8") as f:
-            json.dump(freeze_config, f, ensure_ascii=False, indent=2)
-        return jsonify({"success": True})
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
-
-@app.route("/sheets/conditional-format", methods=["POST"])
-def sheets_conditional_format():
-    data = request.json
-    sid = data["spreadsheet_id"]
-    tab = data["tab"]
-    rule = data["rule"]
-
-    sheet_dir = os.path.join(SHEETS_DIR, sid)
-    if not os.path.exists(sheet_dir):
-        os.makedirs(sheet_dir, exist_ok=True)
-
-    cond_file = os.path.join(sheet_dir, f"{tab}.conditional.json")
-    rules = []
-    if os.path.exists(cond_file):
-        with open(cond_file, "r", encoding="utf-8") as f:
-            rules = json.load(f)
-
-    rules.append({
-        "rule": rule,
-        "created_at": datetime.datetime.now().isoformat()
-    })
-
+        with open(path, encoding="utf-8") as f:
+            return [(tuple(key), value) for key, value in json.load(f)]
+    except (OSError, ValueError):
+        return []
+
+def reset_metrics(stale_only=False):
+    # Forget the metrics of earlier runs; call before any worker starts.
+    # Workers that start on their own (uvicorn) pass stale_only, which keeps
+    # the directory while any process that wrote to it is still alive.
+    if stale_only and any(_process_alive(pid, token) for _, pid, token in _metrics_files()):
+        return
+    shutil.rmtree(METRICS_DIR, ignore_errors=True)
+
+def _retire_metrics(dead):
+    # Fold exited processes' files into one retired file. The names folded in
+    # are kept until the files are gone, so a crash between writing the
+    # retired file and removing them cannot count them twice.
+    retired_path = os.path.join(METRICS_DIR, _METRICS_RETIRED)
+    with _file_lock(retired_path):
+        try:
+            with open(retired_path, encoding="utf-8") as f:
+                retired = json.load(f)
+        except FileNotFoundError:
+            retired = {"merged": [], "metrics": []}
+        merged = [name for name in retired["merged"] if os.path.exists(os.path.join(METRICS_DIR, name))]
+        totals = {tuple(key): value for key, value in retired["metrics"]}
+        fresh = [path for path in dead
+                 if os.path.basename(path) not in merged and os.path.exists(path)]
+        for path in fresh:
+            _merge_metrics(totals, _read_metrics_file(path))
+        merged += [os.path.basename(path) for path in fresh]
+        if fresh or len(merged) != len(retired["merged"]):
+            with _atomic_write(retired_path, "w", encoding="utf-8") as f:
+                json.dump({"merged": merged, "metrics": [[list(key), value] for key, value in totals.items()]},
+                          f, separators=(",", ":"))
+        for path in dead:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+def _all_metrics():
+    totals = _process_metrics()
+    dead = []
+    for path, pid, token in _metrics_files():
+        if _process_alive(pid, token):
+            _merge_metrics(totals, _read_metrics_file(path))
+        else:
+            dead.append(path)
+    if dead:
+        _retire_metrics(dead)
     try:
-        with open(cond_file, "w", encoding="utf-8") as f:
-            json.dump(rules, f, ensure_ascii=False, indent=2)
-        return jsonify({"success": True})
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
-
-@app.route("/sheets/query", methods=["POST"])
-def sheets_query():
-    data = request.json
-    sid = data["spreadsheet_id"]
-    query = data["query"]
-
-    path = os.path.join(SHEETS_DIR, f"{sid}.csv")
-    if not os.path.exists(path):
-        return jsonify({"error": "Spreadsheet not found"}), 404
-
-    with open(path, "r", newline="", encoding="utf-8") as f:
-        reader = csv.reader(f)
-        rows = list(reader)
-
-    if not rows:
-        return jsonify({"headers": [], "rows": []})
-
-    headers = rows[0]
-    data_rows = rows[1:]
-
-    # Extremely basic query parser: SELECT * ONLY
-    if query.strip().upper() == "SELECT *":
-        return jsonify({"headers": headers, "rows": data_rows})
-
-    return jsonify({"error": "Only 'SELECT *' supported for now"}), 400
-
-@app.route("/docs/create", methods=["POST"])
-def docs_create():
-    data = request.json
-    title = data["title"]
-    content = data.get("content", "")
-
-    # Create safe filename
-    safe_title = re.sub(r"[^\w\-_\.]", "_", title)
-    path = os.path.join(DOCS_DIR, f"{safe_title}.txt")
-
-    # Ensure docs directory exists
-    os.makedirs(DOCS_DIR, exist_ok=True)
-
-    with open(path, "w", encoding="utf-8") as f:
-        f.write(content)
-
-    return jsonify({"document_id": safe_title})
-
-@app.route("/docs/read", methods=["GET"])
-def docs_read():
-    document_id = request.args.get("document_id")
-    path = os.path.join(DOCS_DIR, f"{document_id}.txt")
-
-    if not os.path.exists(path):
-        return jsonify({"error": "Document not found"}), 404
-
-    with open(path, "r", encoding="utf-8") as f:
-        content = f.read()
-
-    return jsonify({"content": content})
-
-@app.route("/docs/update", methods=["POST"])
-def docs_update():
-    data = request.json
-    document_id = data["document_id"]
-    new_content = data["new_content"]
-
-    path = os.path.join(DOCS_DIR, f"{document_id}.txt")
-
-    if not os.path.exists(path):
-        return jsonify({"error": "Document not found"}), 404
-
-    with open(path, "w", encoding="utf-8") as f:
-        f.write(new_content)
-
-    return jsonify({"success": True})
-
-@app.route("/docs/format", methods=["POST"])
-def docs_format():
-    data = request.json
-    document_id = data["document_id"]
-    requests = data["requests"]
-
-    meta_path = os.path.join(DOCS_DIR, f"{document_id}.format.json")
-
-    # Load existing formats
-    formats = []
-    if os.path.exists(meta_path):
-        with open(meta_path, "r", encoding="utf-8") as f:
-            formats = json.load(f)
-
-    formats.extend(requests)
-
-    with open(meta_path, "w", encoding="utf-8") as f:
-        json.dump(formats, f, ensure_ascii=False, indent=2)
-
-    return jsonify({"success": True})
-
-@app.route("/docs/insert-image", methods=["POST"])
-def docs_insert_image():
-    data = request.json
-    document_id = data["document_id"]
-    image_url = data["image_url"]
-    index = data.get("index", 0)
-
-    file_path = os.path.join(DOCS_DIR, f"{document_id}.txt")
-    if not os.path.exists(file_path):
-        return jsonify({"error": "Document not found"}), 404
-
-    with open(file_path, "r", encoding="utf-8") as f:
-        content = f.read()
-
-    image_tag = f"[IMAGE: {image_url}]"
-    index = min(len(content), max(0, index))
-    new_content = content[:index] + image_tag + content[index:]
-
-    with open(file_path, "w", encoding="utf-8") as f:
-        f.write(new_content)
-
-    # log inserted image (optional for agent traceability)
-    images_meta = os.path.join(DOCS_DIR, f"{document_id}.images.json")
-    images = []
-    if os.path.exists(images_meta):
-        with open(images_meta, "r", encoding="utf-8") as f:
-            images = json.load(f)
-    images.append({"url": image_url, "index": index})
-    with open(images_meta, "w", encoding="utf-8") as f:
-        json.dump(images, f, ensure_ascii=False, indent=2)
-
-    return jsonify({"success": True})
-
-@app.route("/web/search", methods=["GET"])
-def web_search():
-    query = request.args.get("query")
-    if not query:
-        return jsonify({"error": "query parameter required"}), 400
-
-    # Simulated search results
-    results = [
-        {"title": f"Result 1 for '{query}'", "snippet": "First simulated search result.", "link": f"https://example.com/{query}/1"},
-        {"title": f"Result 2 for '{query}'", "snippet": "Second simulated search result.", "link": f"https://example.com/{query}/2"},
-        {"title": f"Result 3 for '{query}'", "snippet": "Third simulated search result.", "link": f"https://example.com/{query}/3"},
-    ]
-
-    return jsonify({"results": results})
-
-@app.route("/web/scrape", methods=["GET"])
-def web_scrape():
-    url = request.args.get("url")
-    if not url:
-        return jsonify({"error": "url parameter required"}), 400
-
-    # Simulated scrape output
-    simulated_content = f"""
-    Simulated content scraped from {url}.
-    This is placeholder data representing extracted page content.
-    Title: Example Page
-    Summary: This page was successfully processed in simulation.
-    """
-
-    return jsonify({"content": simulated_content.strip()})
+        with open(os.path.join(METRICS_DIR, _METRICS_RETIRED), encoding="utf-8") as f:
+            _merge_metrics(totals, ((tuple(key), value) for key, value in json.load(f)["metrics"]))
+    except (OSError, ValueError):
+        pass
+    return totals
+
+def _metric_number(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+def _metric_labels(method, route, **extra):
+    pairs = [("method", method), ("route", route)] + list(extra.items())
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped))
+
+def _render_metrics(totals):
+    lines = ["# HELP toolserver_requests_total Requests served, by route and status.",
+             "# TYPE toolserver_requests_total counter"]
+    for key in sorted(k for k in totals if k[0] == "requests_total"):
+        lines.append(f"toolserver_requests_total{{{_metric_labels(key[1], key[2], status=key[3])}}} {totals[key]}")
+    for name, bounds, description in _HISTOGRAMS:
+        metric = f"toolserver_{name}"
+        lines += [f"# HELP {metric} {description}", f"# TYPE {metric} histogram"]
+        for key in sorted(k for k in totals if k[0] == name):
+            cell, labels = totals[key], _metric_labels(key[1], key[2])
+            cumulative = 0
+            for bound, count in zip(bounds + (None,), cell):
+                cumulative += count
+                le = "+Inf" if bound is None else _metric_number(bound)
+                lines.append(f'{metric}_bucket{{{labels},le="{le}"}} {cumulative}')
+            lines.append(f"{metric}_sum{{{labels}}} {_metric_number(cell[-1])}")
+            lines.append(f"{metric}_count{{{labels}}} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return Response(_render_metrics(_all_metrics()), mimetype="text/plain; version=0.0.4; charset=utf-8")
+
+if METRICS_ENABLED:
+    app.before_request(_label_route)
+    app.after_request(_label_response)
+    app.wsgi_app = _MetricsMiddleware(app.wsgi_app)
+
+def start_background_tasks():
+    # Per-worker startup: warm the drive and search indexes, sweep the trash
+    drive_index.start()
+    search_index.start()
+    _start_trash_sweeper()
+    _start_metrics_flusher()
 
 if __name__ == "__main__":
     import os
     port = int(os.getenv("PORT", 80))
+    reset_metrics()
+    start_background_tasks()
     app.run(host="0.0.0.0", port=port)
 
 
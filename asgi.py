@@ -0,0 +1,143 @@
+# Asyncio serving mode for the tool server.
+#
+#   uvicorn asgi:app --host 0.0.0.0 --port 80 --workers 4
+#   gunicorn -k uvicorn.workers.UvicornWorker -c gunicorn.conf.py asgi:app
+#
+# Same routes and JSON contract as app.py: requests are dispatched to the
+# Flask views unchanged. Connections, request bodies and responses are
+# driven by the event loop, while everything that blocks (the view itself,
+# its file I/O, each pull from a streamed response) runs on a bounded thread
+# pool of ASYNC_IO_THREADS threads. Thousands of in-flight requests then
+# cost one coroutine each, and a slow disk or a slow client holds a pool
+# thread only for one chunk at a time rather than for the whole request.
+# Consecutive steps of one request may run on different pool threads, so
+# they all run inside the same copied context: Flask's request and app
+# contexts (stream_with_context) live in context variables.
+
+import asyncio
+import contextvars
+import io
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from app import app as flask_app, reset_metrics, start_background_tasks
+
+ASYNC_IO_THREADS = int(os.getenv("ASYNC_IO_THREADS", 32))
+
+_executor = None
+
+def _pool():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=ASYNC_IO_THREADS, thread_name_prefix="asgi-io")
+    return _executor
+
+class _BodyStream(io.RawIOBase):
+    # wsgi.input fed from ASGI receive(); read from a pool thread, so each
+    # receive is handed back to the event loop and awaited there
+    def __init__(self, receive, loop):
+        self.receive = receive
+        self.loop = loop
+        self.pending = b""
+        self.more = True
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.pending and self.more:
+            message = asyncio.run_coroutine_threadsafe(self.receive(), self.loop).result()
+            if message["type"] == "http.disconnect":
+                self.more = False
+                break
+            self.pending = message.get("body", b"")
+            self.more = message.get("more_body", False)
+        n = min(len(b), len(self.pending))
+        b[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+def _environ(scope, body):
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1]),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        "wsgi.input_terminated": True,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            environ[name] = value
+            continue
+        key = f"HTTP_{name}"
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+async def _http(scope, receive, send):
+    loop = asyncio.get_running_loop()
+    body = io.BufferedReader(_BodyStream(receive, loop))
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started["status"] = int(status.split(" ", 1)[0])
+        started["headers"] = [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers]
+        return lambda data: None
+
+    def call_view():
+        # Run the view and pull its first chunk, so start_response has been called
+        result = flask_app.wsgi_app(_environ(scope, body), start_response)
+        chunks = iter(result)
+        return result, chunks, next(chunks, None)
+
+    pool = _pool()
+    context = contextvars.copy_context()
+    result, chunks, chunk = await loop.run_in_executor(pool, context.run, call_view)
+    try:
+        await send({"type": "http.response.start", "status": started["status"], "headers": started["headers"]})
+        while chunk is not None:
+            if chunk:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            chunk = await loop.run_in_executor(pool, context.run, next, chunks, None)
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+    finally:
+        if hasattr(result, "close"):
+            await loop.run_in_executor(pool, context.run, result.close)
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            _pool()
+            # Every uvicorn worker gets here; only the first one of a run
+            # finds no live writer and clears the last run's counters
+            reset_metrics(stale_only=True)
+            start_background_tasks()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            if _executor is not None:
+                _executor.shutdown(wait=True)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def app(scope, receive, send):
+    if scope["type"] == "http":
+        await _http(scope, receive, send)
+    elif scope["type"] == "lifespan":
+        await _lifespan(receive, send)
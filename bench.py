@@ -0,0 +1,878 @@
+# Benchmark and load generator for the tool server.
+#
+#   python bench.py run --out base.json                  # in process, Flask test client
+#   python bench.py run --mode http                      # spawns gunicorn on a free port
+#   python bench.py run --mode http --server uvicorn     # ... or uvicorn (asgi.py), or flask
+#   python bench.py run --mode http --url http://host:port   # an already running server
+#   python bench.py compare base.json new.json
+#
+# `run` drives every operation listed in openapi.json. Each operation has a
+# scenario below. The scenario first creates its fixtures through the API:
+# a workbook loaded with /sheets/import, a folder tree, documents, and so on.
+# After --warmup untimed calls, it fires --requests calls at each
+# --concurrency level. Fixture and payload sizes follow --size (small,
+# medium or large; see SIZES). Any operation without a scenario fails the
+# run, so new routes cannot go unmeasured.
+#
+# For each route and concurrency level, the run reports:
+#   - throughput
+#   - latency percentiles p50/p90/p99/max, end to end, including the response body
+#   - mean response size
+#   - peak RSS during that step
+# Peak RSS is the summed VmHWM from /proc, reset before each step through
+# clear_refs. In client mode it covers this process; in http mode it covers
+# the spawned server and its workers. It is left out for a remote server or
+# when /proc is unavailable.
+#
+# Client mode and spawned servers use a throwaway data directory (DRIVE_DIR,
+# SHEETS_DIR, DOCS_DIR, DATA_DIR, LOGS_DIR). With --url, fixtures go to a
+# server that holds real data. They are named with the run's "bench-..."
+# prefix, and the drive folder and leftover trash fixtures are removed
+# afterwards. Sheets and documents have no delete route, so they are left
+# behind. Routes that act on the whole drive (POST /drive/trash/empty) are
+# skipped with --url unless --include-global is given.
+#
+# `compare` matches two result files by route and concurrency level. It
+# flags a regression when p50, p99 or peak RSS grow, or throughput drops, by
+# more than --threshold percent. Latency must also move by at least
+# --min-ms. It exits with status 1 when anything regressed, so it can gate CI.
+
+import argparse
+import contextlib
+import csv
+import http.client
+import io
+import itertools
+import json
+import math
+import os
+import platform
+import random
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+SIZES = {
+    "small":  {"sheet_rows": 1000, "file_bytes": 4 * 1024, "doc_chars": 8 * 1024,
+               "tree_dirs": 10, "tree_files": 10, "batch_ops": 20, "append_rows": 1, "update_rows": 100},
+    "medium": {"sheet_rows": 20000, "file_bytes": 256 * 1024, "doc_chars": 128 * 1024,
+               "tree_dirs": 30, "tree_files": 30, "batch_ops": 100, "append_rows": 10, "update_rows": 1000},
+    "large":  {"sheet_rows": 200000, "file_bytes": 4 * 1024 * 1024, "doc_chars": 1024 * 1024,
+               "tree_dirs": 50, "tree_files": 60, "batch_ops": 500, "append_rows": 100, "update_rows": 10000},
+}
+
+_WORDS = ("alpha bravo charlie delta echo foxtrot golf hotel india juliet kilo lima mike "
+          "november oscar papa quebec romeo sierra tango uniform victor whiskey xray yankee zulu").split()
+_CITIES = ("Berlin", "Lagos", "Lima", "Oslo", "Osaka", "Perth", "Quito", "Seoul", "Tunis", "Vienna")
+
+# --- Payloads ----------------------------------------------------------------
+
+def _text(chars, seed=0):
+    rng = random.Random(seed)
+    out, size = [], 0
+    while size < chars:
+        line = " ".join(rng.choice(_WORDS) for _ in range(12)) + "\n"
+        out.append(line)
+        size += len(line)
+    return "".join(out)[:chars]
+
+def _sheet_rows(count, seed=0):
+    rng = random.Random(seed)
+    yield ["id", "name", "qty", "price", "city", "active", "day", "note"]
+    for i in range(count):
+        yield [str(i), f"item-{i}", str(rng.randint(0, 100)), f"{rng.uniform(1, 500):.2f}",
+               rng.choice(_CITIES), rng.choice(("true", "false")),
+               f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}", rng.choice(_WORDS)]
+
+def _sheet_csv(count, seed=0):
+    buf = io.StringIO()
+    csv.writer(buf).writerows(_sheet_rows(count, seed))
+    return buf.getvalue().encode("utf-8")
+
+def _request(method, path, params=None, json=None, body=None, content_type=None):
+    return {"method": method, "path": path, "params": params, "json": json,
+            "body": body, "content_type": content_type}
+
+# --- Transports --------------------------------------------------------------
+#
+# request() returns (status, body bytes) with the body fully read, and
+# status 0 for a transport failure. Each thread keeps its own client or
+# keep-alive connection.
+
+class ClientTransport:
+    def __init__(self, app):
+        self.app = app
+        self.local = threading.local()
+
+    def request(self, req):
+        client = getattr(self.local, "client", None)
+        if client is None:
+            client = self.local.client = self.app.test_client()
+        response = client.open(req["path"], method=req["method"], query_string=req["params"],
+                               json=req["json"], data=req["body"], content_type=req["content_type"])
+        try:
+            return response.status_code, response.get_data()
+        finally:
+            response.close()
+
+class HttpTransport:
+    def __init__(self, url):
+        parts = urllib.parse.urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.local = threading.local()
+
+    def request(self, req):
+        target = req["path"]
+        if req["params"]:
+            target += "?" + urllib.parse.urlencode(req["params"], doseq=True)
+        headers, body = {}, req["body"]
+        if req["json"] is not None:
+            body = json.dumps(req["json"]).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+        elif req["content_type"]:
+            headers["Content-Type"] = req["content_type"]
+        for attempt in range(2):
+            conn = getattr(self.local, "conn", None)
+            if conn is None:
+                conn = self.local.conn = http.client.HTTPConnection(self.host, self.port, timeout=300)
+            try:
+                conn.request(req["method"], target, body=body, headers=headers)
+                response = conn.getresponse()
+                return response.status, response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as e:
+                # A keep-alive connection the server has since closed: retry once
+                conn.close()
+                self.local.conn = None
+                if attempt:
+                    return 0, str(e).encode("utf-8")
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                self.local.conn = None
+                return 0, str(e).encode("utf-8")
+
+# --- Peak RSS ----------------------------------------------------------------
+
+class PeakRss:
+    # Summed VmHWM of a process and its descendants, from /proc
+    def __init__(self, root):
+        self.root = root
+
+    def pids(self):
+        parents = {}
+        for name in os.listdir("/proc"):
+            if not name.isdigit():
+                continue
+            try:
+                with open(f"/proc/{name}/stat") as f:
+                    stat = f.read()
+            except OSError:
+                continue
+            parents.setdefault(int(stat.rsplit(")", 1)[1].split()[1]), []).append(int(name))
+        found, stack = [], [self.root]
+        while stack:
+            pid = stack.pop()
+            found.append(pid)
+            stack.extend(parents.get(pid, []))
+        return found
+
+    def reset(self):
+        for pid in self.pids():
+            try:
+                with open(f"/proc/{pid}/clear_refs", "w") as f:
+                    f.write("5")
+            except OSError:
+                pass
+
+    def read(self):
+        total = None
+        for pid in self.pids():
+            try:
+                with open(f"/proc/{pid}/status") as f:
+                    for line in f:
+                        if line.startswith("VmHWM:"):
+                            total = (total or 0) + int(line.split()[1])
+            except OSError:
+                continue
+        return None if total is None else round(total / 1024, 1)
+
+def _peak_rss(pid):
+    return PeakRss(pid) if os.path.isdir("/proc") else None
+
+# --- Scenarios ---------------------------------------------------------------
+#
+# A scenario takes the run context and a request count and returns that many
+# requests, creating whatever they need first (setup is not timed). Shared
+# fixtures are built once per run through ctx.fixture; anything a request
+# consumes (a file to delete, an upload to commit) is created per request.
+
+SCENARIOS = {}
+
+def scenario(method, path, scope="local"):
+    def register(build):
+        SCENARIOS[f"{method} {path}"] = (build, scope)
+        return build
+    return register
+
+class Context:
+    def __init__(self, transport, size, prefix):
+        self.transport = transport
+        self.size = SIZES[size]
+        self.prefix = prefix
+        self.fixtures = {}
+        self.counter = itertools.count()
+        self.trash_ids = []
+
+    def call(self, method, path, **kwargs):
+        status, body = self.transport.request(_request(method, path, **kwargs))
+        if not 200 <= status < 300:
+            raise RuntimeError(f"setup {method} {path} returned {status}: {body[:200]!r}")
+        return json.loads(body) if body[:1] in (b"{", b"[") else body
+
+    def fixture(self, name, build):
+        if name not in self.fixtures:
+            self.fixtures[name] = build()
+        return self.fixtures[name]
+
+    def name(self, kind):
+        return f"{self.prefix}-{kind}{next(self.counter)}"
+
+    # Drive: everything lives under one folder named after the run
+    def folder(self, *parts):
+        return "/".join((self.prefix,) + parts)
+
+    def write_file(self, path, chars=None):
+        self.call("POST", "/drive/write-file", json={"filename": path, "content": _text(chars or 64, len(path))})
+        return path
+
+    def drive_file(self):
+        return self.fixture("file", lambda: self.write_file(self.folder("file.txt"), self.size["file_bytes"]))
+
+    def drive_tree(self):
+        def build():
+            # One folder of files, then copies of it in a single batch
+            self.write_file(self.folder("tree", "d0", "x.txt"))
+            for i in range(1, self.size["tree_files"]):
+                self.write_file(self.folder("tree", "d0", f"f{i}.txt"), 256)
+            self.call("POST", "/drive/batch", json={"operations": [
+                {"op": "copy", "src": self.folder("tree", "d0"), "dst": self.folder("tree", f"d{i}")}
+                for i in range(1, self.size["tree_dirs"])]})
+            return self.folder("tree")
+        return self.fixture("tree", build)
+
+    def trashed(self, n):
+        ids = []
+        for _ in range(n):
+            path = self.write_file(self.folder("trash", self.name("t")))
+            ids.append(self.call("DELETE", "/drive/delete-file", params={"path": path})["trash_id"])
+        self.trash_ids.extend(ids)
+        return ids
+
+    def upload(self, data=None):
+        name = self.folder("uploads", self.name("u"))
+        upload_id = self.call("POST", "/drive/uploads", json={"filename": name})["upload_id"]
+        if data is not None:
+            self.call("PUT", f"/drive/uploads/{upload_id}", params={"offset": 0},
+                      body=data, content_type="application/octet-stream")
+        return upload_id
+
+    # Sheets: one imported workbook shared by the read paths
+    def workbook(self):
+        def build():
+            sid = f"{self.prefix}-wb"
+            self.call("POST", "/sheets/import", params={"spreadsheet_id": sid, "tab": "Data"},
+                      body=_sheet_csv(self.size["sheet_rows"]), content_type="text/csv")
+            return sid
+        return self.fixture("workbook", build)
+
+    def sheet(self, rows):
+        sid = self.name("s")
+        self.call("POST", "/sheets/import", params={"spreadsheet_id": sid},
+                  body=_sheet_csv(rows, len(sid)), content_type="text/csv")
+        return sid
+
+    # Docs
+    def doc(self, chars=None):
+        title = self.name("doc")
+        return self.call("POST", "/docs/create", json={
+            "title": title, "content": _text(chars or self.size["doc_chars"], len(title))})["document_id"]
+
+    def shared_doc(self):
+        return self.fixture("doc", self.doc)
+
+@scenario("GET", "/drive/list")
+def bench_drive_list(ctx, n):
+    ctx.drive_tree()
+    return [_request("GET", "/drive/list", params={"limit": 100})] * n
+
+@scenario("GET", "/drive/list-path")
+def bench_drive_list_path(ctx, n):
+    subpath = ctx.drive_tree() + "/d0"
+    return [_request("GET", "/drive/list-path", params={"subpath": subpath})] * n
+
+@scenario("GET", "/drive/tree")
+def bench_drive_tree(ctx, n):
+    subpath = ctx.drive_tree()
+    return [_request("GET", "/drive/tree", params={"subpath": subpath, "limit": 1000})] * n
+
+@scenario("GET", "/drive/du")
+def bench_drive_du(ctx, n):
+    path = ctx.drive_tree()
+    return [_request("GET", "/drive/du", params={"path": path, "depth": 1})] * n
+
+@scenario("GET", "/drive/read-file")
+def bench_drive_read_file(ctx, n):
+    return [_request("GET", "/drive/read-file", params={"filename": ctx.drive_file()})] * n
+
+@scenario("POST", "/drive/write-file")
+def bench_drive_write_file(ctx, n):
+    content = _text(ctx.size["file_bytes"])
+    return [_request("POST", "/drive/write-file", json={"filename": ctx.folder("writes", f"{ctx.name('w')}.txt"),
+                                                        "content": content}) for _ in range(n)]
+
+@scenario("POST", "/drive/uploads")
+def bench_drive_uploads_start(ctx, n):
+    return [_request("POST", "/drive/uploads", json={"filename": ctx.folder("uploads", ctx.name("u")),
+                                                     "size": ctx.size["file_bytes"]}) for _ in range(n)]
+
+@scenario("GET", "/drive/uploads/{upload_id}")
+def bench_drive_upload_status(ctx, n):
+    upload_id = ctx.upload()
+    return [_request("GET", f"/drive/uploads/{upload_id}")] * n
+
+@scenario("PUT", "/drive/uploads/{upload_id}")
+def bench_drive_upload_chunk(ctx, n):
+    data = os.urandom(ctx.size["file_bytes"])
+    return [_request("PUT", f"/drive/uploads/{ctx.upload()}", params={"offset": 0},
+                     body=data, content_type="application/octet-stream") for _ in range(n)]
+
+@scenario("DELETE", "/drive/uploads/{upload_id}")
+def bench_drive_upload_abort(ctx, n):
+    return [_request("DELETE", f"/drive/uploads/{ctx.upload()}") for _ in range(n)]
+
+@scenario("POST", "/drive/uploads/{upload_id}/commit")
+def bench_drive_upload_commit(ctx, n):
+    data = os.urandom(ctx.size["file_bytes"])
+    return [_request("POST", f"/drive/uploads/{ctx.upload(data)}/commit") for _ in range(n)]
+
+@scenario("POST", "/drive/create-folder")
+def bench_drive_create_folder(ctx, n):
+    return [_request("POST", "/drive/create-folder", json={"folder_path": ctx.folder("folders", ctx.name("f"), "a", "b")})
+            for _ in range(n)]
+
+@scenario("POST", "/drive/move-file")
+def bench_drive_move(ctx, n):
+    requests = []
+    for _ in range(n):
+        src = ctx.write_file(ctx.folder("moves", ctx.name("m")))
+        requests.append(_request("POST", "/drive/move-file", json={"src": src, "dst": src + "-moved"}))
+    return requests
+
+@scenario("POST", "/drive/copy")
+def bench_drive_copy(ctx, n):
+    src = ctx.drive_file()
+    return [_request("POST", "/drive/copy", json={"src": src, "dst": ctx.folder("copies", ctx.name("c"))})
+            for _ in range(n)]
+
+@scenario("POST", "/drive/batch")
+def bench_drive_batch(ctx, n):
+    requests = []
+    for _ in range(n):
+        base = ctx.folder("batches", ctx.name("b"))
+        requests.append(_request("POST", "/drive/batch", json={"operations": [
+            {"op": "create_folder", "folder_path": f"{base}/{k}"} for k in range(ctx.size["batch_ops"])]}))
+    return requests
+
+@scenario("DELETE", "/drive/delete-file")
+def bench_drive_delete(ctx, n):
+    return [_request("DELETE", "/drive/delete-file", params={"path": ctx.write_file(ctx.folder("deletes", ctx.name("d")))})
+            for _ in range(n)]
+
+@scenario("GET", "/drive/trash")
+def bench_drive_trash(ctx, n):
+    ctx.fixture("trash", lambda: ctx.trashed(20))
+    return [_request("GET", "/drive/trash", params={"limit": 100})] * n
+
+@scenario("POST", "/drive/trash/restore")
+def bench_drive_trash_restore(ctx, n):
+    return [_request("POST", "/drive/trash/restore", json={"id": entry_id}) for entry_id in ctx.trashed(n)]
+
+@scenario("DELETE", "/drive/trash/{entry_id}")
+def bench_drive_trash_purge(ctx, n):
+    return [_request("DELETE", f"/drive/trash/{entry_id}") for entry_id in ctx.trashed(n)]
+
+@scenario("POST", "/drive/trash/empty", scope="global")
+def bench_drive_trash_empty(ctx, n):
+    ctx.trashed(10)
+    return [_request("POST", "/drive/trash/empty")] * n
+
+@scenario("POST", "/drive/gc")
+def bench_drive_gc(ctx, n):
+    return [_request("POST", "/drive/gc")] * n
+
+@scenario("GET", "/drive/get_metadata")
+def bench_drive_metadata(ctx, n):
+    return [_request("GET", "/drive/get_metadata", params={"path": ctx.drive_file()})] * n
+
+@scenario("POST", "/sheets/create")
+def bench_sheets_create(ctx, n):
+    data = list(_sheet_rows(ctx.size["update_rows"]))
+    return [_request("POST", "/sheets/create", json={"name": ctx.name("c"), "data": data}) for _ in range(n)]
+
+@scenario("GET", "/sheets/read")
+def bench_sheets_read(ctx, n):
+    sid = ctx.workbook()
+    return [_request("GET", "/sheets/read", params={"spreadsheet_id": sid, "tab": "Data", "offset": offset, "limit": 500})
+            for offset in (random.Random(i).randrange(ctx.size["sheet_rows"]) for i in range(n))]
+
+@scenario("GET", "/sheets/batch-read")
+def bench_sheets_batch_read(ctx, n):
+    sid = ctx.workbook()
+    last = ctx.size["sheet_rows"]
+    return [_request("GET", "/sheets/batch-read", params={"spreadsheet_id": sid, "ranges": [
+        "Data!A1:H100", f"Data!B{last // 2}:D{last // 2 + 100}", f"Data!A{max(last - 100, 1)}:H{last}"]})] * n
+
+@scenario("POST", "/sheets/update")
+def bench_sheets_update(ctx, n):
+    sid = ctx.sheet(ctx.size["update_rows"])
+    values = list(_sheet_rows(ctx.size["update_rows"], 1))
+    return [_request("POST", "/sheets/update", json={"spreadsheet_id": sid, "values": values})] * n
+
+@scenario("POST", "/sheets/append")
+def bench_sheets_append(ctx, n):
+    sid = ctx.sheet(ctx.size["sheet_rows"])
+    rows = list(_sheet_rows(ctx.size["append_rows"], 2))[1:]
+    return [_request("POST", "/sheets/append", json={"spreadsheet_id": sid, "values": rows})] * n
+
+@scenario("POST", "/sheets/batch-update")
+def bench_sheets_batch_update(ctx, n):
+    sid = ctx.sheet(ctx.size["sheet_rows"])
+    rng = random.Random(3)
+    return [_request("POST", "/sheets/batch-update", json={"spreadsheet_id": sid, "requests": [{"updateCells": {
+        "start": {"rowIndex": rng.randrange(1, ctx.size["sheet_rows"]), "columnIndex": 2},
+        "rows": [{"values": [{"userEnteredValue": {"stringValue": str(rng.randint(0, 100))}}]}]}}]})
+        for _ in range(n)]
+
+@scenario("GET", "/sheets/list-tabs")
+def bench_sheets_list_tabs(ctx, n):
+    def build():
+        sid = ctx.workbook()
+        for i in range(5):
+            ctx.call("POST", "/sheets/add-tab", json={"spreadsheet_id": sid, "title": f"Extra {i}"})
+        return sid
+    sid = ctx.fixture("tabs", build)
+    return [_request("GET", "/sheets/list-tabs", params={"spreadsheet_id": sid})] * n
+
+@scenario("POST", "/sheets/add-tab")
+def bench_sheets_add_tab(ctx, n):
+    sid = ctx.name("tabs")
+    return [_request("POST", "/sheets/add-tab", json={"spreadsheet_id": sid, "title": f"Tab {i}"}) for i in range(n)]
+
+@scenario("DELETE", "/sheets/delete-tab")
+def bench_sheets_delete_tab(ctx, n):
+    sid = ctx.name("tabs")
+    for i in range(n):
+        ctx.call("POST", "/sheets/add-tab", json={"spreadsheet_id": sid, "title": f"Tab {i}"})
+    return [_request("DELETE", "/sheets/delete-tab", params={"spreadsheet_id": sid, "title": f"Tab {i}"}) for i in range(n)]
+
+@scenario("POST", "/sheets/format")
+def bench_sheets_format(ctx, n):
+    sid = ctx.workbook()
+    return [_request("POST", "/sheets/format", json={"spreadsheet_id": sid, "tab": "Data", "formatting": [
+        {"range": "A1:H1", "format": {"textFormat": {"bold": True}}},
+        {"range": "D2:D", "format": {"numberFormat": {"type": "CURRENCY"}}}]})] * n
+
+@scenario("POST", "/sheets/create-filter")
+def bench_sheets_create_filter(ctx, n):
+    sid = ctx.sheet(10)
+    return [_request("POST", "/sheets/create-filter", json={"spreadsheet_id": sid, "tab": "Sheet1",
+                                                            "filter_config": {"where": "qty > 50"}})] * n
+
+@scenario("GET", "/sheets/filter-view")
+def bench_sheets_filter_view(ctx, n):
+    sid = ctx.workbook()
+    filter_id = ctx.fixture("filter", lambda: ctx.call("POST", "/sheets/create-filter", json={
+        "spreadsheet_id": sid, "tab": "Data", "filter_config": {"where": "qty > 50 AND city = 'Oslo'"}})["filter_id"])
+    return [_request("GET", "/sheets/filter-view", params={"spreadsheet_id": sid, "tab": "Data",
+                                                           "filter_id": filter_id, "limit": 100})] * n
+
+@scenario("POST", "/sheets/freeze-panes")
+def bench_sheets_freeze(ctx, n):
+    sid = ctx.workbook()
+    return [_request("POST", "/sheets/freeze-panes", json={"spreadsheet_id": sid, "tab": "Data", "rows": 1, "columns": 1})] * n
+
+@scenario("POST", "/sheets/conditional-format")
+def bench_sheets_conditional_format(ctx, n):
+    sid = ctx.sheet(10)
+    return [_request("POST", "/sheets/conditional-format", json={"spreadsheet_id": sid, "tab": "Sheet1", "rule": {
+        "range": "C2:C", "condition": {"type": "NUMBER_GREATER", "values": [50]},
+        "format": {"backgroundColor": {"red": 1}}}})] * n
+
+@scenario("POST", "/sheets/query")
+def bench_sheets_query(ctx, n):
+    sid = ctx.workbook()
+    return [_request("POST", "/sheets/query", json={"spreadsheet_id": sid, "tab": "Data",
+                                                    "query": "SELECT city, SUM(qty) WHERE price > 100 GROUP BY city"})] * n
+
+@scenario("GET", "/sheets/export")
+def bench_sheets_export(ctx, n):
+    return [_request("GET", "/sheets/export", params={"spreadsheet_id": ctx.workbook(), "tab": "Data"})] * n
+
+@scenario("POST", "/sheets/import")
+def bench_sheets_import(ctx, n):
+    body = _sheet_csv(ctx.size["sheet_rows"] // 10)
+    return [_request("POST", "/sheets/import", params={"spreadsheet_id": ctx.name("i")},
+                     body=body, content_type="text/csv") for _ in range(n)]
+
+@scenario("GET", "/sheets/import-status")
+def bench_sheets_import_status(ctx, n):
+    def build():
+        import_id = ctx.name("job")
+        ctx.call("POST", "/sheets/import", params={"spreadsheet_id": ctx.name("i"), "import_id": import_id},
+                 body=_sheet_csv(100), content_type="text/csv")
+        return import_id
+    import_id = ctx.fixture("import", build)
+    return [_request("GET", "/sheets/import-status", params={"import_id": import_id})] * n
+
+@scenario("GET", "/sheets/cache-stats")
+def bench_sheets_cache_stats(ctx, n):
+    return [_request("GET", "/sheets/cache-stats")] * n
+
+@scenario("POST", "/docs/create")
+def bench_docs_create(ctx, n):
+    content = _text(ctx.size["doc_chars"])
+    return [_request("POST", "/docs/create", json={"title": ctx.name("doc"), "content": content}) for _ in range(n)]
+
+@scenario("GET", "/docs/read")
+def bench_docs_read(ctx, n):
+    return [_request("GET", "/docs/read", params={"document_id": ctx.shared_doc()})] * n
+
+@scenario("POST", "/docs/update")
+def bench_docs_update(ctx, n):
+    document_id = ctx.doc()
+    content = _text(ctx.size["doc_chars"], 1)
+    return [_request("POST", "/docs/update", json={"document_id": document_id, "new_content": content})] * n
+
+@scenario("POST", "/docs/batch-edit")
+def bench_docs_batch_edit(ctx, n):
+    document_id = ctx.doc()
+    return [_request("POST", "/docs/batch-edit", json={"document_id": document_id, "edits": [
+        {"insert": {"index": 0, "text": "Heading\n"}},
+        {"replace": {"start": 0, "end": 7, "text": "Title"}},
+        {"insert": {"text": "\nfooter"}}]})] * n
+
+@scenario("POST", "/docs/format")
+def bench_docs_format(ctx, n):
+    document_id = ctx.doc(1024)
+    return [_request("POST", "/docs/format", json={"document_id": document_id, "requests": [
+        {"updateTextStyle": {"range": {"startIndex": 1, "endIndex": 20}, "textStyle": {"bold": True}}}]})] * n
+
+@scenario("POST", "/docs/insert-image")
+def bench_docs_insert_image(ctx, n):
+    document_id = ctx.doc(1024)
+    return [_request("POST", "/docs/insert-image", json={"document_id": document_id,
+                                                         "image_url": "https://example.com/chart.png", "index": 0})] * n
+
+@scenario("GET", "/search")
+def bench_search(ctx, n):
+    ctx.shared_doc()
+    return [_request("GET", "/search", params={"query": f"{_WORDS[i % len(_WORDS)]} tango", "limit": 20})
+            for i in range(n)]
+
+@scenario("GET", "/web/search")
+def bench_web_search(ctx, n):
+    return [_request("GET", "/web/search", params={"query": "throughput benchmark"})] * n
+
+@scenario("GET", "/web/scrape")
+def bench_web_scrape(ctx, n):
+    return [_request("GET", "/web/scrape", params={"url": "https://example.com/article"})] * n
+
+@scenario("GET", "/metrics")
+def bench_metrics(ctx, n):
+    return [_request("GET", "/metrics")] * n
+
+# --- Load generation ---------------------------------------------------------
+
+def _percentile(ordered, p):
+    # Nearest-rank percentile of an ascending list
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+def _fire(transport, requests, concurrency):
+    latencies = [0.0] * len(requests)
+    statuses = [0] * len(requests)
+    sizes = [0] * len(requests)
+    failures = []
+    indexes = itertools.count()
+
+    def worker():
+        for i in indexes:
+            if i >= len(requests):
+                return
+            started = time.perf_counter()
+            status, body = transport.request(requests[i])
+            latencies[i] = time.perf_counter() - started
+            statuses[i], sizes[i] = status, len(body)
+            if not 200 <= status < 300 and not failures:
+                failures.append(f"{status}: {body[:200].decode('utf-8', 'replace')}")
+
+    threads = [threading.Thread(target=worker) for _ in range(min(concurrency, len(requests)))]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started, latencies, statuses, sizes, failures
+
+def _measure(transport, rss, build, ctx, args, concurrency):
+    requests = build(ctx, args.warmup + args.requests)
+    if args.warmup:
+        _fire(transport, requests[:args.warmup], concurrency)
+    if rss:
+        rss.reset()
+    elapsed, latencies, statuses, sizes, failures = _fire(transport, requests[args.warmup:], concurrency)
+    ordered = sorted(latencies)
+    errors = sum(1 for status in statuses if not 200 <= status < 300)
+    result = {
+        "concurrency": concurrency,
+        "requests": len(ordered),
+        "errors": errors,
+        "throughput_rps": round(len(ordered) / elapsed, 1),
+        "mean_ms": round(1000 * sum(ordered) / len(ordered), 3),
+        "p50_ms": round(1000 * _percentile(ordered, 50), 3),
+        "p90_ms": round(1000 * _percentile(ordered, 90), 3),
+        "p99_ms": round(1000 * _percentile(ordered, 99), 3),
+        "max_ms": round(1000 * ordered[-1], 3),
+        "response_bytes": round(sum(sizes) / len(sizes)),
+        "peak_rss_mb": rss.read() if rss else None,
+    }
+    if failures:
+        result["first_error"] = failures[0]
+    return result
+
+# --- Targets -----------------------------------------------------------------
+
+_DATA_ENV = ("DRIVE_DIR", "SHEETS_DIR", "DOCS_DIR", "DATA_DIR", "LOGS_DIR")
+
+def _data_env(root):
+    return {name: os.path.join(root, name.lower()[:-4]) for name in _DATA_ENV}
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _server_command(server, port):
+    if server == "gunicorn":
+        return [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "-b", f"127.0.0.1:{port}", "app:app"]
+    if server == "uvicorn":
+        return [sys.executable, "-m", "uvicorn", "asgi:app", "--host", "127.0.0.1", "--port", str(port),
+                "--log-level", "warning"]
+    return [sys.executable, "app.py"]
+
+def _wait_ready(transport, proc, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"server exited with status {proc.returncode}")
+        status, _ = transport.request(_request("GET", "/web/search", params={"query": "ping"}))
+        if status == 200:
+            return
+        time.sleep(0.2)
+    raise RuntimeError("server did not become ready")
+
+@contextlib.contextmanager
+def _target(args):
+    # (transport, PeakRss or None) for the chosen mode, torn down afterwards
+    if args.url:
+        yield HttpTransport(args.url), None
+        return
+    root = tempfile.mkdtemp(prefix="bench-")
+    env = _data_env(root)
+    for path in env.values():
+        os.makedirs(path, exist_ok=True)
+    try:
+        if args.mode == "client":
+            os.environ.update(env)
+            sys.path.insert(0, HERE)
+            import app
+            app.start_background_tasks()
+            yield ClientTransport(app.app), _peak_rss(os.getpid())
+            return
+        port = _free_port()
+        with open(os.path.join(root, "server.log"), "wb") as log:
+            proc = subprocess.Popen(_server_command(args.server, port), cwd=HERE, stdout=log, stderr=subprocess.STDOUT,
+                                    env={**os.environ, **env, "PORT": str(port)})
+            try:
+                transport = HttpTransport(f"http://127.0.0.1:{port}")
+                _wait_ready(transport, proc)
+                yield transport, _peak_rss(proc.pid)
+            finally:
+                proc.send_signal(signal.SIGTERM)
+                try:
+                    proc.wait(timeout=30)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+    finally:
+        if args.keep:
+            print(f"data kept in {root}", file=sys.stderr)
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+def _operations(spec_path):
+    with open(spec_path, encoding="utf-8") as f:
+        spec = json.load(f)
+    return [f"{method.upper()} {path}" for path, item in spec["paths"].items()
+            for method in item if method in ("get", "post", "put", "delete", "patch")]
+
+def _cleanup(ctx):
+    # Remote runs: take the drive folder and any trash fixtures the
+    # scenarios did not consume out again, bypassing the trash
+    try:
+        ctx.trash_ids.append(ctx.call("DELETE", "/drive/delete-file", params={"path": ctx.prefix})["trash_id"])
+    except RuntimeError as e:
+        print(f"cleanup failed: {e}", file=sys.stderr)
+    for trash_id in ctx.trash_ids:
+        ctx.transport.request(_request("DELETE", f"/drive/trash/{trash_id}"))
+
+_COLUMNS = (("route", 44), ("c", 4), ("req/s", 9), ("p50 ms", 9), ("p90 ms", 9), ("p99 ms", 9),
+            ("max ms", 9), ("errors", 7), ("rss MB", 8))
+
+def _row(values):
+    return "".join(str(v).ljust(w) if i == 0 else str(v).rjust(w) for i, (v, (_, w)) in enumerate(zip(values, _COLUMNS)))
+
+def run(args):
+    operations = _operations(args.spec)
+    if args.routes:
+        operations = [op for op in operations if re.search(args.routes, op)]
+    missing = [op for op in operations if op not in SCENARIOS]
+    if missing:
+        print("no benchmark scenario for: " + ", ".join(missing), file=sys.stderr)
+        return 2
+    levels = [int(c) for c in args.concurrency.split(",")]
+    prefix = f"bench-{os.getpid()}-{int(time.time())}"
+    results = []
+
+    with _target(args) as (transport, rss):
+        ctx = Context(transport, args.size, prefix)
+        ctx.call("POST", "/drive/create-folder", json={"folder_path": prefix})
+        print(_row([name for name, _ in _COLUMNS]))
+        for op in operations:
+            build, scope = SCENARIOS[op]
+            if scope == "global" and args.url and not args.include_global:
+                print(_row([op, "", "skipped (acts on the whole drive; --include-global)"]))
+                continue
+            for concurrency in levels:
+                try:
+                    result = {"route": op, **_measure(transport, rss, build, ctx, args, concurrency)}
+                except RuntimeError as e:
+                    print(_row([op, concurrency, f"setup failed: {e}"]))
+                    results.append({"route": op, "concurrency": concurrency, "setup_error": str(e)})
+                    continue
+                results.append(result)
+                print(_row([op, concurrency, result["throughput_rps"], result["p50_ms"], result["p90_ms"],
+                            result["p99_ms"], result["max_ms"], result["errors"],
+                            "-" if result["peak_rss_mb"] is None else result["peak_rss_mb"]]))
+        if args.url:
+            _cleanup(ctx)
+
+    if args.out:
+        try:
+            commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE, capture_output=True,
+                                    text=True).stdout.strip() or None
+        except OSError:
+            commit = None
+        meta = {"mode": "http" if args.url else args.mode, "server": args.url or (args.server if args.mode == "http" else None),
+                "size": args.size, "requests": args.requests, "warmup": args.warmup, "concurrency": levels,
+                "commit": commit, "python": platform.python_version(), "platform": platform.platform(),
+                "cpus": os.cpu_count(), "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z")}
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump({"meta": meta, "results": results}, f, indent=2)
+        print(f"results written to {args.out}")
+    return 1 if any(r.get("errors") or r.get("setup_error") for r in results) else 0
+
+# --- Comparison --------------------------------------------------------------
+
+# (metric, +1 when higher is worse, -1 when lower is worse)
+_COMPARED = (("p50_ms", 1), ("p99_ms", 1), ("throughput_rps", -1), ("peak_rss_mb", 1))
+_RSS_FLOOR_MB = 2.0  # smaller RSS moves are allocator noise
+
+def compare(args):
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    with open(args.candidate, encoding="utf-8") as f:
+        candidate = json.load(f)
+    for key in ("mode", "server", "size", "requests"):
+        if baseline["meta"].get(key) != candidate["meta"].get(key):
+            print(f"warning: runs differ in {key}: {baseline['meta'].get(key)} vs {candidate['meta'].get(key)}")
+
+    def keyed(run):
+        return {(r["route"], r["concurrency"]): r for r in run["results"] if "setup_error" not in r}
+    before, after = keyed(baseline), keyed(candidate)
+
+    regressions = 0
+    for key in sorted(before.keys() | after.keys()):
+        route, concurrency = key
+        if key not in before or key not in after:
+            print(f"{route} c={concurrency}: only in {'candidate' if key in after else 'baseline'}")
+            continue
+        notes = []
+        for metric, direction in _COMPARED:
+            old, new = before[key].get(metric), after[key].get(metric)
+            if old is None or new is None or old == 0:
+                continue
+            change = 100 * (new - old) / old
+            floor = args.min_ms if metric.endswith("_ms") else _RSS_FLOOR_MB if metric == "peak_rss_mb" else 0
+            if abs(change) <= args.threshold or abs(new - old) < floor:
+                continue
+            worse = change * direction > 0
+            regressions += worse
+            notes.append(f"{metric} {old} -> {new} ({change:+.1f}%{' REGRESSION' if worse else ''})")
+        if notes:
+            print(f"{route} c={concurrency}: " + "; ".join(notes))
+    print(f"{regressions} regression(s) beyond {args.threshold}%")
+    return 1 if regressions else 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark every route of the tool server.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="measure every route in openapi.json")
+    run_parser.add_argument("--mode", choices=("client", "http"), default="client")
+    run_parser.add_argument("--server", choices=("gunicorn", "uvicorn", "flask"), default="gunicorn",
+                            help="server to spawn in http mode")
+    run_parser.add_argument("--url", help="benchmark an already running server instead of spawning one")
+    run_parser.add_argument("--size", choices=sorted(SIZES), default="small")
+    run_parser.add_argument("--concurrency", default="1,8,32", help="comma-separated client thread counts")
+    run_parser.add_argument("--requests", type=int, default=200, help="timed requests per route and level")
+    run_parser.add_argument("--warmup", type=int, default=10, help="untimed requests before each measurement")
+    run_parser.add_argument("--routes", help="only routes matching this regex, e.g. '^GET /sheets'")
+    run_parser.add_argument("--spec", default=os.path.join(HERE, "openapi.json"))
+    run_parser.add_argument("--out", help="write results as JSON for `compare`")
+    run_parser.add_argument("--include-global", action="store_true",
+                            help="with --url, also run routes that act on the whole drive")
+    run_parser.add_argument("--keep", action="store_true", help="keep the throwaway data directory")
+
+    compare_parser = commands.add_parser("compare", help="flag regressions between two result files")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+    compare_parser.add_argument("--threshold", type=float, default=10.0, help="percent change to flag")
+    compare_parser.add_argument("--min-ms", type=float, default=0.5, help="ignore latency moves smaller than this")
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        if args.url:
+            args.mode = "http"
+        return run(args)
+    return compare(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
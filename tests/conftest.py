@@ -0,0 +1,18 @@
+# app.py reads its data directories from the environment at import time,
+# so point them at a throwaway tree before any test imports it.
+
+import os
+import sys
+import tempfile
+
+_ROOT = tempfile.mkdtemp(prefix="toolserver-tests-")
+for name in ("drive", "sheets", "docs", "logs", "data"):
+    os.makedirs(os.path.join(_ROOT, name))
+os.environ.update(
+    DRIVE_DIR=os.path.join(_ROOT, "drive"),
+    SHEETS_DIR=os.path.join(_ROOT, "sheets"),
+    DOCS_DIR=os.path.join(_ROOT, "docs"),
+    LOGS_DIR=os.path.join(_ROOT, "logs"),
+    DATA_DIR=os.path.join(_ROOT, "data"),
+)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
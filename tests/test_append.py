@@ -0,0 +1,24 @@
+import os
+
+import app
+
+def test_append_after_missing_trailing_newline(monkeypatch):
+    # Serve reads from the row index rather than the parsed-sheet cache
+    monkeypatch.setattr(app, "SHEET_INDEX_STRIDE", 2)
+    monkeypatch.setattr(app.sheet_cache, "max_bytes", 0)
+    path = os.path.join(app.SHEETS_DIR, "unterminated.csv")
+    with open(path, "wb") as f:
+        f.write(b"h,v\r\nr1,x\r\nr2,y")
+    client = app.app.test_client()
+    # Index the sheet before the append, so the append extends the index
+    assert app._row_index(path)[1] == 3
+
+    response = client.post("/sheets/append", json={
+        "spreadsheet_id": "unterminated",
+        "values": [["r3", "x"], ["r4", "y"], ["r5", "z"]],
+    })
+    assert response.get_json()["first_row"] == 4
+
+    body = client.get("/sheets/read", query_string={"spreadsheet_id": "unterminated", "range": "A5:B6"}).get_json()
+    assert body["values"] == [["r4", "y"], ["r5", "z"]]
+    assert body["total_rows"] == 6
@@ -0,0 +1,48 @@
+import asyncio
+import json
+
+import asgi
+
+async def _call(method, path, query=b"", headers=(), body=b""):
+    sent = []
+    pending = [{"type": "http.request", "body": body, "more_body": False}]
+
+    async def receive():
+        return pending.pop(0) if pending else {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "http",
+        "method": method,
+        "path": path,
+        "query_string": query,
+        "headers": [(k.encode("latin-1"), v.encode("latin-1")) for k, v in headers],
+    }
+    await asgi.app(scope, receive, send)
+    return sent
+
+def test_streamed_response_completes():
+    # stream_with_context pops Flask's contexts after the last chunk, which
+    # may be pulled on a different pool thread than the view ran on
+    rows = "".join(f"r{i},{i}\n" for i in range(2000))
+    sent = asyncio.run(_call(
+        "POST", "/sheets/import",
+        query=b"spreadsheet_id=asgi_stream&format=csv",
+        headers=[("accept", "application/x-ndjson"), ("content-type", "text/csv")],
+        body=("a,b\n" + rows).encode(),
+    ))
+    assert sent[0]["type"] == "http.response.start"
+    assert sent[0]["status"] == 200
+    assert sent[-1] == {"type": "http.response.body", "body": b"", "more_body": False}
+    body = b"".join(m.get("body", b"") for m in sent[1:])
+    records = [json.loads(line) for line in body.decode().splitlines()]
+    assert records[-1]["state"] == "done"
+    assert records[-1]["rows"] == 2001  # header included
+
+def test_buffered_response():
+    sent = asyncio.run(_call("GET", "/sheets/read", query=b"spreadsheet_id=asgi_stream&range=A1:B2"))
+    assert sent[0]["status"] == 200
+    body = b"".join(m.get("body", b"") for m in sent[1:])
+    assert json.loads(body)["values"] == [["a", "b"], ["r0", "0"]]
@@ -0,0 +1,43 @@
+import os
+
+import app
+
+_ROWS = [
+    ["id", "zip", "ratio", "mixed", "blank"],
+    ["1", "007", "0.5", "12", ""],
+    ["2", "10", "1.0", "x", ""],
+    ["-3", "", "1e3", "4.25", ""],
+    ["40000000000", "99", "-0", "", ""],
+]
+
+def test_rows_round_trip_exactly(monkeypatch):
+    monkeypatch.setattr(app, "SHEETS_STORAGE", "columnar")
+    monkeypatch.setattr(app, "COLUMNAR_GROUP_ROWS", 2)
+    client = app.app.test_client()
+    client.post("/sheets/create", json={"name": "columnar", "data": _ROWS})
+    path = os.path.join(app.SHEETS_DIR, "columnar.csv")
+    assert os.path.exists(app._columnar_path(path)) and not os.path.exists(path)
+
+    sheet = app._open_columnar(path)
+    assert (sheet.rows, list(sheet.first_row)) == (len(_ROWS), _ROWS[0])
+    # Only columns whose every present cell round-trips are stored as numbers
+    assert [column["type"] for column in sheet.meta] == ["int", "str", "str", "str", "int"]
+    assert list(sheet.iter_rows(1)) == _ROWS[1:]
+    values = client.get("/sheets/read", query_string={"spreadsheet_id": "columnar"}).get_json()["values"]
+    assert values == _ROWS
+    window = client.get("/sheets/read", query_string={"spreadsheet_id": "columnar", "range": "B2:C3"}).get_json()
+    assert window["values"] == [["007", "0.5"], ["10", "1.0"]]
+
+def test_writes_replace_the_file_and_keep_it_columnar(monkeypatch):
+    monkeypatch.setattr(app, "SHEETS_STORAGE", "columnar")
+    client = app.app.test_client()
+    client.post("/sheets/create", json={"name": "columnar-writes", "data": _ROWS[:2]})
+    path = os.path.join(app.SHEETS_DIR, "columnar-writes.csv")
+    client.post("/sheets/append", json={"spreadsheet_id": "columnar-writes", "values": [["5", "01", "2", "y", ""]]})
+    client.post("/sheets/batch-update", json={"spreadsheet_id": "columnar-writes", "mode": "rewrite", "requests": [
+        {"updateCells": {"start": {"rowIndex": 1, "columnIndex": 1},
+                         "rows": [{"values": [{"userEnteredValue": {"stringValue": "abc"}}]}]}}]})
+    expected = [_ROWS[0], ["1", "abc", "0.5", "12", ""], ["5", "01", "2", "y", ""]]
+    assert client.get("/sheets/read", query_string={"spreadsheet_id": "columnar-writes"}).get_json()["values"] == expected
+    assert not os.path.exists(path)
+    assert list(app._open_columnar(path).iter_rows(0)) == expected
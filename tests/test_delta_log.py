@@ -0,0 +1,72 @@
+import csv
+import os
+import time
+
+import app
+
+def _edit(client, sid, row, col, *values):
+    cells = [{"userEnteredValue": {"stringValue": v}} for v in values]
+    response = client.post("/sheets/batch-update", json={"spreadsheet_id": sid, "mode": "delta", "requests": [
+        {"updateCells": {"start": {"rowIndex": row, "columnIndex": col}, "rows": [{"values": cells}]}}]})
+    assert response.status_code == 200
+    return response
+
+def _read(client, sid):
+    return client.get("/sheets/read", query_string={"spreadsheet_id": sid}).get_json()["values"]
+
+def _csv(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        return list(csv.reader(f))
+
+def _wait_for_compaction(path):
+    deadline = time.time() + 5
+    while os.path.exists(app._sidecar_path(path, "delta")) and time.time() < deadline:
+        time.sleep(0.01)
+    with app._compaction_guard:
+        assert path not in app._compaction_pending
+
+def test_edits_are_logged_then_compacted(monkeypatch):
+    client = app.app.test_client()
+    client.post("/sheets/create", json={"name": "delta", "data": [["k", "v"], ["a", "1"], ["b", "2"]]})
+    path = os.path.join(app.SHEETS_DIR, "delta.csv")
+    _edit(client, "delta", 1, 1, "10")
+    _edit(client, "delta", 1, 1, "11")     # the later edit wins
+    _edit(client, "delta", 4, 0, "e", "5")  # past the end: rows grow, the gap is empty
+    expected = [["k", "v"], ["a", "11"], ["b", "2"], [], ["e", "5"]]
+
+    # The CSV is untouched until compaction; reads apply the log
+    assert _csv(path) == [["k", "v"], ["a", "1"], ["b", "2"]]
+    assert os.path.exists(app._sidecar_path(path, "delta"))
+    assert _read(client, "delta") == expected
+
+    # A torn trailing line from an interrupted write is skipped
+    with open(app._sidecar_path(path, "delta"), "a", encoding="utf-8") as f:
+        f.write('[[2,1,"tor')
+    assert _read(client, "delta") == expected
+
+    monkeypatch.setattr(app, "SHEET_DELTA_COMPACT_BYTES", 1)
+    _edit(client, "delta", 2, 1, "20")
+    expected[2] = ["b", "20"]
+    _wait_for_compaction(path)
+    assert _csv(path) == expected
+    assert _read(client, "delta") == expected
+
+def test_append_folds_the_log_first():
+    client = app.app.test_client()
+    client.post("/sheets/create", json={"name": "delta-append", "data": [["k", "v"], ["a", "1"]]})
+    _edit(client, "delta-append", 2, 0, "b", "2")
+    response = client.post("/sheets/append", json={"spreadsheet_id": "delta-append", "values": [["c", "3"]]})
+    assert response.get_json()["first_row"] == 4
+    assert _read(client, "delta-append") == [["k", "v"], ["a", "1"], ["b", "2"], ["c", "3"]]
+    assert not os.path.exists(app._sidecar_path(os.path.join(app.SHEETS_DIR, "delta-append.csv"), "delta"))
+
+def test_full_rewrite_drops_the_log():
+    client = app.app.test_client()
+    client.post("/sheets/create", json={"name": "delta-rewrite", "data": [["k"], ["a"]]})
+    _edit(client, "delta-rewrite", 1, 0, "edited")
+    client.post("/sheets/batch-update", json={"spreadsheet_id": "delta-rewrite", "mode": "rewrite", "requests": [
+        {"updateCells": {"start": {"rowIndex": 0, "columnIndex": 0},
+                         "rows": [{"values": [{"userEnteredValue": {"stringValue": "key"}}]}]}}]})
+    path = os.path.join(app.SHEETS_DIR, "delta-rewrite.csv")
+    assert not os.path.exists(app._sidecar_path(path, "delta"))
+    assert _csv(path) == [["key"], ["edited"]]
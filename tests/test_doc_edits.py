@@ -0,0 +1,80 @@
+import os
+import random
+import time
+
+import app
+
+def _client(name, content):
+    client = app.app.test_client()
+    client.post("/docs/create", json={"title": name, "content": content})
+    return client, os.path.join(app.DOCS_DIR, f"{name}.txt")
+
+def _edit(client, name, *edits):
+    return client.post("/docs/batch-edit", json={"document_id": name, "edits": list(edits)})
+
+def _read(client, name):
+    return client.get("/docs/read", query_string={"document_id": name}).get_json()["content"]
+
+def test_piece_table_matches_string_edits():
+    rng = random.Random(11)
+    text = "the quick brown fox"
+    table = app._PieceTable(text, None)
+    for _ in range(2000):
+        if text and rng.random() < 0.4:
+            start = rng.randrange(len(text))
+            end = rng.randint(start, min(len(text), start + 5))
+            table.apply([["d", start, end]])
+            text = text[:start] + text[end:]
+        else:
+            index = rng.randint(0, len(text))
+            insert = rng.choice(["a", "bc", "déf", "\n", ""])
+            table.apply([["i", index, insert]])
+            text = text[:index] + insert + text[index:]
+        assert table.length == len(text)
+    assert table.text() == text
+
+def test_batch_edits_are_logged_and_read_back():
+    client, path = _client("edits", "hello world")
+    response = _edit(client, "edits", {"replace": {"start": 0, "end": 5, "text": "HELLO"}},
+                     {"insert": {"index": 11, "text": "!"}}, {"delete": {"start": 5, "end": 6}})
+    assert response.get_json()["length"] == 11
+    assert _read(client, "edits") == "HELLOworld!"
+    with open(path, encoding="utf-8") as f:
+        assert f.read() == "hello world"  # the base file waits for compaction
+    assert _edit(client, "edits", {"insert": {"index": 12, "text": "x"}}).status_code == 400
+    assert _edit(client, "edits", {"delete": {"start": 3, "end": 2}}).status_code == 400
+    assert _read(client, "edits") == "HELLOworld!"
+
+def test_tables_pick_up_edits_from_other_workers():
+    client, path = _client("edits-shared", "abc")
+    _edit(client, "edits-shared", {"insert": {"index": 3, "text": "d"}})
+    assert _read(client, "edits-shared") == "abcd"
+    # Another worker appends to the log; this worker replays only the new line
+    with open(app._sidecar_path(path, "delta"), "ab") as f:
+        f.write(b'[["i",0,">"]]\n')
+    assert _read(client, "edits-shared") == ">abcd"
+    # A torn line is skipped, and the next edit is not glued onto it
+    with open(app._sidecar_path(path, "delta"), "ab") as f:
+        f.write(b'[["i",0,"tor')
+    assert _read(client, "edits-shared") == ">abcd"
+    _edit(client, "edits-shared", {"insert": {"index": 5, "text": "e"}})
+    with app._doc_tables_lock:
+        app._doc_tables.pop(path)
+    assert _read(client, "edits-shared") == ">abcde"
+
+def test_compaction_folds_the_log_into_the_file(monkeypatch):
+    client, path = _client("edits-compact", "0123456789")
+    _edit(client, "edits-compact", {"delete": {"start": 0, "end": 2}})
+    # Line windows read the file itself, so pending edits are folded first
+    body = client.get("/docs/read", query_string={"document_id": "edits-compact", "num_lines": 1}).get_json()
+    assert body["content"] == "23456789"
+    assert not os.path.exists(app._sidecar_path(path, "delta"))
+
+    monkeypatch.setattr(app, "DOC_DELTA_COMPACT_BYTES", 1)
+    _edit(client, "edits-compact", {"insert": {"index": 8, "text": "!"}})
+    deadline = time.time() + 5
+    while os.path.exists(app._sidecar_path(path, "delta")) and time.time() < deadline:
+        time.sleep(0.01)
+    with open(path, encoding="utf-8") as f:
+        assert f.read() == "23456789!"
+    assert _read(client, "edits-compact") == "23456789!"
@@ -0,0 +1,81 @@
+import os
+
+import app
+
+def _tree(root):
+    found = {}
+    for folder, dirs, files in os.walk(root):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        rel = os.path.relpath(folder, root)
+        found[rel] = None
+        for name in files:
+            with open(os.path.join(folder, name), encoding="utf-8") as f:
+                found[os.path.normpath(os.path.join(rel, name))] = f.read()
+    return found
+
+def _setup(client, root):
+    for name in ("f1", "f2", "f3", "f4"):
+        client.post("/drive/write-file", json={"filename": f"{root}/{name}.txt", "content": name * 3})
+    return os.path.join(app.BASE_DIR, root)
+
+def _failing_copy(monkeypatch):
+    real_copy = app._drive_copy
+    def copy(src, dst):
+        if os.path.basename(dst) == "boom.txt":
+            raise OSError("disk full")
+        return real_copy(src, dst)
+    monkeypatch.setattr(app, "_drive_copy", copy)
+
+def _operations(root):
+    return [
+        {"op": "create_folder", "folder_path": f"{root}/new/deeper"},
+        {"op": "copy", "src": f"{root}/f1.txt", "dst": f"{root}/new/deeper/f1.txt"},
+        {"op": "move", "src": f"{root}/f2.txt", "dst": f"{root}/new/f2.txt"},
+        {"op": "delete", "path": f"{root}/f3.txt"},
+        {"op": "copy", "src": f"{root}/new/f2.txt", "dst": f"{root}/moved-copy.txt"},
+        {"op": "copy", "src": f"{root}/f4.txt", "dst": f"{root}/boom.txt"},
+    ]
+
+def test_atomic_batch_rolls_back_every_completed_operation(monkeypatch):
+    client = app.app.test_client()
+    root = _setup(client, "batch-atomic")
+    before = _tree(root)
+    trash_before = [meta["id"] for meta in client.get("/drive/trash").get_json()]
+    _failing_copy(monkeypatch)
+
+    response = client.post("/drive/batch", json={"atomic": True, "operations": _operations("batch-atomic")})
+    assert response.status_code == 409
+    body = response.get_json()
+    assert body["rolled_back"] and body["rollback_errors"] == []
+    # Operations that completed before the failure were undone
+    assert sum(r["success"] for r in body["results"]) >= 3
+    assert [r["index"] for r in body["results"] if not r["success"]] == [5]
+    assert _tree(root) == before
+    assert [meta["id"] for meta in client.get("/drive/trash").get_json()] == trash_before
+
+def test_non_atomic_batch_keeps_what_succeeded(monkeypatch):
+    client = app.app.test_client()
+    root = _setup(client, "batch-partial")
+    _failing_copy(monkeypatch)
+
+    body = client.post("/drive/batch", json={"operations": _operations("batch-partial")}).get_json()
+    assert body["success"] is False
+    assert [r["success"] for r in body["results"]] == [True, True, True, True, True, False]
+    after = _tree(root)
+    assert after["new/deeper/f1.txt"] == "f1f1f1"
+    assert after["moved-copy.txt"] == after["new/f2.txt"] == "f2f2f2"
+    assert "f2.txt" not in after and "f3.txt" not in after and "boom.txt" not in after
+
+def test_invalid_batch_applies_nothing():
+    client = app.app.test_client()
+    root = _setup(client, "batch-invalid")
+    before = _tree(root)
+    response = client.post("/drive/batch", json={"atomic": True, "operations": [
+        {"op": "delete", "path": "batch-invalid/f1.txt"},
+        {"op": "move", "src": "batch-invalid/f1.txt", "dst": "batch-invalid/x.txt"},  # already deleted
+        {"op": "copy", "src": "batch-invalid/f2.txt", "dst": "batch-invalid/f3.txt"},  # would overwrite
+        {"op": "delete", "path": "../outside.txt"},
+    ]})
+    assert response.status_code == 400
+    assert [e["index"] for e in response.get_json()["errors"]] == [1, 2, 3]
+    assert _tree(root) == before
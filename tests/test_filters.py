@@ -0,0 +1,35 @@
+import os
+
+import app
+
+def _client():
+    with open(os.path.join(app.SHEETS_DIR, "filtered.csv"), "w", encoding="utf-8") as f:
+        f.write("name,qty\na,1\nb,5\nc,9\n")
+    return app.app.test_client()
+
+def _create(client, config):
+    response = client.post("/sheets/create-filter", json={"spreadsheet_id": "filtered", "tab": "filtered",
+                                                          "filter_config": config})
+    assert response.status_code == 200
+    return response.get_json()["filter_id"]
+
+def _view(client, filter_id):
+    return client.get("/sheets/filter-view", query_string={"spreadsheet_id": "filtered", "filter_id": filter_id})
+
+def test_views_of_where_and_condition_filters():
+    client = _client()
+    where = _create(client, {"where": "qty > 2"})
+    conditions = _create(client, {"conditions": [{"column": "name", "op": "=", "value": "a"},
+                                                 {"column": "qty", "op": ">=", "value": 9}], "match": "any"})
+    assert _view(client, where).get_json()["values"] == [["b", "5"], ["c", "9"]]
+    body = _view(client, conditions).get_json()
+    assert (body["values"], body["row_numbers"]) == ([["a", "1"], ["c", "9"]], [2, 4])
+
+def test_unknown_shapes_are_stored_but_not_viewable():
+    client = _client()
+    # Configs stored before views existed keep being accepted
+    filter_id = _create(client, {"range": "A1:B10", "criteria": {"1": {"hiddenValues": ["x"]}}})
+    saved = [f for f in app._load_filters("filtered", "filtered") if f["filter_id"] == filter_id]
+    assert saved[0]["filter"]["range"] == "A1:B10"
+    assert _view(client, filter_id).status_code == 400
+    assert _view(client, _create(client, {"where": "qty >"})).status_code == 400
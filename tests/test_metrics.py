@@ -0,0 +1,39 @@
+import json
+import os
+import subprocess
+import sys
+
+import app
+
+def _write(path, count):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump([[["requests_total", "GET", "/x", "200"], count]], f)
+
+def _requests(totals):
+    return totals.get(("requests_total", "GET", "/x", "200"), 0)
+
+def test_exited_workers_fold_into_retired_file(monkeypatch, tmp_path):
+    monkeypatch.setattr(app, "METRICS_DIR", tmp_path)
+    monkeypatch.setattr(app, "_metrics_file", (None, None))
+    monkeypatch.setattr(app, "_process_metrics", lambda: {})
+    live = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])
+    try:
+        dead = subprocess.Popen([sys.executable, "-c", "pass"])
+        dead.wait()
+        _write(tmp_path / f"{live.pid}-{app._process_token(live.pid)}.json", 3)
+        _write(tmp_path / f"{dead.pid}-1.json", 5)
+        _write(tmp_path / "99999999-2.json", 7)
+
+        assert _requests(app._all_metrics()) == 15
+        names = sorted(name for name in os.listdir(tmp_path) if app._METRICS_FILE.match(name))
+        assert names == [f"{live.pid}-{app._process_token(live.pid)}.json"]
+        assert _requests(app._all_metrics()) == 15
+
+        # A live writer keeps the run's counters; none left means a new run
+        app.reset_metrics(stale_only=True)
+        assert _requests(app._all_metrics()) == 15
+    finally:
+        live.kill()
+        live.wait()
+    app.reset_metrics(stale_only=True)
+    assert _requests(app._all_metrics()) == 0
@@ -0,0 +1,46 @@
+import app
+
+def _read(client, headers=None, **query):
+    return client.get("/drive/read-file", query_string={"filename": "partial.txt", **query}, headers=headers or {})
+
+def _client():
+    client = app.app.test_client()
+    client.post("/drive/write-file", json={"filename": "partial.txt", "content": "ab\ncd\nefg\n"})
+    return client
+
+def test_byte_ranges():
+    client = _client()
+    response = _read(client, {"Range": "bytes=3-5"})
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == "bytes 3-5/10"
+    assert response.get_json()["content"] == "cd\n"
+
+    response = _read(client, {"Range": "bytes=-4"})
+    assert response.headers["Content-Range"] == "bytes 6-9/10"
+    assert response.get_json()["content"] == "efg\n"
+
+def test_suffix_longer_than_the_file():
+    response = _read(_client(), {"Range": "bytes=-20"})
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == "bytes 0-9/10"
+    body = response.get_json()
+    assert (body["offset"], body["length"], body["content"]) == (0, 10, "ab\ncd\nefg\n")
+
+def test_line_windows():
+    client = _client()
+    body = _read(client, start_line=1, num_lines=1).get_json()
+    assert (body["content"], body["offset"], body["num_lines"]) == ("cd\n", 3, 1)
+    body = _read(client, start_line=2).get_json()
+    assert (body["content"], body["num_lines"]) == ("efg\n", 1)
+    body = _read(client, start_line=7, num_lines=2).get_json()
+    assert (body["content"], body["offset"], body["num_lines"]) == ("", 10, 0)
+
+def test_past_end_of_file():
+    client = _client()
+    response = _read(client, {"Range": "bytes=10-"})
+    assert response.status_code == 416
+    assert response.headers["Content-Range"] == "bytes */10"
+    body = _read(client, offset=8, length=5).get_json()
+    assert (body["content"], body["offset"], body["length"]) == ("g\n", 8, 2)
+    body = _read(client, offset=50).get_json()
+    assert (body["content"], body["offset"], body["length"]) == ("", 10, 0)
@@ -0,0 +1,65 @@
+import os
+import random
+
+import pytest
+
+import app
+
+_QUERIES = [
+    "SELECT * WHERE qty > 40 ORDER BY id",
+    "SELECT name, price WHERE price BETWEEN 10 AND 20.5 AND name LIKE 'b%' ORDER BY price DESC, id LIMIT 7",
+    "SELECT id WHERE note IS NULL OR qty IN (1, 2, 3) ORDER BY id",
+    "SELECT name, COUNT(*) AS n, SUM(qty), AVG(price), MIN(qty), MAX(price) GROUP BY name ORDER BY name",
+    "SELECT id, qty ORDER BY qty DESC, id LIMIT 5 OFFSET 3",
+    "SELECT id WHERE NOT (qty >= 10) AND price < 30 ORDER BY id",
+    "SELECT COUNT(note), COUNT(*)",
+]
+
+def _rows():
+    rng = random.Random(3)
+    rows = [["id", "name", "qty", "price", "note"]]
+    for i in range(200):
+        rows.append([str(i), rng.choice(["apple", "banana", "blueberry", "cherry"]), str(rng.randint(0, 50)),
+                     f"{rng.uniform(1, 40):.2f}", rng.choice(["", "fresh", "ripe"])])
+    return rows
+
+@pytest.fixture(scope="module")
+def client():
+    # The same rows stored once as CSV and once as a columnar file
+    client = app.app.test_client()
+    app.SHEETS_STORAGE = "columnar"
+    try:
+        client.post("/sheets/create", json={"name": "query-col", "data": _rows()})
+    finally:
+        app.SHEETS_STORAGE = "csv"
+    client.post("/sheets/create", json={"name": "query-csv", "data": _rows()})
+    assert app._open_columnar(os.path.join(app.SHEETS_DIR, "query-col.csv")) is not None
+    assert app._open_columnar(os.path.join(app.SHEETS_DIR, "query-csv.csv")) is None
+    return client
+
+def _query(client, sid, query):
+    response = client.post("/sheets/query", json={"spreadsheet_id": sid, "query": query})
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()
+
+@pytest.mark.parametrize("query", _QUERIES)
+def test_csv_and_columnar_agree(client, query):
+    assert _query(client, "query-csv", query) == _query(client, "query-col", query)
+
+def test_query_results(client):
+    body = _query(client, "query-csv", "SELECT id, qty WHERE qty > 40 ORDER BY qty DESC, id LIMIT 3")
+    assert body["headers"] == ["id", "qty"]
+    expected = sorted((r for r in _rows()[1:] if int(r[2]) > 40), key=lambda r: (-int(r[2]), int(r[0])))[:3]
+    assert [[str(id_), str(qty)] for id_, qty in body["rows"]] == [[r[0], r[2]] for r in expected]
+
+def test_columnar_query_sees_pending_edits(client):
+    client.post("/sheets/batch-update", json={"spreadsheet_id": "query-col", "mode": "delta", "requests": [
+        {"updateCells": {"start": {"rowIndex": 1, "columnIndex": 2},
+                         "rows": [{"values": [{"userEnteredValue": {"stringValue": "999"}}]}]}}]})
+    body = _query(client, "query-col", "SELECT id WHERE qty > 900")
+    assert [str(row[0]) for row in body["rows"]] == ["0"]
+
+def test_query_errors(client):
+    for query in ("SELECT", "SELECT * WHERE", "SELECT nope(qty)", "SELECT * LIMIT x"):
+        response = client.post("/sheets/query", json={"spreadsheet_id": "query-csv", "query": query})
+        assert response.status_code == 400
@@ -0,0 +1,50 @@
+import os
+import random
+
+import app
+
+def _scan(rects, r, c):
+    # The per-cell rectangle scan the row bands replace
+    return tuple(i for i, (a, b, x, y, _) in enumerate(rects)
+                 if a <= r and (b is None or r < b) and x <= c and (y is None or c < y))
+
+def test_style_map_bands_match_full_scan():
+    rng = random.Random(7)
+    for _ in range(50):
+        rects = []
+        for k in range(rng.randint(0, 8)):
+            a, x = rng.randint(0, 12), rng.randint(0, 6)
+            b = rng.choice([None, a + rng.randint(1, 6)])
+            y = rng.choice([None, x + rng.randint(1, 4)])
+            rects.append((a, b, x, y, {"k": k}))
+        style_map = app._StyleMap(None, None, rects, {}, {})
+        palette, cell_styles = style_map.resolve([[""] * 8 for _ in range(16)], 2, 1)
+        for r in range(2, 18):
+            for c in range(1, 9):
+                expected = {}
+                for i in _scan(rects, r, c):
+                    expected = app._merge_style(expected, rects[i][4])
+                cell = cell_styles.get(f"{app._column_letters(c)}{r + 1}")
+                assert (palette[cell] if cell is not None else {}) == expected
+
+def test_rendered_read_revalidates(monkeypatch):
+    with open(os.path.join(app.SHEETS_DIR, "styled.csv"), "w", encoding="utf-8") as f:
+        f.write("h,v\nr1,1\nr2,2\n")
+    client = app.app.test_client()
+    query = {"spreadsheet_id": "styled", "render": "true"}
+    first = client.get("/sheets/read", query_string=query)
+    etag = first.headers["ETag"]
+    assert client.get("/sheets/read", query_string=query, headers={"If-None-Match": etag}).status_code == 304
+
+    # New formatting changes the rendered styles, so the old tag is stale
+    tab = app._resolve_tab("styled", None, None)[1]
+    client.post("/sheets/format", json={"spreadsheet_id": "styled", "tab": tab,
+                                        "formatting": [{"range": "A1:B1", "format": {"bold": True}}]})
+    second = client.get("/sheets/read", query_string=query, headers={"If-None-Match": etag})
+    assert second.status_code == 200
+    assert second.get_json()["cell_styles"] == {"A1": 0, "B1": 0}
+
+    # The rendered tag still works as a write precondition
+    response = client.post("/sheets/append", json={"spreadsheet_id": "styled", "values": [["r3", "3"]]},
+                           headers={"If-Match": second.headers["ETag"]})
+    assert response.status_code == 200
@@ -0,0 +1,21 @@
+import os
+
+import app
+
+def _client():
+    return app.app.test_client()
+
+def test_quote_inside_unquoted_field():
+    # A quote in the middle of an unquoted field is data, not an opening quote
+    with open(os.path.join(app.SHEETS_DIR, "pipes.csv"), "wb") as f:
+        f.write(b'h1,h2\r\n5" pipe,a\r\nr2,b\r\nr3,c\r\nr4,d\r\n')
+    body = _client().get("/sheets/read", query_string={"spreadsheet_id": "pipes", "range": "A3:B5"}).get_json()
+    assert body["total_rows"] == 5
+    assert body["values"] == [["r2", "b"], ["r3", "c"], ["r4", "d"]]
+
+def test_quoted_field_spanning_lines(tmp_path):
+    path = tmp_path / "multi.csv"
+    path.write_bytes(b'a,b\r\n"x\r\n""y"" z",1\r\n"q"r,2\r\nlast,3\r\n')
+    offsets, rows = app._build_row_index(str(path), 1)
+    assert rows == 4
+    assert list(offsets) == [0, 5, 21, 29]
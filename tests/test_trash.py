@@ -0,0 +1,54 @@
+import os
+
+import app
+
+def _trash(client, name, content="hello"):
+    client.post("/drive/write-file", json={"filename": name, "content": content})
+    return client.delete("/drive/delete-file", query_string={"path": name}).get_json()["trash_id"]
+
+def test_restore_puts_the_file_back():
+    client = app.app.test_client()
+    entry = _trash(client, "trash-restore/a.txt")
+    assert not os.path.exists(os.path.join(app.BASE_DIR, "trash-restore/a.txt"))
+    assert entry in [meta["id"] for meta in client.get("/drive/trash").get_json()]
+
+    response = client.post("/drive/trash/restore", json={"id": entry})
+    assert response.get_json() == {"success": True, "path": "trash-restore/a.txt"}
+    with open(os.path.join(app.BASE_DIR, "trash-restore/a.txt"), encoding="utf-8") as f:
+        assert f.read() == "hello"
+    assert entry not in [meta["id"] for meta in client.get("/drive/trash").get_json()]
+    assert client.post("/drive/trash/restore", json={"id": entry}).status_code == 404
+
+def test_restore_refuses_an_existing_destination():
+    client = app.app.test_client()
+    entry = _trash(client, "trash-conflict.txt", "old")
+    client.post("/drive/write-file", json={"filename": "trash-conflict.txt", "content": "new"})
+    assert client.post("/drive/trash/restore", json={"id": entry}).status_code == 409
+    response = client.post("/drive/trash/restore", json={"id": entry, "dst": "trash-conflict-old.txt"})
+    assert response.status_code == 200
+    with open(os.path.join(app.BASE_DIR, "trash-conflict-old.txt"), encoding="utf-8") as f:
+        assert f.read() == "old"
+
+def test_restore_stays_inside_the_drive_and_out_of_the_trash():
+    client = app.app.test_client()
+    entry = _trash(client, "trash-escape.txt")
+    for dst in ("../escaped.txt", ".trash/zzz", os.path.join(os.path.dirname(app.BASE_DIR), "abs.txt"), "."):
+        assert client.post("/drive/trash/restore", json={"id": entry, "dst": dst}).status_code == 400
+    assert not os.path.exists(os.path.join(os.path.dirname(app.BASE_DIR), "escaped.txt"))
+    assert not os.path.exists(os.path.join(app.TRASH_DIR, "zzz"))
+    assert entry in [meta["id"] for meta in client.get("/drive/trash").get_json()]
+
+def test_purge_and_empty():
+    client = app.app.test_client()
+    first = _trash(client, "trash-purge-1.txt", "x" * 10)
+    second = _trash(client, "trash-purge-2.txt", "y" * 20)
+
+    response = client.delete(f"/drive/trash/{first}")
+    assert response.get_json() == {"success": True, "freed_bytes": 10}
+    assert client.delete(f"/drive/trash/{first}").status_code == 404
+    assert not os.path.exists(os.path.join(app.TRASH_DIR, first))
+
+    emptied = client.post("/drive/trash/empty").get_json()
+    assert emptied["purged"] >= 1 and emptied["freed_bytes"] >= 20
+    assert second not in [meta["id"] for meta in client.get("/drive/trash").get_json()]
+    assert client.get("/drive/trash").get_json() == []
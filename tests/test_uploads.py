@@ -0,0 +1,46 @@
+import os
+import threading
+
+import app
+
+def _open_upload(client, content):
+    upload_id = client.post("/drive/uploads", json={"filename": "uploaded.bin", "size": len(content)}).get_json()["upload_id"]
+    client.put(f"/drive/uploads/{upload_id}", query_string={"offset": 0}, data=content)
+    return upload_id
+
+def test_abort_waits_for_the_upload_lock():
+    client = app.app.test_client()
+    upload_id = _open_upload(client, b"abc")
+    part_path, meta_path = app._upload_paths(upload_id)
+    results = []
+    with app._file_lock(part_path):
+        aborter = threading.Thread(target=lambda: results.append(client.delete(f"/drive/uploads/{upload_id}").status_code))
+        aborter.start()
+        aborter.join(0.3)
+        # Abort is blocked behind the holder (a chunk or a commit)
+        assert aborter.is_alive() and os.path.exists(part_path) and os.path.exists(meta_path)
+    aborter.join()
+    assert results == [200]
+    assert not os.path.exists(part_path) and not os.path.exists(meta_path)
+    assert client.delete(f"/drive/uploads/{upload_id}").status_code == 404
+
+def test_lock_files_outlive_the_data(monkeypatch):
+    client = app.app.test_client()
+    committed = _open_upload(client, b"abc")
+    aborted = _open_upload(client, b"xyz")
+    assert client.post(f"/drive/uploads/{committed}/commit").status_code == 200
+    assert client.delete(f"/drive/uploads/{aborted}").status_code == 200
+    locks = [app._sidecar_path(app._upload_paths(i)[0], "lock") for i in (committed, aborted)]
+    assert all(os.path.exists(lock) for lock in locks)
+
+    live = _open_upload(client, b"a")
+    app._expire_uploads()
+    assert not any(os.path.exists(lock) for lock in locks)
+    assert client.get(f"/drive/uploads/{live}").get_json()["offset"] == 1
+
+    monkeypatch.setattr(app, "UPLOAD_TTL_SECONDS", -1)
+    app._expire_uploads()
+    assert client.get(f"/drive/uploads/{live}").status_code == 404
+    assert os.path.exists(app._sidecar_path(app._upload_paths(live)[0], "lock"))
+    app._expire_uploads()
+    assert not os.path.exists(app._sidecar_path(app._upload_paths(live)[0], "lock"))